@@ -0,0 +1,105 @@
+"""Checkpoints for resumable parsehl7 runs.
+
+A checkpoint is a small JSON file that records the files already done, the
+byte offset of the last message written from the current file and the size
+of the output at that moment. It is replaced atomically, only after the
+output it describes has been flushed to disk, so a restarted run truncates
+the output back to the checkpointed size and carries on from the next
+message: nothing is lost and nothing is written twice.
+"""
+import json
+import os
+
+
+class CheckpointMismatch(Exception):
+    """ the checkpoint belongs to a run over different paths or output """
+
+
+class Checkpoint(object):
+    """Progress of a batch run over paths, kept in the file at path.
+
+    Reading code calls opened() for each input file in order; writing code
+    calls advance() with the source and offset of the last message written
+    and then save().
+    """
+
+    def __init__(self, path, paths, output):
+        self.path = path
+        self.paths = list(paths)
+        self.output = os.path.abspath(output)
+        self.completed = []
+        self.current = None
+        self.offset = -1
+        self.output_size = 0
+        self.messages = 0
+        self.resumed = False
+        self._completed = set()
+        self._opened = []
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as fh:
+            state = json.load(fh)
+        if state["paths"] != self.paths or state["output"] != self.output:
+            raise CheckpointMismatch(
+                "%s was written for paths %s and output %s" % (
+                    self.path, " ".join(state["paths"]), state["output"]))
+        self.completed = state["completed"]
+        self._completed = set(self.completed)
+        self.current = state["current"]
+        self.offset = state["offset"]
+        self.output_size = state["output_size"]
+        self.messages = state["messages"]
+        self.resumed = True
+
+    def done(self, source):
+        """ whether every message in source was written by an earlier run """
+        return source in self._completed
+
+    def resume_offset(self, source):
+        """ offset of the last message already written from source, or -1 """
+        return self.offset if source == self.current else -1
+
+    def opened(self, source):
+        self._opened.append(source)
+
+    def advance(self, source, offset, messages):
+        """ record that messages more were written, the last from source at offset """
+        while self._opened and self._opened[0] != source:
+            self._complete(self._opened.pop(0))
+        self.current = source
+        self.offset = offset
+        self.messages += messages
+
+    def finish(self):
+        """ every opened file has been written in full """
+        for source in self._opened:
+            self._complete(source)
+        self._opened = []
+        self.current = None
+        self.offset = -1
+
+    def _complete(self, source):
+        if source not in self._completed:
+            self._completed.add(source)
+            self.completed.append(source)
+
+    def save(self, output_size):
+        """ atomically replace the checkpoint file; the output must already be synced """
+        self.output_size = output_size
+        state = {
+            "paths": self.paths,
+            "output": self.output,
+            "completed": self.completed,
+            "current": self.current,
+            "offset": self.offset,
+            "output_size": output_size,
+            "messages": self.messages,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
@@ -0,0 +1,237 @@
+"""Memory-mapped code system index for OBX-3 and OBR-4 identifiers.
+
+A code table (LOINC, SNOMED CT, a local table...) is compiled once by the
+buildcodeindex command into a file of records sorted by (system, code).
+Lookups binary search the memory-mapped file, so every worker process
+shares the same pages through the OS page cache instead of loading its own
+dict. A small LRU cache in front absorbs the handful of codes a feed
+repeats all day.
+
+File layout, all integers little endian::
+
+    magic (8 bytes) | record count (u32) | systems length (u32)
+    systems, separated by \\x1f
+    record offsets (u64 each, relative to the first record)
+    records: system \\x1f code \\x1e status byte display \\n
+
+The status byte is A for active and D for deprecated codes.
+"""
+import csv
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+
+# version 1 separated the systems with commas, which system names may contain
+MAGIC = b"LCCODES2"
+_HEADER = struct.Struct("<8sII")
+_OFFSET = struct.Struct("<Q")
+
+# statuses in the source table that mark a code as deprecated
+DEPRECATED_STATUSES = {"DEPRECATED", "INACTIVE", "RETIRED"}
+
+# coding system names seen in the wild for the same system
+SYSTEM_ALIASES = {"LOINC": "LN", "SNOMED CT": "SCT", "SNOMED-CT": "SCT", "SNOMEDCT": "SCT"}
+
+CodeEntry = namedtuple("CodeEntry", "system code display deprecated")
+
+
+def normalize_system(system):
+    system = system.strip().upper()
+    return SYSTEM_ALIASES.get(system, system)
+
+
+def _clean(text):
+    return text.replace("\x1f", " ").replace("\x1e", " ").replace("\n", " ").replace("\r", " ").strip()
+
+
+def build_index(rows, path):
+    """Write an index file from (system, code, display, status) rows.
+
+    Later rows win over earlier ones with the same system and code. The
+    file is written next to path and renamed into place, so processes that
+    have the old index open keep a consistent view. Returns the number of
+    codes written.
+    """
+    records = {}
+    for system, code, display, status in rows:
+        system, code = normalize_system(_clean(system)), _clean(code)
+        if not system or not code:
+            continue
+        flag = b"D" if status.strip().upper() in DEPRECATED_STATUSES else b"A"
+        key = ("%s\x1f%s" % (system, code)).encode("utf-8")
+        records[key] = key + b"\x1e" + flag + _clean(display).encode("utf-8") + b"\n"
+    keys = sorted(records)
+    systems = b"\x1f".join(sorted(set(k.split(b"\x1f", 1)[0] for k in keys)))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".codeindex-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(_HEADER.pack(MAGIC, len(keys), len(systems)))
+            fh.write(systems)
+            offset = 0
+            for key in keys:
+                fh.write(_OFFSET.pack(offset))
+                offset += len(records[key])
+            for key in keys:
+                fh.write(records[key])
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(keys)
+
+
+def read_csv(path, code_column="code", display_column="display", status_column="status",
+             system_column="system", system=None):
+    """ yield (system, code, display, status) rows from a code table CSV """
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        for row in csv.DictReader(fh):
+            yield (system or row.get(system_column) or "", row.get(code_column) or "",
+                   row.get(display_column) or "", row.get(status_column) or "")
+
+
+class CodeIndex(object):
+    """Read-only lookups in an index file written by build_index."""
+
+    def __init__(self, path, cache_size=4096):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, systems_length = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError("%s is not a labcheck code index of this version; rebuild it with buildcodeindex"
+                             % path)
+        start = _HEADER.size
+        systems = self._map[start:start + systems_length].decode("utf-8")
+        self.systems = frozenset(systems.split("\x1f")) if systems else frozenset()
+        self._offsets = start + systems_length
+        self._records = self._offsets + self.count * _OFFSET.size
+        # per index, so closing one drops its entries with it
+        self._lookup = lru_cache(maxsize=cache_size)(self._find)
+
+    def cache_info(self):
+        return self._lookup.cache_info()
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, i):
+        start = self._records + _OFFSET.unpack_from(self._map, self._offsets + i * _OFFSET.size)[0]
+        return start, self._map.find(b"\x1e", start)
+
+    def _search(self, key):
+        lo, hi = 0, self.count
+        data = self._map
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = self._record(mid)
+            found = data[start:end]
+            if found == key:
+                return end
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def lookup(self, system, code):
+        """ CodeEntry for code in system, or None when the index does not have it """
+        return self._lookup(normalize_system(system), code)
+
+    def _find(self, system, code):
+        end = self._search(("%s\x1f%s" % (system, code)).encode("utf-8"))
+        if end is None:
+            return None
+        line = self._map[end + 1:self._map.find(b"\n", end)]
+        return CodeEntry(system, code, line[1:].decode("utf-8"), line[:1] == b"D")
+
+    def check(self, system, code):
+        """ "unknown" or "deprecated" for a code in a system this index covers, else None """
+        system = normalize_system(system)
+        if not code or system not in self.systems:
+            return None
+        entry = self.lookup(system, code)
+        if entry is None:
+            return "unknown"
+        if entry.deprecated:
+            return "deprecated"
+        return None
+
+
+def coded_values(value):
+    """ (code, system) pairs of a CE/CWE value: the identifier and the alternate """
+    if isinstance(value, str):
+        return [(value, "")] if value else []
+    components = [str(c) for c in value]
+    components += [""] * (6 - len(components))
+    return [(components[i], components[i + 2]) for i in (0, 3) if components[i]]
+
+
+# (output section, key, segment, field) checked against the index
+CHECKED_FIELDS = (
+    ("observations", "observation_identifier", "OBX", 3),
+    ("orders", "universal_service_identifier", "OBR", 4),
+)
+
+
+def code_issues(message, index):
+    """List unknown and deprecated codes in a parse_message result.
+
+    Only codes whose coding system the index covers are checked, so local
+    codes pass through untouched when no local table has been loaded.
+    """
+    issues = []
+    for section, key, segment_id, field in CHECKED_FIELDS:
+        for position, entry in enumerate(message.get(section) or (), 1):
+            for code, system in coded_values(entry.get(key) or ""):
+                issue = index.check(system, code)
+                if issue:
+                    issues.append({"segment": segment_id, "position": position,
+                                   "field": "%s-%d" % (segment_id, field),
+                                   "system": normalize_system(system), "code": code, "issue": issue})
+    return issues
+
+
+_UNRESOLVED = object()
+_default_index = _UNRESOLVED
+
+
+def default_index():
+    """ the CodeIndex named by settings.LABCHECK_CODE_INDEX, or None; resolved once per process """
+    global _default_index
+    if _default_index is _UNRESOLVED:
+        try:
+            path = getattr(settings, "LABCHECK_CODE_INDEX", "")
+        except ImproperlyConfigured:
+            # used outside a Django project, e.g. from a plain script
+            path = ""
+        _default_index = CodeIndex(path) if path else None
+    return _default_index
+
+
+def reset_default_index(setting="LABCHECK_CODE_INDEX", **kwargs):
+    """ close the default index, so the next default_index() reads the setting again """
+    global _default_index
+    if setting != "LABCHECK_CODE_INDEX":
+        return
+    if _default_index is not _UNRESOLVED and _default_index is not None:
+        _default_index.close()
+    _default_index = _UNRESOLVED
+
+
+# a changed setting, e.g. under override_settings, takes effect on the next message
+setting_changed.connect(reset_default_index)
@@ -0,0 +1,250 @@
+"""Conformance profile validation.
+
+A profile such as profiles/elr-2.5.1.json declares, per segment, how often
+the segment may occur and the usage (R required, RE required but may be
+empty, X not supported), repetition, data type, length and value set rules
+of its fields and components. load_profile() compiles that into flat
+tables, one tuple of checks per segment id, so validating a message is a
+single pass over its segments that splits only the fields some rule reads;
+nothing walks the profile or builds a parse tree per message.
+
+validate() returns a list of findings, each a dict with the segment id, its
+position in the message, field, component (None for the whole field),
+repetition, severity, a short code and a readable message.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), "profiles")
+
+SEVERITIES = ("error", "warning", "info")
+
+USAGES = ("R", "RE", "O", "X")
+
+# patterns for the primitive data types the profiles check
+DATA_TYPES = {
+    "NM": r"[+-]?(?:\d+\.?\d*|\.\d+)",
+    "SI": r"\d+",
+    "DT": r"\d{4}(?:\d{2}(?:\d{2})?)?",
+    "TM": r"\d{2}(?:\d{2}(?:\d{2}(?:\.\d{1,4})?)?)?(?:[+-]\d{4})?",
+    "DTM": r"\d{4}(?:\d{2}(?:\d{2}(?:\d{2}(?:\d{2}(?:\d{2}(?:\.\d{1,4})?)?)?)?)?)?(?:[+-]\d{4})?",
+    "ST": None,
+    "ID": None,
+    "IS": None,
+}
+DATA_TYPES["TS"] = DATA_TYPES["DTM"]
+
+_RULE_KEYS = {"field", "component", "usage", "repeats", "type", "max_length", "value_set", "severity"}
+
+
+class ProfileError(ValueError):
+    """ the profile file is not valid """
+
+
+def _value_checks(rule, value_sets, label):
+    """ (test, severity, code, message) tuples for a rule's checks on one value """
+    severity = rule.get("severity", "error")
+    checks = []
+    data_type = rule.get("type")
+    if data_type is not None:
+        if data_type not in DATA_TYPES:
+            raise ProfileError("%s: unknown data type %s" % (label, data_type))
+        if DATA_TYPES[data_type]:
+            checks.append((re.compile(DATA_TYPES[data_type]).fullmatch, severity, "data_type",
+                           "%s is not a valid %s" % (label, data_type)))
+    if "max_length" in rule:
+        limit = int(rule["max_length"])
+        checks.append((lambda value, limit=limit: len(value) <= limit, severity, "length",
+                       "%s is longer than %d" % (label, limit)))
+    if "value_set" in rule:
+        value_set = rule["value_set"]
+        if isinstance(value_set, str):
+            if value_set not in value_sets:
+                raise ProfileError("%s: unknown value set %s" % (label, value_set))
+            name, values = value_set, value_sets[value_set]
+        else:
+            name, values = "the allowed values", value_set
+        checks.append((frozenset(values).__contains__, severity, "value_set",
+                       "%s is not in %s" % (label, name)))
+    return tuple(checks)
+
+
+def compile_segment(segment_id, fields, value_sets):
+    """Compile a segment's field rules into a tuple of field entries.
+
+    Each entry is (field, required severity, X severity, max repetitions,
+    field value checks, components) and components is a tuple of
+    (component, required severity, value checks). Severities are None when
+    the rule does not apply; max repetitions is 0 for unlimited.
+    """
+    by_field = {}
+    for rule in fields:
+        unknown = set(rule) - _RULE_KEYS
+        if unknown:
+            raise ProfileError("%s: unknown rule keys %s" % (segment_id, ", ".join(sorted(unknown))))
+        usage = rule.get("usage", "O")
+        severity = rule.get("severity", "error")
+        if usage not in USAGES or severity not in SEVERITIES:
+            raise ProfileError("%s-%s: bad usage %r or severity %r" % (
+                segment_id, rule.get("field"), usage, severity))
+        field = int(rule["field"])
+        entry = by_field.setdefault(field, {"required": None, "unsupported": None, "max": 0,
+                                            "checks": (), "components": []})
+        component = rule.get("component")
+        if component is None:
+            label = "%s-%d" % (segment_id, field)
+            if usage == "R":
+                entry["required"] = severity
+            elif usage == "X":
+                entry["unsupported"] = severity
+            if rule.get("repeats") is False:
+                entry["max"] = 1
+            entry["checks"] += _value_checks(rule, value_sets, label)
+        else:
+            label = "%s-%d.%d" % (segment_id, field, component)
+            entry["components"].append((int(component) - 1, severity if usage == "R" else None,
+                                        _value_checks(rule, value_sets, label)))
+    return tuple((field, e["required"], e["unsupported"], e["max"], e["checks"],
+                  tuple(sorted(e["components"], key=lambda c: c[0])))
+                 for field, e in sorted(by_field.items()))
+
+
+class Profile(object):
+    """A compiled conformance profile; build one with compile_profile or load_profile."""
+
+    def __init__(self, name, message_types, tables, cardinality):
+        self.name = name
+        self.message_types = message_types
+        self.tables = tables
+        self.cardinality = cardinality
+
+    def message_type(self, message):
+        """ MSH-9 type and trigger as "ORU^R01" """
+        header = message[:message.find("\r")] if "\r" in message else message
+        if not header.startswith("MSH") or len(header) < 8:
+            return ""
+        fields = header.split(header[3])
+        if len(fields) < 9:
+            return ""
+        parts = fields[8].split(header[4])
+        return "^".join(parts[:2])
+
+    def applies_to(self, message):
+        """ whether the profile covers the message type, any type when it lists none """
+        return not self.message_types or self.message_type(message) in self.message_types
+
+    def validate(self, message):
+        """ findings for a message with \\r separated segments, see the module docstring """
+        findings = []
+        segments = [s for s in message.split("\r") if s.strip()]
+        if not segments or not segments[0].startswith("MSH") or len(segments[0]) < 8:
+            return [_finding("MSH", 1, None, None, None, "error", "structure",
+                             "message does not start with an MSH segment")]
+        header = segments[0]
+        fs = header[3]
+        encoding = header[4:header.find(fs, 4)] if fs in header[4:] else header[4:]
+        cs = encoding[0] if encoding else "^"
+        rs = encoding[1] if len(encoding) > 1 else "~"
+        counts = {}
+        tables = self.tables
+        for sequence, segment in enumerate(segments, 1):
+            segment_id = segment[:3]
+            counts[segment_id] = counts.get(segment_id, 0) + 1
+            table = tables.get(segment_id)
+            if table is None:
+                continue
+            if segment_id == "MSH":
+                fields = ["MSH", fs, encoding] + segment[5 + len(encoding):].split(fs)
+            else:
+                fields = segment.split(fs)
+            size = len(fields)
+            for field, required, unsupported, max_reps, checks, components in table:
+                value = fields[field] if field < size else ""
+                if not value:
+                    if required:
+                        findings.append(_finding(segment_id, sequence, field, None, None, required,
+                                                 "required", "%s-%d is required" % (segment_id, field)))
+                    continue
+                if unsupported:
+                    findings.append(_finding(segment_id, sequence, field, None, None, unsupported,
+                                             "not_supported", "%s-%d must be empty" % (segment_id, field)))
+                if not (checks or components or max_reps):
+                    continue
+                if rs not in value or (segment_id == "MSH" and field < 3):
+                    repetitions = (value,)
+                else:
+                    repetitions = value.split(rs)
+                if max_reps and len(repetitions) > max_reps:
+                    findings.append(_finding(segment_id, sequence, field, None, None, "error",
+                                             "repetitions", "%s-%d may not repeat" % (segment_id, field)))
+                for repetition_number, repetition in enumerate(repetitions, 1):
+                    for test, severity, code, text in checks:
+                        if repetition and not test(repetition):
+                            findings.append(_finding(segment_id, sequence, field, None, repetition_number,
+                                                     severity, code, text, repetition))
+                    if not components:
+                        continue
+                    parts = repetition.split(cs)
+                    count = len(parts)
+                    for component, comp_required, comp_checks in components:
+                        part = parts[component] if component < count else ""
+                        if not part:
+                            if comp_required and repetition:
+                                findings.append(_finding(
+                                    segment_id, sequence, field, component + 1, repetition_number,
+                                    comp_required, "required",
+                                    "%s-%d.%d is required" % (segment_id, field, component + 1)))
+                            continue
+                        for test, severity, code, text in comp_checks:
+                            if not test(part):
+                                findings.append(_finding(segment_id, sequence, field, component + 1,
+                                                         repetition_number, severity, code, text, part))
+        for segment_id, (low, high) in self.cardinality:
+            count = counts.get(segment_id, 0)
+            if count < low:
+                findings.append(_finding(segment_id, None, None, None, None, "error", "cardinality",
+                                         "%s must occur at least %d times, found %d" % (segment_id, low, count)))
+            elif high and count > high:
+                findings.append(_finding(segment_id, None, None, None, None, "error", "cardinality",
+                                         "%s may occur at most %d times, found %d" % (segment_id, high, count)))
+        return findings
+
+
+def _finding(segment, sequence, field, component, repetition, severity, code, message, value=None):
+    finding = {"segment": segment, "sequence": sequence, "field": field, "component": component,
+               "repetition": repetition, "severity": severity, "code": code, "message": message}
+    if value is not None:
+        finding["value"] = value
+    return finding
+
+
+def compile_profile(spec):
+    """ compile a profile from its parsed JSON """
+    value_sets = spec.get("value_sets", {})
+    tables = {}
+    cardinality = []
+    for segment_id, segment in spec.get("segments", {}).items():
+        tables[segment_id] = compile_segment(segment_id, segment.get("fields", ()), value_sets)
+        low, high = int(segment.get("min", 0)), int(segment.get("max", 0))
+        if low or high:
+            cardinality.append((segment_id, (low, high)))
+    return Profile(spec.get("name", ""), tuple(spec.get("message_types", ())), tables, tuple(cardinality))
+
+
+@lru_cache(maxsize=None)
+def load_profile(name):
+    """ compiled profile from a JSON file path, or a name in PROFILE_DIR such as "elr-2.5.1" """
+    path = name if os.path.sep in name or name.endswith(".json") else os.path.join(PROFILE_DIR, name + ".json")
+    try:
+        with open(path) as fh:
+            spec = json.load(fh)
+    except (OSError, ValueError) as e:
+        raise ProfileError("cannot load profile %s: %s" % (name, e))
+    return compile_profile(spec)
+
+
+def available_profiles():
+    return sorted(f[:-5] for f in os.listdir(PROFILE_DIR) if f.endswith(".json"))
@@ -0,0 +1,226 @@
+"""Duplicate message suppression for batch runs.
+
+Senders resend whole batches, so every message is checked before it is
+parsed. The key is the sender (MSH-3 and MSH-4) with the MSH-10 control id,
+and optionally a digest of the normalized message. A scalable Bloom filter
+answers "never seen" for almost every new message without touching disk;
+only when the filter says "maybe" is the key looked up in an exact store,
+so a false positive never drops a message.
+
+Both live in one SQLite file that persists between runs: the filter bit
+arrays as blobs and the exact keys in an indexed table.
+"""
+import hashlib
+import math
+import sqlite3
+
+from .parsecache import message_digest
+
+
+class BloomFilter(object):
+    """ fixed size Bloom filter sized for capacity keys at error_rate """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8) if bits is None else bytearray(bits)
+        self.count = count
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+    def add(self, digest):
+        bits = self.bits
+        for p in self._positions(digest):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def estimated_error_rate(self):
+        """ false-positive probability at the current fill """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ScalableBloomFilter(object):
+    """Bloom filter that adds a larger, tighter filter whenever the last one fills.
+
+    Filter i holds initial_capacity * growth**i keys at error_rate *
+    tightening**i, so the combined false-positive rate never exceeds
+    error_rate / (1 - tightening), however many keys are added.
+    """
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=2, tightening=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def __contains__(self, digest):
+        return any(digest in f for f in self.filters)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def add(self, digest):
+        if not self.filters or self.filters[-1].full():
+            level = len(self.filters)
+            self.filters.append(BloomFilter(
+                self.initial_capacity * self.growth ** level,
+                self.error_rate * self.tightening ** level))
+        self.filters[-1].add(digest)
+
+    def error_budget(self):
+        """ upper bound on the false-positive rate, whatever the number of keys """
+        return self.error_rate / (1 - self.tightening)
+
+    def estimated_error_rate(self):
+        """ false-positive probability across all filters at their current fill """
+        miss = 1.0
+        for f in self.filters:
+            miss *= 1 - f.estimated_error_rate()
+        return 1 - miss
+
+
+def key_digest(key):
+    return hashlib.blake2b(key.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+
+
+def message_keys(message, content_hash=False):
+    """Dedup keys of a normalized message.
+
+    The control id key is MSH-3, MSH-4 and MSH-10, since control ids are
+    only unique per sender; messages without MSH-10 get none. With
+    content_hash a digest of the whole message is a key as well.
+    """
+    keys = []
+    first = message.split("\r", 1)[0]
+    if first.startswith("MSH") and len(first) > 3:
+        fields = first.split(first[3])
+        if len(fields) > 9 and fields[9].strip():
+            keys.append("id:%s|%s|%s" % (fields[2], fields[3], fields[9].strip()))
+    if content_hash:
+        keys.append("hash:" + message_digest(message).hex())
+    return keys
+
+
+class Deduplicator(object):
+    """Check-and-record messages against the state in a SQLite file.
+
+    seen() returns True for a message any of whose keys was recorded
+    before, in this run or an earlier one, and records the keys of new
+    messages. Call close() to persist the filter; keys are committed in
+    batches of flush_every, or only by explicit flush() calls when
+    flush_every is None.
+    """
+
+    def __init__(self, path, content_hash=False, initial_capacity=100000, error_rate=0.001,
+                 flush_every=10000):
+        self.path = path
+        self.content_hash = content_hash
+        self.flush_every = flush_every
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value REAL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS filters (
+                level INTEGER PRIMARY KEY, capacity INTEGER, error_rate REAL,
+                count INTEGER, bits BLOB);
+            CREATE TABLE IF NOT EXISTS keys (digest BLOB PRIMARY KEY) WITHOUT ROWID;
+        """)
+        stored = dict(self.db.execute("SELECT name, value FROM settings"))
+        self.filter = ScalableBloomFilter(
+            int(stored.get("initial_capacity", initial_capacity)),
+            stored.get("error_rate", error_rate))
+        for capacity, rate, count, bits in self.db.execute(
+                "SELECT capacity, error_rate, count, bits FROM filters ORDER BY level"):
+            self.filter.filters.append(BloomFilter(capacity, rate, bits, count))
+        # fill of each filter as last written, full filters are not rewritten
+        self.saved = [f.count for f in self.filter.filters]
+        # keys not yet committed, in the order they were added
+        self.pending = {}
+        self.added = 0
+        self.committed = 0
+        self.checked = 0
+        self.duplicates = 0
+        self.filter_hits = 0
+        self.false_positives = 0
+
+    def _known(self, digest):
+        """ exact confirmation of a filter hit """
+        if digest in self.pending:
+            return True
+        return self.db.execute("SELECT 1 FROM keys WHERE digest = ?", (digest,)).fetchone() is not None
+
+    def seen(self, message):
+        self.checked += 1
+        digests = [key_digest(key) for key in message_keys(message, self.content_hash)]
+        for digest in digests:
+            if digest in self.filter:
+                self.filter_hits += 1
+                if self._known(digest):
+                    self.duplicates += 1
+                    return True
+                self.false_positives += 1
+        for digest in digests:
+            self.filter.add(digest)
+            self.pending[digest] = None
+            self.added += 1
+        if self.flush_every and len(self.pending) >= self.flush_every:
+            self.flush()
+        return False
+
+    def flush(self, upto=None):
+        """Commit pending keys and the filter state.
+
+        upto is a value of ``added``: only keys added before that point are
+        committed, so a caller that emits messages after reading ahead can
+        commit exactly what it has emitted.
+        """
+        count = len(self.pending) if upto is None else max(0, upto - self.committed)
+        keys = list(self.pending)[:count]
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO keys (digest) VALUES (?)",
+                                ((digest,) for digest in keys))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                [("initial_capacity", self.filter.initial_capacity),
+                 ("error_rate", self.filter.error_rate)])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO filters (level, capacity, error_rate, count, bits) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(level, f.capacity, f.error_rate, f.count, bytes(f.bits))
+                 for level, f in enumerate(self.filter.filters)
+                 if level >= len(self.saved) or self.saved[level] != f.count])
+        self.saved = [f.count for f in self.filter.filters]
+        for digest in keys:
+            del self.pending[digest]
+        self.committed += len(keys)
+
+    def close(self, upto=None):
+        """ flush, see flush() for upto, and close the state file """
+        self.flush(upto)
+        self.db.close()
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "duplicate_rate": self.duplicates / self.checked if self.checked else 0.0,
+            "keys": len(self.filter),
+            "filters": len(self.filter.filters),
+            "filter_hits": self.filter_hits,
+            "false_positives": self.false_positives,
+            "estimated_false_positive_rate": self.filter.estimated_error_rate(),
+            "false_positive_budget": self.filter.error_budget(),
+        }
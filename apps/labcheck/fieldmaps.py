@@ -0,0 +1,195 @@
+"""Declarative field maps for the optional and repeating labcheck sections.
+
+Each row is (segment, field, component, output key). ``field`` uses HL7
+numbering, so OBX-3 is field 3. ``component`` is 1-based as well; ``None``
+copies the first repetition of the field unchanged, which is what
+parse_message has always emitted. Commented out rows can be switched on
+without touching the extraction code: every access is bounds safe and a
+field the sender left off comes back as "".
+
+The tables are compiled once at import into extractor callables.
+"""
+
+EVN_FIELDS = (
+    ("EVN", 1, None, "event_type_code"),
+    ("EVN", 2, None, "recorded_date_time"),
+    ("EVN", 3, None, "date_time_planned_event"),
+    ("EVN", 4, None, "event_reason_code"),
+    ("EVN", 5, None, "operator_id"),
+    # ("EVN", 6, None, "event_occurred"),
+)
+
+PD1_FIELDS = (
+    ("PD1", 1, None, "living_dependency"),
+    ("PD1", 2, None, "living_arrangement"),
+    ("PD1", 3, None, "primary_facility"),
+    ("PD1", 4, None, "primary_care_provider"),
+    ("PD1", 5, None, "student_indicator"),
+    ("PD1", 6, None, "handicap"),
+    ("PD1", 7, None, "living_will_code"),
+    ("PD1", 8, None, "organ_donor_code"),
+    ("PD1", 9, None, "separate_bill"),
+    ("PD1", 10, None, "duplicate_patient"),
+    ("PD1", 11, None, "publicity_code"),
+    ("PD1", 12, None, "protection_indicator"),
+    ("PD1", 13, None, "protection_indicator_effective_date"),
+    ("PD1", 14, None, "place_of_worship"),
+    ("PD1", 15, None, "advance_directive_code"),
+    ("PD1", 16, None, "immunization_registry_status"),
+    ("PD1", 17, None, "immunization_registry_status_effective_date"),
+    ("PD1", 18, None, "publicity_code_effective_date"),
+    ("PD1", 19, None, "military_branch"),
+    ("PD1", 20, None, "military_rank"),
+    ("PD1", 21, None, "military_status"),
+)
+
+PV1_FIELDS = (
+    ("PV1", 1, None, "set_id"),
+    ("PV1", 2, None, "patient_class"),
+    ("PV1", 3, None, "assigned_patient_location"),
+    ("PV1", 4, None, "admission_type"),
+    ("PV1", 5, None, "preadmit_number"),
+    ("PV1", 6, None, "prior_patient_location"),
+    # ("PV1", 7, None, "attending_doctor"),
+    # ("PV1", 8, None, "referring_doctor"),
+)
+
+OBX_FIELDS = (
+    ("OBX", 1, None, "set_id"),
+    ("OBX", 2, None, "value_type"),
+    ("OBX", 3, None, "observation_identifier"),
+    ("OBX", 4, None, "observation_sub_id"),
+    ("OBX", 5, None, "observation_value"),
+    ("OBX", 6, None, "units"),
+    ("OBX", 7, None, "references_range"),
+    ("OBX", 8, None, "abnormal_flags"),
+    ("OBX", 9, None, "probability"),
+    ("OBX", 10, None, "nature_of_abnormal_test"),
+    ("OBX", 11, None, "observ_result_status"),
+    ("OBX", 12, None, "date_last_obs_normal_values"),
+    ("OBX", 13, None, "user_defined_access_checks"),
+    ("OBX", 14, None, "date_time_of_the_observation"),
+    ("OBX", 15, None, "producer_id"),
+    ("OBX", 16, None, "responsible_observer"),
+    ("OBX", 17, None, "observation_method"),
+)
+
+OBR_FIELDS = (
+    ("OBR", 1, None, "set_id"),
+    ("OBR", 2, None, "placer_order_number"),
+    ("OBR", 3, None, "filler_order_number"),
+    ("OBR", 4, None, "universal_service_identifier"),
+    ("OBR", 5, None, "priority"),
+    ("OBR", 6, None, "requested_date_time"),
+    ("OBR", 7, None, "observation_date_time"),
+    ("OBR", 8, None, "observation_end_date_time"),
+    ("OBR", 9, None, "collection_volume"),
+    ("OBR", 10, None, "collector_identifier"),
+    ("OBR", 11, None, "specimen_action_code"),
+    ("OBR", 12, None, "danger_code"),
+    ("OBR", 13, None, "relevant_clinical_info"),
+    ("OBR", 14, None, "specimen_received_date_time"),
+    ("OBR", 15, None, "specimen_source"),
+    ("OBR", 16, None, "ordering_provider"),
+    ("OBR", 17, None, "order_callback_phone_number"),
+    ("OBR", 18, None, "placer_field_1"),
+    ("OBR", 19, None, "placer_field_2"),
+    ("OBR", 20, None, "filler_field_1"),
+    ("OBR", 21, None, "filler_field_2"),
+    ("OBR", 22, None, "results_rpt_status_chng_date_time"),
+    ("OBR", 23, None, "charge_to_practice"),
+    ("OBR", 24, None, "diagnostic_serv_sect_id"),
+    ("OBR", 25, None, "result_status"),
+    ("OBR", 26, None, "parent_result"),
+    ("OBR", 27, None, "quantity_timing"),
+    ("OBR", 28, None, "result_copies_to"),
+    ("OBR", 29, None, "parent"),
+    ("OBR", 30, None, "transportation_mode"),
+    ("OBR", 31, None, "reason_for_study"),
+    # ("OBR", 32, None, "principal_result_interpreter"),
+    # ("OBR", 33, None, "assistant_result_interpreter"),
+    # ("OBR", 34, None, "technician"),
+    # ("OBR", 35, None, "transcriptionist"),
+    # ("OBR", 36, None, "scheduled_date_time"),
+    # ("OBR", 37, None, "number_of_sample_containers"),
+    # ("OBR", 38, None, "transport_logistics_of_collected_sample"),
+    # ("OBR", 39, None, "collectors_comment"),
+    # ("OBR", 40, None, "transport_arrangement_responsibility"),
+    # ("OBR", 41, None, "transport_arranged"),
+    # ("OBR", 42, None, "escort_required"),
+    # ("OBR", 43, None, "planned_patient_transport_comment"),
+    # ("OBR", 44, None, "procedure_code"),
+    # ("OBR", 45, None, "procedure_code_modifier"),
+    # ("OBR", 46, None, "placer_supplemental_service_info"),
+    # ("OBR", 47, None, "filler_supplemental_service_info"),
+    # ("OBR", 48, None, "medically_necessary_duplicate_procedure_reason"),
+    # ("OBR", 49, None, "result_handling"),
+    # ("OBR", 50, None, "parent_universal_service_identifier"),
+)
+
+# (output key, segment id, repeats, field map) in parse_message output order
+SECTIONS = (
+    ("event_type", "EVN", False, EVN_FIELDS),
+    ("patient_additional_demographic", "PD1", False, PD1_FIELDS),
+    ("patient_visit", "PV1", False, PV1_FIELDS),
+    ("observations", "OBX", True, OBX_FIELDS),
+    ("orders", "OBR", True, OBR_FIELDS),
+)
+
+
+def compile_fields(field_map, keys=None):
+    """Compile a field map into a callable that turns a segment into a dict.
+
+    When ``keys`` is given only those output keys are extracted, so fields
+    nobody asked for are never touched.
+    """
+    segment_ids = set(row[0] for row in field_map)
+    if len(segment_ids) > 1:
+        raise ValueError("Field map mixes segments %s" % ", ".join(sorted(segment_ids)))
+    rows = tuple((key, field, -1 if component is None else component - 1)
+                 for segment_id, field, component, key in field_map
+                 if keys is None or key in keys)
+
+    def extract(segment):
+        size = len(segment)
+        return {key: ("" if field >= size
+                      else segment[field][0] if component < 0
+                      else _component(segment[field][0], component))
+                for key, field, component in rows}
+    return extract
+
+
+def compile_record(field_map, record, convert):
+    """Like compile_fields, but the callable returns a record instead of a dict.
+
+    record is a tuple type with a field per row, in map order (see
+    records.py), and convert is applied to each value first.
+    """
+    rows = tuple((field, -1 if component is None else component - 1)
+                 for segment_id, field, component, key in field_map)
+
+    def extract(segment):
+        size = len(segment)
+        return record._make([convert("" if field >= size
+                                     else segment[field][0] if component < 0
+                                     else _component(segment[field][0], component))
+                             for field, component in rows])
+    return extract
+
+
+def _component(repetition, component):
+    if isinstance(repetition, str):
+        # no component separators, the whole value is component 1
+        return repetition if component == 0 else ""
+    if component >= len(repetition):
+        return ""
+    return str(repetition[component])
+
+
+def compile_sections(sections=SECTIONS):
+    """ compile SECTIONS style tables into (output key, segment id, repeats, extractor) """
+    return tuple((name, segment_id, repeats, compile_fields(field_map))
+                 for name, segment_id, repeats, field_map in sections)
+
+
+SECTION_EXTRACTORS = compile_sections()
@@ -0,0 +1,318 @@
+"""Field fill rates, value lengths and distinct counts of an HL7v2 corpus.
+
+CorpusProfile reads raw segments once, without parsing messages, and
+keeps per segment and field: how often the field is filled, a log2
+histogram of value lengths and a HyperLogLog sketch of the values. Memory
+depends on the number of distinct fields, never on the number of
+messages or values, so a year of a sender's traffic profiles like an
+hour of it. Profiles of parts of a corpus merge() into the profile of the
+whole, so files can be profiled in parallel and saved reports combined
+later when they include their sketches.
+"""
+import base64
+import hashlib
+import os
+from itertools import zip_longest
+
+import numpy as np
+
+from .hl7reader import ENVELOPE_SEGMENTS, iter_lines
+
+# 2**12 registers: 4 KB per field, distinct counts within about 1.6%
+DEFAULT_PRECISION = 12
+
+# segments buffered per segment id before their fields are counted column by column
+PENDING_ROWS = 1024
+
+
+def value_hash(value):
+    """ 64 bit hash of a value, the same in every process """
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "little")
+
+
+def bit_lengths(values):
+    """ int.bit_length of each value of a uint64 array """
+    # frexp gives the bit length of a float; each 32 bit half converts exactly
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+
+
+class HyperLogLog(object):
+    """ HyperLogLog distinct count sketch over 64 bit hashes """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = np.zeros(self.size, dtype=np.uint8)
+        else:
+            self.registers = np.frombuffer(registers, dtype=np.uint8).copy()
+
+    def add_hashes(self, hashes):
+        """ add an array of uint64 hashes """
+        index = (hashes & np.uint64(self.size - 1)).astype(np.intp)
+        rest = hashes >> np.uint64(self.precision)
+        rank = 64 - self.precision - bit_lengths(rest) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLog sketches of precision %d and %d"
+                             % (self.precision, other.precision))
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int32))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * np.log(size / zeros)
+        return int(round(estimate))
+
+    def to_text(self):
+        return base64.b64encode(self.registers.tobytes()).decode("ascii")
+
+    @classmethod
+    def from_text(cls, precision, text):
+        return cls(precision, base64.b64decode(text))
+
+
+def length_bucket(length):
+    """ the log2 histogram bucket of a value length: "1", "2-3", "4-7", ... """
+    low = 1 << (length.bit_length() - 1)
+    return str(low) if low == 1 else "%d-%d" % (low, 2 * low - 1)
+
+
+class FieldStats(object):
+    """ fill count, length histogram and distinct values of one field """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.filled = 0
+        self.total_length = 0
+        self.min_length = None
+        self.max_length = 0
+        # bit_length of the length to count
+        self.lengths = {}
+        self.distinct = HyperLogLog(precision)
+
+    def update(self, values):
+        """ count a list of non-empty values """
+        if not values:
+            return
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+        self.filled += len(values)
+        self.total_length += int(lengths.sum())
+        shortest, longest = int(lengths.min()), int(lengths.max())
+        if self.min_length is None or shortest < self.min_length:
+            self.min_length = shortest
+        self.max_length = max(self.max_length, longest)
+        for bits, count in enumerate(np.bincount(np.frexp(lengths.astype(np.float64))[1]).tolist()):
+            if count:
+                self.lengths[bits] = self.lengths.get(bits, 0) + count
+        # a field repeats few values within a batch, each is hashed once
+        unique = set(values)
+        self.distinct.add_hashes(np.fromiter(map(value_hash, unique), dtype=np.uint64, count=len(unique)))
+
+    def merge(self, other):
+        self.filled += other.filled
+        self.total_length += other.total_length
+        if other.min_length is not None and (self.min_length is None or other.min_length < self.min_length):
+            self.min_length = other.min_length
+        self.max_length = max(self.max_length, other.max_length)
+        for bits, count in other.lengths.items():
+            self.lengths[bits] = self.lengths.get(bits, 0) + count
+        self.distinct.merge(other.distinct)
+
+    def report(self, occurrences, sketches=False):
+        report = {
+            "filled": self.filled,
+            "fill_rate": round(self.filled / occurrences, 4) if occurrences else 0.0,
+            # the estimate can overshoot a little; there are never more distinct values than values
+            "distinct": min(self.distinct.estimate(), self.filled),
+            "length": {
+                "min": self.min_length or 0,
+                "max": self.max_length,
+                "mean": round(self.total_length / self.filled, 2) if self.filled else 0.0,
+                "histogram": {length_bucket(1 << (bits - 1)): self.lengths[bits]
+                              for bits in sorted(self.lengths)},
+            },
+        }
+        if sketches:
+            report["sketch"] = self.distinct.to_text()
+        return report
+
+    @classmethod
+    def from_report(cls, report, precision):
+        stats = cls(precision)
+        stats.filled = report["filled"]
+        stats.total_length = int(round(report["length"]["mean"] * report["filled"]))
+        stats.min_length = report["length"]["min"] if report["filled"] else None
+        stats.max_length = report["length"]["max"]
+        stats.lengths = {int(bucket.split("-")[0]).bit_length(): count
+                         for bucket, count in report["length"]["histogram"].items()}
+        stats.distinct = HyperLogLog.from_text(precision, report["sketch"])
+        return stats
+
+
+class SegmentStats(object):
+    """One segment id: its occurrences, the messages it is in and its fields by position.
+
+    add() buffers the split segments; flush() counts them a column at a
+    time, so the per-value work happens in builtins and numpy.
+    """
+
+    def __init__(self, segment_id, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.count = 0
+        self.messages = 0
+        # FieldStats per field position, 1 based; index 0 is unused
+        self.fields = [None]
+        # MSH-1 is the separator itself, so MSH-n is values[n - 1]
+        self.shift = 1 if segment_id == b"MSH" else 0
+        self.pending = []
+
+    def add(self, values):
+        self.count += 1
+        self.pending.append(values)
+        if len(self.pending) >= PENDING_ROWS:
+            self.flush()
+
+    def flush(self):
+        rows = self.pending
+        if not rows:
+            return
+        self.pending = []
+        fields = self.fields
+        shift = self.shift
+        for position, column in enumerate(zip_longest(*rows, fillvalue=b""), shift):
+            if not position:
+                continue
+            if position >= len(fields):
+                fields.extend(FieldStats(self.precision) for i in range(len(fields), position + 1))
+            fields[position].update(list(filter(None, column)))
+
+
+class CorpusProfile(object):
+    """Profile of the segments and fields of a corpus.
+
+    Feed it with add_file() or add_stream(), combine partial profiles with
+    merge(), and get the JSON report from report().
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.files = 0
+        self.bytes = 0
+        self.messages = 0
+        self.segments = {}
+
+    def add_file(self, path):
+        with open(path, "rb") as fh:
+            self.add_stream(fh)
+            self.bytes += os.fstat(fh.fileno()).st_size
+        self.files += 1
+        return self
+
+    def add_stream(self, fh):
+        """ profile a binary stream of messages """
+        separator = b"|"
+        seen = set()
+        segments = self.segments
+        for offset, line in iter_lines(fh):
+            segment_id = line[:3]
+            if not segment_id.strip() or segment_id in ENVELOPE_SEGMENTS:
+                continue
+            if segment_id == b"MSH":
+                self.messages += 1
+                seen = set()
+                separator = line[3:4] or b"|"
+            segment = segments.get(segment_id)
+            if segment is None:
+                segment = segments[segment_id] = SegmentStats(segment_id, self.precision)
+            if segment_id not in seen:
+                seen.add(segment_id)
+                segment.messages += 1
+            values = line.split(separator)
+            if segment_id == b"MSH":
+                values[0] = separator
+            segment.add(values)
+        return self
+
+    def flush(self):
+        for segment in self.segments.values():
+            segment.flush()
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge profiles of precision %d and %d" % (self.precision, other.precision))
+        self.flush()
+        other.flush()
+        self.files += other.files
+        self.bytes += other.bytes
+        self.messages += other.messages
+        for segment_id, theirs in other.segments.items():
+            ours = self.segments.get(segment_id)
+            if ours is None:
+                ours = self.segments[segment_id] = SegmentStats(segment_id, self.precision)
+            ours.count += theirs.count
+            ours.messages += theirs.messages
+            for position in range(len(ours.fields), len(theirs.fields)):
+                ours.fields.append(FieldStats(self.precision))
+            for field, their_field in zip(ours.fields[1:], theirs.fields[1:]):
+                field.merge(their_field)
+        return self
+
+    def report(self, sketches=False):
+        """The profile as a JSON-serializable dict, segments in alphabetical order.
+
+        Fill rates are per occurrence of the segment. With sketches the
+        HyperLogLog registers are included, so from_report() can turn the
+        report back into a profile that merges with others.
+        """
+        self.flush()
+        segments = {}
+        for segment_id in sorted(self.segments):
+            segment = self.segments[segment_id]
+            name = segment_id.decode("ascii", errors="replace")
+            segments[name] = {
+                "count": segment.count,
+                "messages": segment.messages,
+                "presence": round(segment.messages / self.messages, 4) if self.messages else 0.0,
+                "fields": {"%s-%d" % (name, position): field.report(segment.count, sketches)
+                           for position, field in enumerate(segment.fields) if position},
+            }
+        report = {"files": self.files, "bytes": self.bytes, "messages": self.messages,
+                  "segments": segments}
+        if sketches:
+            report["precision"] = self.precision
+        return report
+
+    @classmethod
+    def from_report(cls, report):
+        """ a profile from a report() made with sketches """
+        if "precision" not in report:
+            raise ValueError("the report has no sketches to merge")
+        profile = cls(report["precision"])
+        profile.files = report["files"]
+        profile.bytes = report["bytes"]
+        profile.messages = report["messages"]
+        for name, section in report["segments"].items():
+            segment_id = name.encode("ascii")
+            segment = profile.segments[segment_id] = SegmentStats(segment_id, profile.precision)
+            segment.count = section["count"]
+            segment.messages = section["messages"]
+            segment.fields.extend(FieldStats.from_report(field, profile.precision)
+                                  for field in section["fields"].values())
+        return profile
+
+
+def profile_file(path, precision=DEFAULT_PRECISION):
+    """ CorpusProfile of one file, for process pool workers """
+    profile = CorpusProfile(precision).add_file(path)
+    profile.flush()
+    return profile
@@ -0,0 +1,112 @@
+"""Streaming reader for files that hold one or many HL7v2 messages.
+
+Nightly ELR drops can contain tens of thousands of messages, so nothing in
+here holds more than the message currently being assembled in memory.
+"""
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# segments that wrap messages in a batch file and are not part of a message
+ENVELOPE_SEGMENTS = (b"FHS", b"BHS", b"BTS", b"FTS")
+
+# MLLP start block (0x0B) and end block (0x1C) become line breaks, so a
+# framed message reads like one surrounded by blank lines. The 0x0D that
+# follows 0x1C is an ordinary line end.
+_MLLP_TO_NEWLINE = bytes.maketrans(b"\x0b\x1c", b"\n\n")
+
+
+class SegmentNormalizer(object):
+    """Incrementally split a byte stream into segments in one linear pass.
+
+    Call feed() with chunks as they arrive from a file, upload or socket and
+    close() at the end of the stream; both return a list of (byte offset,
+    segment) for the segments completed so far. Segments may end in \\r,
+    \\n or \\r\\n, and MLLP framing bytes end a segment as well. Blank
+    segments are returned too, since they separate messages. Chunks may be
+    bytes, bytearray or memoryview.
+    """
+
+    def __init__(self):
+        # pieces of the unterminated last line, joined once it ends
+        self._pending = []
+        self._offset = 0
+
+    def feed(self, chunk):
+        chunk = bytes(chunk).translate(_MLLP_TO_NEWLINE)
+        pending = self._pending
+        if b"\n" not in chunk and b"\r" not in chunk and not (pending and pending[-1][-1:] == b"\r"):
+            # a long segment arriving in small chunks is only collected
+            if chunk:
+                pending.append(chunk)
+            return []
+        pending.append(chunk)
+        lines = b"".join(pending).splitlines(keepends=True)
+        if lines and lines[-1][-1:] != b"\n":
+            # the last line is unterminated, or ends in a \r whose \n may
+            # be in the next chunk
+            self._pending = [lines.pop()]
+        else:
+            self._pending = []
+        return self._segments(lines)
+
+    def close(self):
+        lines = [b"".join(self._pending)] if self._pending else []
+        self._pending = []
+        return self._segments(lines)
+
+    def _segments(self, lines):
+        segments = []
+        offset = self._offset
+        for line in lines:
+            segments.append((offset, line.rstrip(b"\r\n")))
+            offset += len(line)
+        self._offset = offset
+        return segments
+
+
+def normalize_segments(data):
+    """ bytes or memoryview in, message out with every non-blank segment ended by \\r """
+    lines = bytes(data).translate(_MLLP_TO_NEWLINE).splitlines()
+    return b"".join([line + b"\r" for line in lines if line.strip()])
+
+
+def iter_lines(fh, chunk_size=CHUNK_SIZE):
+    """ yield (byte offset, line) for each line of a binary stream, see SegmentNormalizer """
+    normalizer = SegmentNormalizer()
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        yield from normalizer.feed(chunk)
+    yield from normalizer.close()
+
+
+def read_messages(fh, encoding="utf-8", chunk_size=CHUNK_SIZE):
+    """ yield (byte offset, message) for each message in a binary stream.
+
+    Messages are split on blank lines, FHS/BHS/BTS/FTS batch envelopes and
+    MSH segments. Each message is returned with its segments terminated by
+    \\r, the same shape cleanup_hl7 produces. Segments found before any MSH
+    are yielded as their own message so the parser can report them instead
+    of them being silently dropped.
+    """
+    start = None
+    segments = []
+    for offset, line in iter_lines(fh, chunk_size):
+        segment_id = line[:3]
+        if segment_id == b"MSH" or segment_id in ENVELOPE_SEGMENTS or not line.strip():
+            if segments:
+                yield start, _join(segments, encoding)
+                segments = []
+            if segment_id != b"MSH":
+                continue
+        if not segments:
+            start = offset
+        segments.append(line)
+    if segments:
+        yield start, _join(segments, encoding)
+
+
+def _join(segments, encoding):
+    return (b"\r".join(segments) + b"\r").decode(encoding, errors="replace")
@@ -0,0 +1,186 @@
+"""Lazy HL7v2 tokenizer used as a fast path in front of ``hl7.parse``.
+
+``hl7.parse`` builds the whole Message/Segment/Field/Repetition/Component
+tree up front, while parse_message only reads a fraction of it. Here a
+message is scanned once for segment boundaries, each segment keeps only its
+offsets into the original string, and a segment is split into fields the
+first time one of its fields is read. Fields are turned into the same
+``hl7`` containers ``hl7.parse`` would have produced, so everything
+downstream sees identical values.
+
+Anything the tokenizer is not sure about raises ``Unsupported`` so the
+caller can fall back to ``hl7.parse``.
+"""
+import hl7
+
+
+class Unsupported(Exception):
+    """ the message needs the full hl7.parse treatment """
+
+
+class SegmentIndex(dict):
+    """Segments of a parsed message keyed by segment id.
+
+    Built in a single pass over the message so each lookup is a dict hit
+    instead of another linear scan like ``hl7.Message.segment()``. Missing
+    segments raise ``KeyError`` just like the hl7 library does.
+    """
+
+    def __init__(self, h=()):
+        super().__init__()
+        for segment in h:
+            try:
+                segment_id = segment[0][0]
+            except IndexError:
+                # blank segment, nothing to index
+                continue
+            self.add(segment_id, segment)
+
+    def add(self, segment_id, segment):
+        if segment_id in self:
+            self[segment_id].append(segment)
+        else:
+            self[segment_id] = [segment]
+
+    def segment(self, segment_id):
+        """ first segment with segment_id """
+        return self[segment_id][0]
+
+    def segments(self, segment_id):
+        """ all segments with segment_id, in message order """
+        return self[segment_id]
+
+
+class Delimiters(object):
+    """ delimiters declared in MSH-1 and MSH-2, laid out the way hl7.parse does """
+
+    __slots__ = ("field", "repetition", "component", "subcomponent", "esc",
+                 "separators", "_field_level", "_repetition_level")
+
+    def __init__(self, field, encoding):
+        self.field = field
+        self.component = encoding[0] if len(encoding) > 0 else "^"
+        self.repetition = encoding[1] if len(encoding) > 1 else "~"
+        self.esc = encoding[2] if len(encoding) > 2 else "\\"
+        self.subcomponent = encoding[3] if len(encoding) > 3 else "&"
+        self.separators = "\r" + field + self.repetition + self.component + self.subcomponent
+        if len(set(self.separators)) != 5:
+            raise Unsupported("Delimiters are not distinct")
+        self._field_level = self.separators[2:]
+        self._repetition_level = self.separators[3:]
+
+    def make_field(self, text):
+        """ build the hl7.Field hl7.parse would build for text """
+        for separator in self._field_level:
+            if separator in text:
+                break
+        else:
+            return hl7.Field(sequence=[text], esc=self.esc, separators=self.separators)
+        return hl7.Field(
+            sequence=[self._make_repetition(r) for r in text.split(self.repetition)],
+            esc=self.esc, separators=self.separators)
+
+    def raw_field(self, text):
+        """ MSH-1 and MSH-2 are kept whole """
+        return hl7.Field(sequence=[text], esc=self.esc, separators=self.separators)
+
+    def _make_repetition(self, text):
+        for separator in self._repetition_level:
+            if separator in text:
+                break
+        else:
+            return hl7.Repetition(sequence=[text], esc=self.esc, separators=self.separators)
+        subcomponent = self.subcomponent
+        return hl7.Repetition(
+            sequence=[hl7.Component(
+                sequence=c.split(subcomponent) if subcomponent in c else [c],
+                esc=self.esc, separators=self.separators)
+                for c in text.split(self.component)],
+            esc=self.esc, separators=self.separators)
+
+
+class LazySegment(object):
+    """A segment that is only split into fields when a field is read.
+
+    Supports the parts of the ``hl7.Segment`` interface parse_message uses:
+    ``len()`` and integer indexing, with field 0 being the segment id.
+    """
+
+    __slots__ = ("_message", "_start", "_end", "_delimiters", "_values", "_fields")
+
+    def __init__(self, message, start, end, delimiters):
+        self._message = message
+        self._start = start
+        self._end = end
+        self._delimiters = delimiters
+        self._values = None
+        self._fields = None
+
+    def _split(self):
+        text = self._message[self._start:self._end]
+        field = self._delimiters.field
+        if text.startswith("MSH"):
+            # MSH-1 is the field separator itself and MSH-2 the encoding characters
+            encoding_end = text.find(field, 4)
+            rest = text[encoding_end + 1:]
+            values = ["MSH", field, text[4:encoding_end]]
+            if rest:
+                values.extend(rest.split(field))
+        else:
+            values = text.split(field)
+        self._values = values
+        self._fields = [None] * len(values)
+
+    def __len__(self):
+        if self._values is None:
+            self._split()
+        return len(self._values)
+
+    def __getitem__(self, index):
+        if self._values is None:
+            self._split()
+        field = self._fields[index]
+        if field is None:
+            text = self._values[index]
+            if 0 < index < 3 and self._values[0] == "MSH":
+                field = self._delimiters.raw_field(text)
+            else:
+                field = self._delimiters.make_field(text)
+            self._fields[index] = field
+        return field
+
+    def __str__(self):
+        return self._message[self._start:self._end]
+
+
+def index_message(message):
+    """Tokenize a message into a SegmentIndex of LazySegments.
+
+    Raises ``Unsupported`` for anything that hl7.parse would build
+    differently, so callers can fall back to it.
+    """
+    text = message.strip()
+    if not text.startswith("MSH") or len(text) < 8:
+        raise Unsupported("Message does not start with MSH")
+    field = text[3]
+    encoding_end = text.find(field, 4)
+    if encoding_end < 0:
+        raise Unsupported("MSH-2 is not terminated")
+    delimiters = Delimiters(field, text[4:encoding_end])
+    id_separators = delimiters.separators[1:]
+
+    index = SegmentIndex()
+    start = 0
+    length = len(text)
+    while start <= length:
+        end = text.find("\r", start)
+        if end < 0:
+            end = length
+        if end > start:
+            segment_id = text[start:start + 3]
+            if (text[start + 3:start + 4] != field or any(c in segment_id for c in id_separators)
+                    or (start and segment_id in ("BHS", "FHS"))):
+                raise Unsupported("Cannot tokenize segment at offset %d" % start)
+            index.add(segment_id, LazySegment(text, start, end, delimiters))
+        start = end + 1
+    return index
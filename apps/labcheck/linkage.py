@@ -0,0 +1,297 @@
+"""Patient record linkage over parse_message patient_identity sections.
+
+Comparing every pair of identities is quadratic, so only identities that
+share a blocking key are compared: Soundex surname plus birth year, postal
+code plus date of birth, and assigning authority plus PID-3 identifier.
+The block index is two flat arrays (key hash, record number), about 12
+bytes per entry, sorted once when linking; blocks are the runs of equal
+keys.
+
+Each identity is reduced to a few fixed width numbers (name bigram
+signatures, date of birth, sex, postal code and identifier hashes), so
+the candidate pairs of all blocks of the same size are generated together
+and every pair is scored in bulk with numpy. Scores add a Fellegi-Sunter
+style weight per field (WEIGHTS); pairs at or above the threshold are
+joined into clusters by connected components.
+"""
+import hashlib
+import re
+import zlib
+from array import array
+
+import numpy as np
+
+from .records import component, field_text
+
+# (agree, partial, disagree) weights; a missing value on either side scores 0
+WEIGHTS = {
+    "family_name": (4.0, 2.0, -3.0),
+    "given_name": (3.0, 1.5, -2.0),
+    "birthdate": (5.0, 1.0, -4.0),
+    "gender": (0.5, 0.0, -2.0),
+    "postal_code": (1.5, 0.0, -0.5),
+    "identifier": (7.0, 0.0, -3.0),
+    "ssn": (8.0, 0.0, -6.0),
+}
+
+# name signature Jaccard similarity that counts as agreement, and as partial agreement
+NAME_AGREE = 0.75
+NAME_PARTIAL = 0.45
+
+DEFAULT_THRESHOLD = 9.0
+
+# blocks larger than this (a shared default birthdate, say) are not compared
+DEFAULT_MAX_BLOCK = 500
+
+# candidate pairs scored per numpy pass
+PAIR_BATCH = 1000000
+
+_SOUNDEX = {c: d for d, letters in (("1", "BFPV"), ("2", "CGJKQSXZ"), ("3", "DT"),
+                                    ("4", "L"), ("5", "MN"), ("6", "R")) for c in letters}
+
+_NOT_LETTERS = re.compile(r"[^A-Z]")
+
+GENDERS = {"male": 1, "female": 2}
+
+# set bits of each byte value, for NumPy before 2.0 which has no bitwise_count
+_BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+
+
+def bit_counts(values):
+    """ number of set bits of each value of a uint64 array, as int32 """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.int32)
+    return byte_bit_counts(values)
+
+
+def byte_bit_counts(values):
+    """ bit_counts by a lookup of each of the eight bytes of a value """
+    octets = np.ascontiguousarray(values, dtype=np.uint64).view(np.uint8)
+    return _BYTE_BITS[octets].reshape(-1, 8).sum(axis=1)
+
+
+def soundex(name):
+    """ American Soundex code of a name, "" when it has no letters """
+    letters = _NOT_LETTERS.sub("", name.upper())
+    if not letters:
+        return ""
+    code = letters[0]
+    previous = _SOUNDEX.get(letters[0], "")
+    for c in letters[1:]:
+        digit = _SOUNDEX.get(c, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if c not in "HW":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def name_signature(name):
+    """ 128 bit signature of the letter bigrams of a name as two ints, (0, 0) for no name """
+    letters = _NOT_LETTERS.sub("", name.upper())
+    if not letters:
+        return 0, 0
+    padded = "^" + letters + "$"
+    signature = 0
+    for i in range(len(padded) - 1):
+        signature |= 1 << (zlib.crc32(padded[i:i + 2].encode()) & 127)
+    return signature >> 64, signature & 0xFFFFFFFFFFFFFFFF
+
+
+def value_hash(text):
+    """ non-zero 63 bit hash of a value, 0 for "" """
+    if not text:
+        return 0
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"),
+                                          digest_size=8).digest(), "little") >> 1 or 1
+
+
+def identity(pid):
+    """The fields linkage uses, as text, from a patient_identity section.
+
+    pid is the dict parse_message returns or a records.PatientRecord.
+    """
+    sub = pid.get("sub")
+    addresses = pid.get("address") or ()
+    address = addresses[0] if addresses else {}
+    ssn = ""
+    for document in pid.get("document") or ():
+        if document.get("issuer_meta"):
+            ssn = field_text(document.get("number"))
+    return {
+        "family_name": field_text(pid.get("family_name")),
+        "given_name": field_text(pid.get("given_name")),
+        "birthdate": component(pid.get("birthdate"), 0)[:8],
+        "gender": field_text(pid.get("gender")),
+        "postal_code": field_text(address.get("postal_code"))[:5],
+        "identifier": component(sub, 0),
+        "authority": component(sub, 3),
+        "ssn": re.sub(r"\D", "", ssn),
+    }
+
+
+def blocking_keys(fields):
+    """ the blocking keys of an identity() """
+    keys = []
+    birthdate = fields["birthdate"] if fields["birthdate"].isdigit() else ""
+    surname = soundex(fields["family_name"])
+    if surname and len(birthdate) >= 4:
+        keys.append("S%s%s" % (surname, birthdate[:4]))
+    if fields["postal_code"] and len(birthdate) == 8:
+        keys.append("P%s%s" % (fields["postal_code"], birthdate))
+    if fields["identifier"]:
+        keys.append("I%s\x1f%s" % (fields["authority"], fields["identifier"]))
+    return keys
+
+
+class Linker(object):
+    """Collect identities with add(), then call clusters().
+
+    Per identity it keeps 9 numbers and its block index entries, so
+    millions of identities fit in memory on one machine.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, max_block=DEFAULT_MAX_BLOCK):
+        self.threshold = threshold
+        self.max_block = max_block
+        self.family = (array("Q"), array("Q"))
+        self.given = (array("Q"), array("Q"))
+        self.birthdate = array("l")
+        self.gender = array("b")
+        self.postal = array("l")
+        self.authority = array("q")
+        self.identifier = array("q")
+        self.ssn = array("q")
+        # block index: key hash and record number per entry
+        self.block_keys = array("q")
+        self.block_records = array("l")
+        self.stats = {}
+
+    def __len__(self):
+        return len(self.birthdate)
+
+    def add(self, pid):
+        """ add a patient_identity section, returns its record number """
+        fields = identity(pid)
+        record = len(self.birthdate)
+        for columns, name in ((self.family, fields["family_name"]), (self.given, fields["given_name"])):
+            high, low = name_signature(name)
+            columns[0].append(high)
+            columns[1].append(low)
+        birthdate = fields["birthdate"]
+        self.birthdate.append(int(birthdate) if len(birthdate) == 8 and birthdate.isdigit() else 0)
+        self.gender.append(GENDERS.get(fields["gender"], 0))
+        postal = fields["postal_code"]
+        self.postal.append(int(postal) if postal.isdigit() else 0)
+        self.authority.append(value_hash(fields["authority"]))
+        self.identifier.append(value_hash(fields["identifier"]))
+        self.ssn.append(value_hash(fields["ssn"]))
+        for key in blocking_keys(fields):
+            self.block_keys.append(value_hash(key))
+            self.block_records.append(record)
+        return record
+
+    def candidate_pairs(self):
+        """ (a, b) arrays of the distinct record pairs sharing a block, a < b """
+        keys = np.frombuffer(self.block_keys, dtype=np.int64)
+        records = np.frombuffer(self.block_records, dtype=np.dtype("l"))
+        order = np.argsort(keys, kind="stable")
+        keys, records = keys[order], records[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(keys)])
+        self.stats["blocks"] = int(np.count_nonzero(sizes > 1))
+        self.stats["skipped_blocks"] = int(np.count_nonzero(sizes > self.max_block))
+        found = []
+        for size in np.unique(sizes):
+            if size < 2 or size > self.max_block:
+                continue
+            # blocks of this size as rows of a matrix, then every pair of columns
+            members = records[starts[sizes == size][:, None] + np.arange(size)]
+            i, j = np.triu_indices(size, 1)
+            a, b = members[:, i].ravel(), members[:, j].ravel()
+            found.append(np.minimum(a, b).astype(np.int64) << 32 | np.maximum(a, b))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        # a pair sharing several keys is scored once; sorting is much faster than np.unique here
+        pairs = np.sort(np.concatenate(found))
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]] & ((pairs >> 32) != (pairs & 0xFFFFFFFF))]
+        return pairs >> 32, pairs & 0xFFFFFFFF
+
+    def score(self, a, b):
+        """ total weight of each pair of record numbers """
+        total = np.zeros(len(a))
+        for name, (high, low) in (("family_name", self.family), ("given_name", self.given)):
+            high, low = np.frombuffer(high, dtype=np.uint64), np.frombuffer(low, dtype=np.uint64)
+            ha, la, hb, lb = high[a], low[a], high[b], low[b]
+            union = bit_counts(ha | hb) + bit_counts(la | lb)
+            common = bit_counts(ha & hb) + bit_counts(la & lb)
+            similarity = common / np.maximum(union, 1)
+            present = ((ha | la) != 0) & ((hb | lb) != 0)
+            agree, partial, disagree = WEIGHTS[name]
+            total += np.where(present, np.select(
+                [similarity >= NAME_AGREE, similarity >= NAME_PARTIAL], [agree, partial], disagree), 0)
+
+        birthdate = np.frombuffer(self.birthdate, dtype=np.dtype("l"))
+        da, db = birthdate[a], birthdate[b]
+        agree, partial, disagree = WEIGHTS["birthdate"]
+        # same year and month, or day and month swapped, is a partial agreement
+        swapped = (da // 10000 == db // 10000) & (da % 100 == db // 100 % 100) & (da // 100 % 100 == db % 100)
+        total += np.where((da != 0) & (db != 0), np.select(
+            [da == db, (da // 100 == db // 100) | swapped], [agree, partial], disagree), 0)
+
+        for name, column in (("gender", self.gender), ("postal_code", self.postal), ("ssn", self.ssn)):
+            values = np.frombuffer(column, dtype=column.typecode)
+            va, vb = values[a], values[b]
+            agree, partial, disagree = WEIGHTS[name]
+            total += np.where((va != 0) & (vb != 0), np.where(va == vb, agree, disagree), 0)
+
+        # identifiers only disagree when the same authority issued both
+        authority = np.frombuffer(self.authority, dtype=np.int64)
+        identifier = np.frombuffer(self.identifier, dtype=np.int64)
+        same_authority = authority[a] == authority[b]
+        ia, ib = identifier[a], identifier[b]
+        agree, partial, disagree = WEIGHTS["identifier"]
+        total += np.where((ia != 0) & (ib != 0) & same_authority, np.where(ia == ib, agree, disagree), 0)
+        return total
+
+    def clusters(self):
+        """ cluster id per record, numbered 0.. in order of first record """
+        a, b = self.candidate_pairs()
+        matched_a, matched_b = [], []
+        for start in range(0, len(a), PAIR_BATCH):
+            pa, pb = a[start:start + PAIR_BATCH], b[start:start + PAIR_BATCH]
+            keep = self.score(pa, pb) >= self.threshold
+            matched_a.append(pa[keep])
+            matched_b.append(pb[keep])
+        matched_a = np.concatenate(matched_a) if matched_a else a
+        matched_b = np.concatenate(matched_b) if matched_b else b
+        self.stats["candidate_pairs"] = len(a)
+        self.stats["matched_pairs"] = len(matched_a)
+        labels = connected_components(len(self), matched_a, matched_b)
+        self.stats["clusters"] = int(labels.max()) + 1 if len(labels) else 0
+        return labels
+
+
+def connected_components(count, a, b):
+    """Label the components of a graph given as edge arrays, by hooking and shortcutting.
+
+    Each round points the larger root of every edge at the smaller one and
+    then halves path lengths until every record points at its root.
+    Returns labels numbered 0.. in order of each component's first record.
+    """
+    parent = np.arange(count)
+    while len(a):
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        ra, rb = ra[differ], rb[differ]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return np.unique(parent, return_inverse=True)[1]
@@ -0,0 +1,201 @@
+"""Bulk loading of parsed messages into the labcheck models.
+
+MessageLoader buffers compact parse results (records.parse_compact) and
+writes them chunk_size messages at a time: one transaction per chunk and
+one bulk INSERT per table, split only where the database limits the
+number of parameters per statement. Primary keys of the parent rows come
+back from the INSERT itself, so a chunk of a thousand messages costs
+four statements whatever its number of orders and observations, plus one
+upsert of the chunk's daily counts (see rollups.py).
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from .models import Message, Observation, Order, Patient
+from .records import component, field_text, parse_compact
+from .rollups import chunk_counts, message_day, supersede, upsert_counts
+
+
+def order_links(message):
+    """For each OBX of a message, the 0 based position of the OBR it follows, or None.
+
+    parse_message lists OBX and OBR separately, so the grouping is read off
+    the segment order of the message text.
+    """
+    links = []
+    orders = 0
+    for segment in message.split("\r"):
+        segment_id = segment[:3]
+        if segment_id == "OBR":
+            orders += 1
+        elif segment_id == "OBX":
+            links.append(orders - 1 if orders else None)
+    return links
+
+
+def _char_limits(model):
+    return tuple((field.attname, field.max_length) for field in model._meta.concrete_fields
+                 if field.get_internal_type() == "CharField" and field.max_length)
+
+
+# (attribute, max_length) of the CharFields of each model; senders send
+# whatever length they like, a row that is too long would fail the chunk
+CHAR_LIMITS = {model: _char_limits(model) for model in (Message, Patient, Order, Observation)}
+
+
+def fit(instance):
+    """ cut the CharFields of an unsaved instance to their max_length """
+    for attname, limit in CHAR_LIMITS[type(instance)]:
+        value = getattr(instance, attname)
+        if len(value) > limit:
+            setattr(instance, attname, value[:limit])
+    return instance
+
+
+class MessageLoader(object):
+    """Write parsed messages to the database in chunked bulk inserts.
+
+    Call add() for every message and close() at the end. counts holds the
+    rows written so far per model, and transactions the chunks committed.
+    With rollups the DailyCount rows and corrections are maintained too.
+    A chunk that fails to write is rolled back and dropped before the
+    database error propagates, so the next chunk starts empty.
+    """
+
+    def __init__(self, chunk_size=1000, batch_size=None, using=DEFAULT_DB_ALIAS, rollups=True):
+        if not connections[using].features.can_return_rows_from_bulk_insert:
+            raise ImproperlyConfigured(
+                "MessageLoader needs a database that returns primary keys from bulk inserts "
+                "(PostgreSQL, MariaDB or SQLite 3.35+)")
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.using = using
+        self.rollups = rollups
+        self.pending = []
+        self.counts = {"messages": 0, "patients": 0, "orders": 0, "observations": 0}
+        self.transactions = 0
+
+    def add(self, message, source="", offset=None):
+        """ parse a message and queue it; parse errors propagate """
+        links = order_links(message)
+        for record in parse_compact(message):
+            self.add_result(record, links, source, offset)
+
+    def add_result(self, record, links=None, source="", offset=None):
+        """ queue a parse_compact record, or a parse_message dict; links as order_links gives """
+        self.pending.append((record, links, source, offset))
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        messages, patients, orders, observations = [], [], [], []
+        # (observation, position of its order in orders) to link once orders have keys
+        linked = []
+        for record, links, source, offset in pending:
+            message = self.message_row(record, source, offset)
+            messages.append(message)
+            pid = record.get("patient_identity")
+            if pid:
+                patients.append(self.patient_row(pid, message))
+            first_order = len(orders)
+            order_count = 0
+            for position, obr in enumerate(record.get("orders") or (), 1):
+                orders.append(self.order_row(obr, message, position))
+                order_count += 1
+            obx_list = record.get("observations") or ()
+            if links is None or len(links) != len(obx_list):
+                links = [0 if order_count == 1 else None] * len(obx_list)
+            for position, (obx, link) in enumerate(zip(obx_list, links), 1):
+                observation = self.observation_row(obx, message, position)
+                observations.append(observation)
+                if link is not None and link < order_count:
+                    linked.append((observation, first_order + link))
+        batch_size = self.batch_size
+        with transaction.atomic(using=self.using):
+            Message.objects.using(self.using).bulk_create(messages, batch_size=batch_size)
+            Patient.objects.using(self.using).bulk_create(patients, batch_size=batch_size)
+            Order.objects.using(self.using).bulk_create(orders, batch_size=batch_size)
+            for observation, order in linked:
+                observation.order = orders[order]
+            if self.rollups:
+                deltas = supersede(observations, self.using)
+            Observation.objects.using(self.using).bulk_create(observations, batch_size=batch_size)
+            if self.rollups:
+                deltas.update(chunk_counts(messages, observations))
+                upsert_counts(deltas, self.using)
+        self.transactions += 1
+        self.counts["messages"] += len(messages)
+        self.counts["patients"] += len(patients)
+        self.counts["orders"] += len(orders)
+        self.counts["observations"] += len(observations)
+
+    def close(self):
+        self.flush()
+
+    def message_row(self, record, source, offset):
+        header = record.get("message") or {}
+        timestamp = field_text(header.get("timestamp"))
+        return fit(Message(
+            source=source,
+            offset=offset,
+            msg_type=field_text(header.get("msg_type")),
+            sub_msg_type=field_text(header.get("sub_msg_type")),
+            control_id=field_text(header.get("id")),
+            from_system=field_text(header.get("from_system")),
+            from_location=field_text(header.get("from_location")),
+            to_system=field_text(header.get("to_system")),
+            to_location=field_text(header.get("to_location")),
+            timestamp=timestamp,
+            day=message_day(timestamp) or timezone.localdate(),
+        ))
+
+    def patient_row(self, pid, message):
+        sub = pid.get("sub")
+        address = (pid.get("address") or [{}])[0]
+        return fit(Patient(
+            message=message,
+            patient_id=component(sub, 0),
+            assigning_authority=component(sub, 3),
+            family_name=field_text(pid.get("family_name")),
+            given_name=field_text(pid.get("given_name")),
+            birthdate=field_text(pid.get("birthdate")),
+            gender=field_text(pid.get("gender")),
+            postal_code=field_text(address.get("postal_code")),
+        ))
+
+    def order_row(self, obr, message, position):
+        service = obr.get("universal_service_identifier")
+        return fit(Order(
+            message=message,
+            position=position,
+            set_id=field_text(obr.get("set_id")),
+            placer_order_number=component(obr.get("placer_order_number"), 0),
+            filler_order_number=component(obr.get("filler_order_number"), 0),
+            service_code=component(service, 0),
+            service_text=component(service, 1),
+            service_system=component(service, 2),
+            observation_date_time=component(obr.get("observation_date_time"), 0),
+            result_status=field_text(obr.get("result_status")),
+        ))
+
+    def observation_row(self, obx, message, position):
+        code = obx.get("observation_identifier")
+        return fit(Observation(
+            message=message,
+            position=position,
+            set_id=field_text(obx.get("set_id")),
+            value_type=field_text(obx.get("value_type")),
+            code=component(code, 0),
+            code_text=component(code, 1),
+            code_system=component(code, 2),
+            value=field_text(obx.get("observation_value")),
+            units=component(obx.get("units"), 0),
+            reference_range=field_text(obx.get("references_range")),
+            abnormal_flags=field_text(obx.get("abnormal_flags")),
+            result_status=field_text(obx.get("observ_result_status")),
+            observation_date_time=component(obx.get("date_time_of_the_observation"), 0),
+        ))
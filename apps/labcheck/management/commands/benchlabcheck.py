@@ -0,0 +1,86 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...hl7reader import SegmentNormalizer, normalize_segments
+from .parsehl7 import cleanup_hl7, parse_message
+
+
+ORU_HEADER = (
+    "MSH|^~\\&|SendingApp|SendingFac|ReceivingApp|ReceivingFac|20120411070545||ORU^R01|59689|P|2.3\r"
+    "PID|1|12345|12345^^^MIE&1.2.840.114398.1.100&ISO^MR||MOUSE^MINNIE^S||19240101|F|||"
+    "123 MOUSEHOLE LN^^FORT WAYNE^IN^46808|||||||||||||||||||\r"
+    "PV1|1|O|||||71^DUCK^DONALD||||||||||||12376|||||||||||||||||||||||||20120410160227||||||\r"
+    "OBR|1||12376|cbc^CBC|R||20120410160227|||22^GOOF^GOOFY|||Fasting: No|201204101625||"
+    "71^DUCK^DONALD||||||201204101630|||F||^^^^^R|||||||||||||||||85025|\r"
+)
+
+OBX_TEMPLATE = (
+    "OBX|%d|NM|wbc^Wbc^Local^6690-2^Wbc^LN||7.0|/nl|3.8-11.0||||F|||"
+    "20120410160227|lab|12^XYZ LAB|\r"
+)
+
+
+def build_oru(obx_count):
+    """ build an ORU^R01 message with obx_count OBX segments """
+    return ORU_HEADER + "".join(OBX_TEMPLATE % (i + 1) for i in range(obx_count))
+
+
+class Command(BaseCommand):
+    help = ("Benchmark labcheck parse_message time per message against OBX count, "
+            "for the lazy tokenizer and the full hl7.parse path.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--obx', default='1,10,50,100,250,500',
+            help='Comma separated OBX counts to benchmark.')
+        parser.add_argument(
+            '--iterations', type=int, default=200,
+            help='Messages parsed per OBX count.')
+        parser.add_argument(
+            '--normalize-mb', type=int, default=8,
+            help='Size in MB of the input for the segment normalizer benchmark, 0 to skip.')
+
+    def handle(self, *args, **options):
+        counts = [int(c) for c in options['obx'].split(',') if c.strip()]
+        iterations = options['iterations']
+        self.stdout.write("%8s %14s %14s %14s %10s" % (
+            "obx", "ms/message", "us/obx", "hl7.parse ms", "speedup"))
+        for count in counts:
+            message = build_oru(count)
+            fast = self.time_parse(message, iterations, fast=True)
+            full = self.time_parse(message, iterations, fast=False)
+            self.stdout.write("%8d %14.3f %14.2f %14.3f %9.2fx" % (
+                count, fast * 1000, fast * 1e6 / max(count, 1), full * 1000, full / fast))
+        if options['normalize_mb']:
+            self.bench_normalize(options['normalize_mb'])
+
+    def bench_normalize(self, megabytes):
+        """ MB/s for cleanup_hl7 and the bytes normalizer on a large MLLP framed paste """
+        framed = ("\x0b" + build_oru(20).replace("\r", "\r\n") + "\x1c\r").encode()
+        data = framed * (megabytes * 1024 * 1024 // len(framed) + 1)
+        text = data.decode()
+        size = len(data) / (1024 * 1024)
+
+        def incremental():
+            normalizer = SegmentNormalizer()
+            view = memoryview(data)
+            for start in range(0, len(view), 65536):
+                normalizer.feed(view[start:start + 65536])
+            normalizer.close()
+
+        self.stdout.write("\n%-36s %10s" % ("normalizer (%.1f MB)" % size, "MB/s"))
+        for name, run in (("cleanup_hl7 (str)", lambda: cleanup_hl7(text)),
+                          ("normalize_segments (bytes)", lambda: normalize_segments(data)),
+                          ("SegmentNormalizer (64 KB chunks)", incremental)):
+            start = time.perf_counter()
+            run()
+            self.stdout.write("%-36s %10.1f" % (name, size / (time.perf_counter() - start)))
+
+    def time_parse(self, message, iterations, fast):
+        """ seconds per parse_message call """
+        parse_message(message, fast=fast)  # warm up
+        start = time.perf_counter()
+        for _ in range(iterations):
+            parse_message(message, fast=fast)
+        return (time.perf_counter() - start) / iterations
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from ...records import parse_compact
+from ...synthetic import generate_messages
+from .parsehl7 import parse_message
+from .synthhl7 import add_corpus_arguments, corpus_options
+
+
+def retained(parse, messages):
+    """Parse every message and keep the results, as a batch aggregation would.
+
+    Returns (results, seconds, bytes still allocated once parsing is done).
+    The messages are generated as they are parsed, so only results count;
+    seconds include generating them and the tracemalloc overhead.
+    """
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        results = []
+        for message in messages:
+            results.extend(parse(message))
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    return results, elapsed, size
+
+
+class Command(BaseCommand):
+    help = ("Compare the memory held by a batch of parse_message dicts with the same "
+            "batch as compact records, and the cost of serializing each.")
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser)
+        parser.set_defaults(count=100000)
+
+    def handle(self, *args, **options):
+        corpus = corpus_options(options)
+        self.stdout.write("%-10s %10s %12s %14s %10s %12s" % (
+            "results", "messages", "retained MB", "bytes/message", "parse s", "serialize s"))
+        digests = {}
+        for name, parse, to_dict in (("dict", parse_message, lambda result: result),
+                                     ("compact", parse_compact, lambda result: result.as_dict())):
+            results, elapsed, size = retained(parse, generate_messages(**corpus))
+            digest = hashlib.blake2b()
+            start = time.perf_counter()
+            for result in results:
+                digest.update(json.dumps(to_dict(result)).encode())
+            serialize = time.perf_counter() - start
+            digests[name] = digest.digest()
+            self.stdout.write("%-10s %10d %12.1f %14.0f %10.2f %12.2f" % (
+                name, len(results), size / 1024 ** 2, size / max(len(results), 1), elapsed, serialize))
+            del results
+        if digests["dict"] != digests["compact"]:
+            self.stderr.write("compact records do not serialize to the parse_message JSON")
@@ -0,0 +1,102 @@
+import datetime
+import json
+import platform
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from ...synthetic import generate_messages
+from .parsehl7 import cleanup_hl7, invalid_hl7, parse_message
+from .synthhl7 import add_corpus_arguments, corpus_options
+
+
+def percentile(ordered, fraction):
+    """ nearest rank percentile of an ascending list """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(func, inputs):
+    """Time func over every input, then run it again under tracemalloc.
+
+    Returns messages/s, latency percentiles in ms and the peak memory the
+    stage allocated above what was already live, in KB.
+    """
+    timings = []
+    clock = time.perf_counter
+    start = clock()
+    for value in inputs:
+        t = clock()
+        func(value)
+        timings.append(clock() - t)
+    elapsed = clock() - start
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        for value in inputs:
+            func(value)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "messages": len(inputs),
+        "seconds": round(elapsed, 6),
+        "messages_per_s": round(len(inputs) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 4),
+        "p90_ms": round(percentile(timings, 0.90) * 1000, 4),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 4),
+        "max_ms": round(timings[-1] * 1000, 4) if timings else 0.0,
+        "peak_memory_kb": round(max(peak, 0) / 1024, 1),
+    }
+
+
+def run_suite(messages):
+    """ benchmark each labcheck stage on its own input, in pipeline order """
+    raw = [message.replace("\r", "\n") for message in messages]
+    cleaned = [cleanup_hl7(message) for message in raw]
+    parsed = [parse_message(message) for message in cleaned]
+    return {
+        "cleanup_hl7": measure(cleanup_hl7, raw),
+        "invalid_hl7": measure(invalid_hl7, cleaned),
+        "parse_message": measure(parse_message, cleaned),
+        "json_serialization": measure(json.dumps, parsed),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmark cleanup_hl7, invalid_hl7, parse_message and JSON serialization "
+            "on a synthetic corpus, reporting messages/s, latency percentiles and peak memory.")
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser)
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the results as JSON to this file, for comparing runs.')
+
+    def handle(self, *args, **options):
+        corpus = corpus_options(options)
+        messages = list(generate_messages(**corpus))
+        stages = run_suite(messages)
+
+        self.stdout.write("%-20s %12s %10s %10s %10s %12s" % (
+            "stage", "messages/s", "p50 ms", "p90 ms", "p99 ms", "peak KB"))
+        for name, result in stages.items():
+            self.stdout.write("%-20s %12.1f %10.4f %10.4f %10.4f %12.1f" % (
+                name, result["messages_per_s"], result["p50_ms"], result["p90_ms"],
+                result["p99_ms"], result["peak_memory_kb"]))
+
+        if options['output']:
+            report = {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "corpus": dict(corpus, msg_types=list(corpus["msg_types"])),
+                "stages": stages,
+            }
+            with open(options['output'], 'w') as fh:
+                json.dump(report, fh, indent=2)
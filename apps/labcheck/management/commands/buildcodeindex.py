@@ -0,0 +1,38 @@
+import itertools
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...codeindex import build_index, read_csv
+
+
+class Command(BaseCommand):
+    help = ("Compile code table CSVs into the memory-mapped index labcheck uses to "
+            "flag unknown and deprecated OBX-3/OBR-4 codes (settings.LABCHECK_CODE_INDEX).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv', nargs='+', help='Code table CSV files with a header row.')
+        parser.add_argument('--output', '-o', required=True, help='Index file to write.')
+        parser.add_argument(
+            '--system',
+            help='Coding system for every row, e.g. LN for Loinc.csv, instead of a system column.')
+        parser.add_argument('--system-column', default='system')
+        parser.add_argument('--code-column', default='code', help='e.g. LOINC_NUM for Loinc.csv.')
+        parser.add_argument('--display-column', default='display', help='e.g. LONG_COMMON_NAME.')
+        parser.add_argument(
+            '--status-column', default='status',
+            help='Column whose DEPRECATED, INACTIVE or RETIRED values mark deprecated codes.')
+
+    def handle(self, *args, **options):
+        rows = itertools.chain.from_iterable(
+            read_csv(path,
+                     code_column=options['code_column'],
+                     display_column=options['display_column'],
+                     status_column=options['status_column'],
+                     system_column=options['system_column'],
+                     system=options['system'])
+            for path in options['csv'])
+        try:
+            count = build_index(rows, options['output'])
+        except (OSError, UnicodeDecodeError) as e:
+            raise CommandError(e)
+        self.stdout.write("%d codes written to %s" % (count, options['output']))
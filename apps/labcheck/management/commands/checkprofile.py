@@ -0,0 +1,79 @@
+import json
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...conformance import ProfileError, available_profiles, load_profile
+from ...structure import check_structure
+from .parsehl7 import expand_paths, open_messages
+
+
+class Command(BaseCommand):
+    help = ("Validate HL7v2 files against a conformance profile and summarize the "
+            "findings; per-message findings can be written as NDJSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--profile', default='elr-2.5.1',
+            help='Profile name (%s) or path to a profile JSON file.' % ', '.join(available_profiles()))
+        parser.add_argument(
+            '--output', '-o',
+            help='Write {"source", "offset", "findings"} NDJSON records to this file.')
+        parser.add_argument(
+            '--all-types', action='store_true',
+            help='Also validate messages whose type the profile does not cover.')
+        parser.add_argument(
+            '--top', type=int, default=20,
+            help='Number of most frequent findings to list.')
+        parser.add_argument(
+            '--structure', action='store_true',
+            help='Also check segment order and grouping against the message structure for MSH-9.')
+
+    def handle(self, *args, **options):
+        try:
+            profile = load_profile(options['profile'])
+        except ProfileError as e:
+            raise CommandError(e)
+        out = open(options['output'], 'w') if options['output'] else None
+        summary = Counter()
+        severities = Counter()
+        messages = failing = skipped = 0
+        start = time.perf_counter()
+        try:
+            for path in expand_paths(options['paths']):
+                for offset, message in open_messages(path):
+                    if not options['all_types'] and not profile.applies_to(message):
+                        skipped += 1
+                        continue
+                    findings = profile.validate(message)
+                    if options['structure']:
+                        findings += check_structure(message)
+                    messages += 1
+                    failing += any(f["severity"] == "error" for f in findings)
+                    for finding in findings:
+                        severities[finding["severity"]] += 1
+                        location = finding["segment"] or "end"
+                        if finding["field"] is not None:
+                            location += "-%d" % finding["field"]
+                        if finding["component"] is not None:
+                            location += ".%d" % finding["component"]
+                        summary[(finding["severity"], finding["code"], location)] += 1
+                    if out:
+                        out.write(json.dumps({"source": path, "offset": offset, "findings": findings}) + "\n")
+        finally:
+            if out:
+                out.close()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            "%s: %d messages, %d with errors, %s in %.3fs (%.1f us/message), "
+            "%d of other types skipped" % (
+                profile.name, messages, failing,
+                ", ".join("%d %s" % (severities[s], s) for s in ("error", "warning", "info")),
+                elapsed, elapsed * 1e6 / messages if messages else 0.0, skipped))
+        for (severity, code, location), count in summary.most_common(options['top']):
+            self.stdout.write("%8d  %-8s %-14s %s" % (count, severity, code, location))
@@ -0,0 +1,68 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...linkage import DEFAULT_MAX_BLOCK, DEFAULT_THRESHOLD, Linker
+from ...records import parse_compact
+from .parsehl7 import expand_paths, open_messages
+
+
+class Command(BaseCommand):
+    help = ("Link the PID segments of HL7v2 files that belong to the same patient. "
+            "Writes NDJSON with the source, offset and cluster id of every message "
+            "that has a PID; messages of one patient share a cluster id.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--threshold', type=float, default=DEFAULT_THRESHOLD,
+            help='Score at or above which two identities are the same patient.')
+        parser.add_argument(
+            '--max-block', type=int, default=DEFAULT_MAX_BLOCK,
+            help='Skip blocking keys shared by more identities than this.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write NDJSON to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        linker = Linker(options['threshold'], options['max_block'])
+        # (source, offset) per linker record
+        origins = []
+        errors = 0
+        start = time.perf_counter()
+        for path in expand_paths(options['paths']):
+            for offset, message in open_messages(path):
+                try:
+                    records = parse_compact(message)
+                except Exception as e:
+                    errors += 1
+                    self.stderr.write("%s@%d: %s: %s" % (path, offset, e.__class__.__name__, e))
+                    continue
+                for record in records:
+                    pid = record.get("patient_identity")
+                    if pid:
+                        linker.add(pid)
+                        origins.append((path, offset))
+        parsed = time.perf_counter()
+        clusters = linker.clusters()
+        linked = time.perf_counter()
+        out = open(options['output'], 'w') if options['output'] else None
+        try:
+            for (source, offset), cluster in zip(origins, clusters.tolist()):
+                line = json.dumps({"source": source, "offset": offset, "cluster": cluster})
+                if out:
+                    out.write(line + "\n")
+                else:
+                    self.stdout.write(line)
+        finally:
+            if out:
+                out.close()
+        self.stderr.write(
+            "%d identities, %d messages could not be parsed; %d blocks (%d too large, skipped), "
+            "%d candidate pairs, %d matches, %d patients; parse %.2fs, link %.2fs" % (
+                len(linker), errors, linker.stats["blocks"], linker.stats["skipped_blocks"],
+                linker.stats["candidate_pairs"], linker.stats["matched_pairs"],
+                linker.stats["clusters"], parsed - start, linked - parsed))
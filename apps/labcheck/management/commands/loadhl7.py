@@ -0,0 +1,67 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from ...loader import MessageLoader, order_links
+from ...records import parse_compact
+from .parsehl7 import expand_paths, open_messages
+
+
+class Command(BaseCommand):
+    help = ("Parse HL7v2 files, globs or directories and load the messages, patients, "
+            "orders and observations into the labcheck tables.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Messages written per transaction.')
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Rows per INSERT statement (default: as many as the database allows).')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to load into.')
+        parser.add_argument(
+            '--no-rollups', action='store_true',
+            help='Do not update the daily counts; rebuild them later with rebuildrollups.')
+
+    def handle(self, *args, **options):
+        try:
+            loader = MessageLoader(options['chunk_size'], options['batch_size'], options['database'],
+                                   rollups=not options['no_rollups'])
+        except ImproperlyConfigured as e:
+            raise CommandError(e)
+        errors = 0
+        path, offset = None, None
+        start = time.perf_counter()
+        try:
+            for path in expand_paths(options['paths']):
+                for offset, message in open_messages(path):
+                    try:
+                        links = order_links(message)
+                        records = parse_compact(message)
+                    except Exception as e:
+                        errors += 1
+                        self.stderr.write("%s@%d: %s: %s" % (path, offset, e.__class__.__name__, e))
+                        continue
+                    for record in records:
+                        loader.add_result(record, links, path, offset)
+            loader.close()
+        except DatabaseError as e:
+            raise CommandError(
+                "chunk %d, ending at %s@%s, was rolled back: %s: %s; %d messages were loaded before it" % (
+                    loader.transactions + 1, path, offset, e.__class__.__name__, e,
+                    loader.counts["messages"]))
+        elapsed = time.perf_counter() - start
+        counts = loader.counts
+        self.stdout.write(
+            "%d messages, %d patients, %d orders, %d observations in %d transactions, "
+            "%d messages could not be parsed; %.2fs (%.0f observations/s)" % (
+                counts["messages"], counts["patients"], counts["orders"], counts["observations"],
+                loader.transactions, errors, elapsed,
+                counts["observations"] / elapsed if elapsed else 0.0))
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from ...mllp import MLLPServer, send_messages
+from .benchlabcheck import build_oru
+from .parsehl7 import open_messages
+
+
+class Command(BaseCommand):
+    help = ("MLLP test client: send messages over many concurrent connections and report "
+            "throughput. Without --port a local listener is started to send to.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Listener address.')
+        parser.add_argument('--port', type=int, help='Listener port; omit to start a local listener.')
+        parser.add_argument('--connections', type=int, default=50, help='Concurrent connections.')
+        parser.add_argument('--messages', type=int, default=100, help='Messages sent per connection.')
+        parser.add_argument(
+            '--file', help='HL7 file whose messages are sent in turn (default: a generated ORU).')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Parser processes for the local listener.')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            messages = [message for offset, message in open_messages(options['file'])]
+        else:
+            messages = [build_oru(10)]
+        asyncio.run(self.run(messages, options))
+
+    async def run(self, messages, options):
+        host, port = options['host'], options['port']
+        executor = listener = None
+        if port is None:
+            executor = ProcessPoolExecutor(max_workers=options['workers'])
+            server = MLLPServer(executor, options['workers'] * 2)
+            listener = await server.start(host, 0)
+            port = listener.sockets[0].getsockname()[1]
+        count = options['messages']
+        batches = [[messages[(c + i) % len(messages)] for i in range(count)]
+                   for c in range(options['connections'])]
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(*(send_messages(host, port, batch) for batch in batches))
+            elapsed = time.perf_counter() - start
+        finally:
+            if listener:
+                listener.close()
+                await listener.wait_closed()
+                executor.shutdown()
+        codes = Counter(code for result in results for code in result)
+        total = sum(codes.values())
+        self.stdout.write("%d messages over %d connections in %.2fs: %.1f messages/s, ACK codes %s" % (
+            total, len(batches), elapsed, total / elapsed if elapsed else 0.0,
+            ", ".join("%s=%d" % item for item in sorted(codes.items()))))
@@ -0,0 +1,62 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from ...mllp import MLLPServer
+from ...volume import VolumeMonitor
+
+
+class Command(BaseCommand):
+    help = "Listen for HL7v2 messages over MLLP, validate and parse them and reply with ACKs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0', help='Address to listen on.')
+        parser.add_argument('--port', type=int, default=2575, help='Port to listen on.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of parser processes (default: number of CPUs).')
+        parser.add_argument(
+            '--max-pending', type=int,
+            help='Frames allowed in the worker pool at once before connections '
+                 'stop being read (default: twice the workers).')
+        parser.add_argument(
+            '--output', '-o',
+            help='Append an NDJSON record per message to this file.')
+        parser.add_argument(
+            '--volume-alerts',
+            help='Watch sender volumes and top OBX-3 codes, appending alerts as NDJSON to this file.')
+
+    def handle(self, *args, **options):
+        output = open(options['output'], 'a', buffering=1) if options['output'] else None
+        alerts = open(options['volume_alerts'], 'a', buffering=1) if options['volume_alerts'] else None
+        monitor = VolumeMonitor() if alerts else None
+        try:
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                server = MLLPServer(executor, options['max_pending'] or options['workers'] * 2, output,
+                                    monitor, alerts)
+                try:
+                    asyncio.run(self.serve(server, options['host'], options['port']))
+                except KeyboardInterrupt:
+                    pass
+                self.stderr.write("Stopped: %(connections)d connections, %(accepted)d accepted, "
+                                  "%(errors)d errors" % server.stats())
+        finally:
+            if output:
+                output.close()
+            if alerts:
+                alerts.close()
+
+    async def serve(self, server, host, port):
+        listener = await server.start(host, port)
+        self.stderr.write("Listening for MLLP on %s:%d" % (host, port))
+        watcher = None
+        if server.monitor is not None:
+            watcher = asyncio.get_running_loop().create_task(server.watch_volumes())
+        try:
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
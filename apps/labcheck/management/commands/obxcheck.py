@@ -0,0 +1,79 @@
+import json
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from ...obxcheck import SUMMARY_KEYS, ObservationBatch
+from ...records import parse_compact
+from .parsehl7 import expand_paths, open_messages
+
+
+def merge_summary(total, summary):
+    """ add the counts of one ObservationBatch.summary() into total """
+    for sender, counts in summary.items():
+        total.setdefault(sender, Counter()).update(counts)
+
+
+class Command(BaseCommand):
+    help = ("Check numeric OBX values against their reference ranges and abnormal "
+            "flags and print a per-sender summary. Reads the NDJSON written by "
+            "parsehl7 or api/batch, or HL7 files with --hl7.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='Files, directories or glob patterns to check.')
+        parser.add_argument(
+            '--hl7', action='store_true',
+            help='The paths are HL7 files to parse rather than NDJSON records.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100000,
+            help='Observations checked per vectorized pass.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the summary as JSON to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        batch = ObservationBatch()
+        totals = {}
+        self.errors = 0
+        for result in self.results(options['paths'], options['hl7']):
+            batch.add(result)
+            if len(batch) >= options['batch_size']:
+                merge_summary(totals, batch.summary())
+                batch = ObservationBatch()
+        merge_summary(totals, batch.summary())
+
+        summary = {sender: {key: totals[sender][key] for key in SUMMARY_KEYS}
+                   for sender in sorted(totals)}
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(summary, fh, indent=2)
+        else:
+            self.stdout.write("%-40s %s" % ("sender", " ".join("%12s" % key for key in SUMMARY_KEYS)))
+            for sender, counts in summary.items():
+                self.stdout.write("%-40s %s" % (
+                    sender, " ".join("%12d" % counts[key] for key in SUMMARY_KEYS)))
+        self.stderr.write("%d senders, %d observations, %d messages could not be parsed" % (
+            len(summary), sum(counts["observations"] for counts in summary.values()), self.errors))
+
+    def results(self, paths, hl7):
+        """ yield parsed messages from NDJSON records or from HL7 files, counting the failures in self.errors """
+        for path in expand_paths(paths):
+            if hl7:
+                for offset, message in open_messages(path):
+                    try:
+                        responses = parse_compact(message)
+                    except Exception:
+                        self.errors += 1
+                        continue
+                    yield from responses
+                continue
+            with open(path) as fh:
+                for line in fh:
+                    if line.strip():
+                        record = json.loads(line)
+                        if "error" in record:
+                            self.errors += 1
+                        elif record.get("result"):
+                            yield record["result"]
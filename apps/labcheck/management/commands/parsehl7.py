@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import argparse
+import glob
 import json
+import math
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import hl7
+from django.core.management.base import BaseCommand, CommandError
+
+from ...checkpoint import Checkpoint, CheckpointMismatch
+from ...codeindex import code_issues, default_index
+from ...dedup import Deduplicator
+from ...fieldmaps import SECTION_EXTRACTORS
+from ...hl7reader import read_messages
+from ...hl7tokenizer import SegmentIndex, Unsupported, index_message
+from ...parsecache import ParseCache, message_digest
+from ...parseprofile import PROFILER
+from ...projection import ProjectionError, parse_projection
 
 
 # adt  msg_names
@@ -76,6 +94,9 @@ hl7_transaction_names["VXU"] = vxu_names
 hl7_transaction_names["ORU"] = oru_names
 hl7_transaction_names["ORM"] = orm_names
 
+# results of validate_and_parse, keyed by message digest
+PARSE_CACHE = ParseCache(maxsize=1024)
+
 
 def invalid_hl7(message):
     """ check if the file is Hl7. return a blank string if"""
@@ -93,312 +114,543 @@ def invalid_hl7(message):
 
 
 def cleanup_hl7(message):
-    """ clean up the HL7 message to ensure proper segment endings """
-    cleaned_message = ""
-    for line in message.splitlines():
-        if len(line) == 1:
-            cleaned_message += "\r"
-        else:
-            if not line.endswith('\r'):
-                line += "\r"
-            cleaned_message += line
-    return cleaned_message
+    """ clean up the HL7 message to ensure proper segment endings.
+
+    Lines may end in \\r, \\n or \\r\\n and every line is ended with \\r;
+    empty and one character lines become a bare \\r, as they always have.
+    Built with a single join so large pastes stay linear.
+    """
+    return "".join(["\r" if len(line) <= 1 else line + "\r" for line in message.splitlines()])
+
+
+def open_messages(input_file, start=0):
+    """Yield (byte offset, message) for every message in an HL7 file or batch file.
+
+    start is the offset of a message to begin reading at.
+    """
+    with open(input_file, "rb") as fh:
+        fh.seek(start)
+        for offset, message in read_messages(fh):
+            yield start + offset, message
+
+
+def index_segments(message, fast=True, stats=None):
+    """Index the segments of a message.
+
+    Uses the lazy tokenizer when fast is set, falling back to a full
+    hl7.parse for anything the tokenizer cannot handle.
+    """
+    if stats is not None:
+        segments = stats.timed("tokenize", index_segments, message, fast)
+        stats.segments += sum(len(found) for found in segments.values())
+        stats.obx += len(segments.get("OBX", ()))
+        return segments
+    if fast:
+        try:
+            return index_message(message)
+        except Unsupported:
+            pass
+    return SegmentIndex(hl7.parse(message))
+
+
+def validate_and_parse(message, cache=PARSE_CACHE, projection=None):
+    """Clean up, validate and parse a message in a single pass.
+
+    Returns (responses, error). error is the same text invalid_hl7 gives when
+    the message cannot be parsed, otherwise responses is what parse_message
+    returns. Outcomes are cached by a digest of the cleaned message (and the
+    projection) so a re-submitted payload costs a lookup; the cached
+    responses are shared and must not be modified.
+    """
+    cleaned = cleanup_hl7(message)
+    key = message_digest(cleaned)
+    if projection is not None:
+        key += projection.spec.encode("utf-8")
+    outcome = cache.get(key)
+    if outcome is not None:
+        return outcome
+    if PROFILER.enabled:
+        with PROFILER.message() as stats:
+            outcome = _validate_and_parse(cleaned, stats, projection)
+    else:
+        outcome = _validate_and_parse(cleaned, projection=projection)
+    cache.set(key, outcome)
+    return outcome
+
+
+def _validate_and_parse(message, stats=None, projection=None):
+    try:
+        segments = index_segments(message, stats=stats)
+    except Exception as e:
+        return [], f"Parsing exception. Not an HL7 message. {e}"
+    return extract_message(segments, stats, projection), ""
 
-def open_message(input_file):
-    message = ""
-    list_of_messages = []
-    with open(input_file, "r") as fh:
-        for line in fh:
-            if len(line) == 1:
-                list_of_messages.append(message)
-                message = ""
-            else:
-                if not line.endswith('\r'):
-                    line += "\r"
-                message += line
-    return message
 
+def message_record(message, projection=None, **fields):
+    """NDJSON record for one message: fields plus "result" or "error".
 
-def parse_message(message):
-    """Parse hl7v2 message into a sensible json-like object"""
-    responses = []
-    h = hl7.parse(message)
-    message = {}
-    message["message"] = {}
-    if str(h.segment('MSH')[9][0][0]):
-        msg_type = str(h.segment('MSH')[9][0][0])
-        sub_msg_type = str(h.segment('MSH')[9][0][1])
-        message["message"]['msg_type'] = msg_type
-        message["message"]["sub_msg_type"] = sub_msg_type
-        message["message"]['msg_description'] = hl7_transaction_names[msg_type][sub_msg_type]
-        message["message"]["id"] = h.segment('MSH')[10][0]
-        message["message"]["from_system"] = str(
-            h.segment('MSH')[3][0]).replace('^', '-')
-        message["message"]["from_location"] = str(
-            h.segment('MSH')[4][0]).replace('^', '-')
-        message["message"]["to_system"] = str(
-            h.segment('MSH')[5][0]).replace('^', '-')
-        message["message"]["to_location"] = str(
-            h.segment('MSH')[6][0]).replace('^', '-')
-        message["message"]['timestamp'] = h.segment('MSH')[7][0]
-
-        rd = {}
-        rd['sub'] = h.segment('PID')[3][0]
-        try:
+    Never raises, so it is safe inside a streaming response or a listener.
+    """
+    record = dict(fields)
+    try:
+        responses, error = validate_and_parse(message, projection=projection)
+        if not error:
+            record["result"] = responses[0] if responses else None
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    if error:
+        record["error"] = error
+    return record
 
-            rd['given_name'] = h.segment('PID')[5][0][1][0]
-        except IndexError:
-            rd['given_name'] = ""
-        
-        try:
-            rd['family_name'] = h.segment('PID')[5][0][0][0]
-        except IndexError:
-            rd['family_name'] = ""
 
-        # phone
-        try:
-            rd['phone_number'] = h.segment('PID')[13][0][0][0]
-        except IndexError:
-            pass
+def parse_message(message, fast=True, projection=None):
+    """Parse hl7v2 message into a sensible json-like object
 
-        # language
-        try:
-            rd['language'] = h.segment('PID')[15][0]
-        except IndexError:
-            pass
+    projection is a projection.Projection limiting the output to some
+    sections and fields.
+    """
+    if PROFILER.enabled:
+        with PROFILER.message() as stats:
+            return extract_message(index_segments(message, fast, stats), stats, projection)
+    return extract_message(index_segments(message, fast), projection=projection)
 
-        # marital status
-        try:
-            rd['marital_status'] = h.segment('PID')[16][0][0][0]
-        except IndexError:
-            pass
 
-        if h.segment('PID')[8] == "M":
-            rd['gender'] = "male"
-        elif h.segment('PID')[8] == "F":
-            rd['gender'] = "female"
-
-        rd['birthdate'] = h.segment('PID')[7][0]
-
-        rd['address'] = []
-        rd['document'] = []
-        addr = {}
-        if len(h.segment('PID')[11][0]):
-            addr['formatted'] = "%s %s %s %s %s" % (h.segment('PID')[11][0][0],
-                                                       h.segment('PID')[
-                11][0][1],
-                h.segment('PID')[
-                11][0][2],
-                h.segment('PID')[11][0][3],
-                h.segment('PID')[11][0][4],
-            )
-            # Clean up the formatted address
-            addr['formatted'] = addr['formatted'].strip()
-
-            if len(h.segment('PID')[11][0][0]):
-                addr['street_address'] = h.segment('PID')[11][0][0][0]
-
-            if len(h.segment('PID')[11][0][1][0]):
-                addr['street_address'] = "%s %s" % (
-                    addr['street_address'], h.segment('PID')[11][0][1])
-            addr['locality'] = h.segment('PID')[11][0][2][0]
-            addr['region'] = h.segment('PID')[11][0][3][0]
-            addr['postal_code'] = h.segment('PID')[11][0][4][0]
-            #addr['country'] = h.segment('PID')[11][0][5][0]
-            if len(h.segment('PID')[11][0]) > 8:
-                addr['county'] = h.segment('PID')[11][0][8][0]
-
-        rd['address'].append(addr)
-
-        doc = {}
-        doc['number'] = h.segment('PID')[3][0]
-        rd['document'].append(doc)
-
-        # if an ssn was found, add it to the document claim
-        # ssn
-        try:
-            ssn = h.segment('PID')[19][0]
-            if ssn:
-                doc = {}
-                doc['number'] = ssn
-                doc['issuer'] = "Social Security Administration (SSA)"
-                doc['issuer_meta'] = []
-                doc['issuer_meta'].append(
-                    {"name": "ssn", "verbose_name": "Social Secuirity Number"})
-                rd['document'].append(doc)
-        except IndexError:
-            pass
+def extract_message(segments, stats=None, projection=None):
+    """Build the parse_message output from a SegmentIndex.
 
-        message["patient_identity"] = rd
+    stats is the parseprofile.MessageStats of the message when profiling.
+    With a projection only the requested sections are extracted.
+    """
+    responses = []
+    msh = segments.segment('MSH')
+    message = {}
+    header = projection is None or "message" in projection
+    patient = projection is None or "patient_identity" in projection
+    if header:
+        message["message"] = {}
+    if str(msh[9][0][0]):
+        if stats is None:
+            if header:
+                message["message"] = extract_header(msh)
+            if patient:
+                message["patient_identity"] = extract_patient(segments.segment('PID'))
+        else:
+            stats.msg_type = "%s^%s" % (msh[9][0][0], msh[9][0][1])
+            if header:
+                message["message"] = stats.timed("message", extract_header, msh)
+            if patient:
+                message["patient_identity"] = stats.timed(
+                    "patient_identity", extract_patient, segments.segment('PID'), stats)
+
+        # Grab the optional EVN, PD1 and PV1 and the repeating OBX and OBR
+        # sections, see fieldmaps.py for the fields pulled from each
+        extractors = SECTION_EXTRACTORS if projection is None else projection.extractors
+        for name, segment_id, repeats, extract in extractors:
+            try:
+                found = segments.segments(segment_id)
+            except KeyError:
+                if stats is not None:
+                    stats.exceptions += 1
+                continue
+            if stats is not None:
+                message[name] = stats.timed(name, extract_section, found, repeats, extract)
+            else:
+                message[name] = extract_section(found, repeats, extract)
 
-        # Grab info from EVN segment if available
-        try:
-            evn_segment = h.segment('EVN')
-            message["event_type"] = {
-                "event_type_code": evn_segment[1][0],
-                "recorded_date_time": evn_segment[2][0],
-                "date_time_planned_event": evn_segment[3][0],
-                "event_reason_code": evn_segment[4][0],
-                "operator_id": evn_segment[5][0],
-                #"event_occurred": evn_segment[6][0]
-            }
-        except KeyError:
-            pass
+        index = default_index() if projection is None or "code_issues" in projection else None
+        if index is not None:
+            if stats is not None:
+                message["code_issues"] = stats.timed("code_issues", code_issues, message, index)
+            else:
+                message["code_issues"] = code_issues(message, index)
 
-        # Grab info from PD1 segment if available
-        try:
-            pd1_segment = h.segment('PD1')
-            message["patient_additional_demographic"] = {
-                "living_dependency": pd1_segment[1][0],
-                "living_arrangement": pd1_segment[2][0],
-                "primary_facility": pd1_segment[3][0],
-                "primary_care_provider": pd1_segment[4][0],
-                "student_indicator": pd1_segment[5][0],
-                "handicap": pd1_segment[6][0],
-                "living_will_code": pd1_segment[7][0],
-                "organ_donor_code": pd1_segment[8][0],
-                "separate_bill": pd1_segment[9][0],
-                "duplicate_patient": pd1_segment[10][0],
-                "publicity_code": pd1_segment[11][0],
-                "protection_indicator": pd1_segment[12][0],
-                "protection_indicator_effective_date": pd1_segment[13][0],
-                "place_of_worship": pd1_segment[14][0],
-                "advance_directive_code": pd1_segment[15][0],
-                "immunization_registry_status": pd1_segment[16][0],
-                "immunization_registry_status_effective_date": pd1_segment[17][0],
-                "publicity_code_effective_date": pd1_segment[18][0],
-                "military_branch": pd1_segment[19][0],
-                "military_rank": pd1_segment[20][0],
-                "military_status": pd1_segment[21][0]
-            }
-        except KeyError:
-            pass
+        if projection is not None:
+            projection.trim(message)
+        if stats is not None:
+            stats.fields += sum(_count_fields(section) for section in message.values())
+        responses.append(message)
 
-        # Grab info from PV1 segment if available
-        try:
-            pv1_segment = h.segment('PV1')
-            message["patient_visit"] = {
-                "set_id": pv1_segment[1][0],
-                "patient_class": pv1_segment[2][0],
-                "assigned_patient_location": pv1_segment[3][0],
-                "admission_type": pv1_segment[4][0],
-                "preadmit_number": pv1_segment[5][0],
-                "prior_patient_location": pv1_segment[6][0],
-                #"attending_doctor": pv1_segment[7][0],
-                #"referring_doctor": pv1_segment[8][0],
-            }
-        except KeyError:
-            pass
+    return responses
 
-        # Grab info from OBX segment if available
-        try:
-            obx_segments = h.segments('OBX')
-            message["observations"] = []
-            for obx_segment in obx_segments:
-                observation = {
-                    "set_id": obx_segment[1][0],
-                    "value_type": obx_segment[2][0],
-                    "observation_identifier": obx_segment[3][0],
-                    "observation_sub_id": obx_segment[4][0],
-                    "observation_value": obx_segment[5][0],
-                    "units": obx_segment[6][0],
-                    "references_range": obx_segment[7][0],
-                    "abnormal_flags": obx_segment[8][0],
-                    "probability": obx_segment[9][0],
-                    "nature_of_abnormal_test": obx_segment[10][0],
-                    "observ_result_status": obx_segment[11][0],
-                    "date_last_obs_normal_values": obx_segment[12][0],
-                    "user_defined_access_checks": obx_segment[13][0],
-                    "date_time_of_the_observation": obx_segment[14][0],
-                    "producer_id": obx_segment[15][0],
-                    "responsible_observer": obx_segment[16][0],
-                    "observation_method": obx_segment[17][0]
-                }
-                message["observations"].append(observation)
-        except KeyError:
-            pass
 
-        # Grab info from OBR segment if available
-        try:
-            obr_segments = h.segments('OBR')
-            message["orders"] = []
-            for obr_segment in obr_segments:
-                order = {
-                    "set_id": obr_segment[1][0],
-                    "placer_order_number": obr_segment[2][0],
-                    "filler_order_number": obr_segment[3][0],
-                    "universal_service_identifier": obr_segment[4][0],
-                    "priority": obr_segment[5][0],
-                    "requested_date_time": obr_segment[6][0],
-                    "observation_date_time": obr_segment[7][0],
-                    "observation_end_date_time": obr_segment[8][0],
-                    "collection_volume": obr_segment[9][0],
-                    "collector_identifier": obr_segment[10][0],
-                    "specimen_action_code": obr_segment[11][0],
-                    "danger_code": obr_segment[12][0],
-                    "relevant_clinical_info": obr_segment[13][0],
-                    "specimen_received_date_time": obr_segment[14][0],
-                    "specimen_source": obr_segment[15][0],
-                    "ordering_provider": obr_segment[16][0],
-                    "order_callback_phone_number": obr_segment[17][0],
-                    "placer_field_1": obr_segment[18][0],
-                    "placer_field_2": obr_segment[19][0],
-                    "filler_field_1": obr_segment[20][0],
-                    "filler_field_2": obr_segment[21][0],
-                    "results_rpt_status_chng_date_time": obr_segment[22][0],
-                    "charge_to_practice": obr_segment[23][0],
-                    "diagnostic_serv_sect_id": obr_segment[24][0],
-                    "result_status": obr_segment[25][0],
-                    "parent_result": obr_segment[26][0],
-                    "quantity_timing": obr_segment[27][0],
-                    "result_copies_to": obr_segment[28][0],
-                    "parent": obr_segment[29][0],
-                    "transportation_mode": obr_segment[30][0],
-                    "reason_for_study": obr_segment[31][0],
-                   #"principal_result_interpreter": obr_segment[32][0],
-                   # "assistant_result_interpreter": obr_segment[33][0],
-                   # "technician": obr_segment[34][0],
-                   # "transcriptionist": obr_segment[35][0],
-                   # "scheduled_date_time": obr_segment[36][0],
-                   # "number_of_sample_containers": obr_segment[37][0],
-                   # "transport_logistics_of_collected_sample": obr_segment[38][0],
-                   # "collectors_comment": obr_segment[39][0],
-                   # "transport_arrangement_responsibility": obr_segment[40][0],
-                   # "transport_arranged": obr_segment[41][0],
-                   # "escort_required": obr_segment[42][0],
-                   # "planned_patient_transport_comment": obr_segment[43][0],
-                   # "procedure_code": obr_segment[44][0],
-                   # "procedure_code_modifier": obr_segment[45][0],
-                   # "placer_supplemental_service_info": obr_segment[46][0],
-                   # "filler_supplemental_service_info": obr_segment[47][0],
-                   # "medically_necessary_duplicate_procedure_reason": obr_segment[48][0],
-                   # "result_handling": obr_segment[49][0],
-                   # "parent_universal_service_identifier": obr_segment[50][0]
-                }
-                message["orders"].append(order)
-        except KeyError:
-            pass
+def extract_section(found, repeats, extract):
+    """ one fieldmaps section: a list of dicts for repeating segments, else a dict """
+    if repeats:
+        return [extract(segment) for segment in found]
+    return extract(found[0])
+
+
+def _count_fields(section):
+    if isinstance(section, list):
+        return sum(len(entry) for entry in section)
+    return len(section)
+
+
+def extract_header(msh):
+    """ the "message" section from MSH """
+    header = {}
+    msg_type = str(msh[9][0][0])
+    sub_msg_type = str(msh[9][0][1])
+    header['msg_type'] = msg_type
+    header["sub_msg_type"] = sub_msg_type
+    header['msg_description'] = hl7_transaction_names[msg_type][sub_msg_type]
+    header["id"] = msh[10][0]
+    header["from_system"] = str(msh[3][0]).replace('^', '-')
+    header["from_location"] = str(msh[4][0]).replace('^', '-')
+    header["to_system"] = str(msh[5][0]).replace('^', '-')
+    header["to_location"] = str(msh[6][0]).replace('^', '-')
+    header['timestamp'] = msh[7][0]
+    return header
+
+
+def extract_patient(pid, stats=None):
+    """The "patient_identity" section from PID.
+
+    Optional fields that are missing are skipped; when profiling each one
+    is counted on stats.
+    """
+    rd = {}
+    rd['sub'] = pid[3][0]
+    try:
 
-        responses.append(message)
+        rd['given_name'] = pid[5][0][1][0]
+    except IndexError:
+        rd['given_name'] = ""
+        _swallowed(stats)
 
-    return responses
+    try:
+        rd['family_name'] = pid[5][0][0][0]
+    except IndexError:
+        rd['family_name'] = ""
+        _swallowed(stats)
 
+    # phone
+    try:
+        rd['phone_number'] = pid[13][0][0][0]
+    except IndexError:
+        _swallowed(stats)
 
-if __name__ == "__main__":
-
-    # Parse args
-    parser = argparse.ArgumentParser(description='Load in an HL7v2 file or stream.')
-    parser.add_argument(
-        dest='input_file',
-        action='store',
-        help='Input the HL7v2 source file.')
-    args = parser.parse_args()
-    message = open_message(args.input_file)
-    result = invalid_hl7(message)
-    if result:
-        print(result)
-        exit(1)
-    result = parse_message(message)
-
-    # output the JSON transaction summary
-    print(json.dumps(result, indent=4))
+    # language
+    try:
+        rd['language'] = pid[15][0]
+    except IndexError:
+        _swallowed(stats)
+
+    # marital status
+    try:
+        rd['marital_status'] = pid[16][0][0][0]
+    except IndexError:
+        _swallowed(stats)
+
+    if pid[8] == "M":
+        rd['gender'] = "male"
+    elif pid[8] == "F":
+        rd['gender'] = "female"
+
+    rd['birthdate'] = pid[7][0]
+
+    rd['address'] = []
+    rd['document'] = []
+    addr = {}
+    pid_address = pid[11][0]
+    if len(pid_address):
+        addr['formatted'] = "%s %s %s %s %s" % (pid_address[0],
+                                                pid_address[1],
+                                                pid_address[2],
+                                                pid_address[3],
+                                                pid_address[4],
+                                                )
+        # Clean up the formatted address
+        addr['formatted'] = addr['formatted'].strip()
+
+        if len(pid_address[0]):
+            addr['street_address'] = pid_address[0][0]
+
+        if len(pid_address[1][0]):
+            addr['street_address'] = "%s %s" % (
+                addr['street_address'], pid_address[1])
+        addr['locality'] = pid_address[2][0]
+        addr['region'] = pid_address[3][0]
+        addr['postal_code'] = pid_address[4][0]
+        #addr['country'] = pid_address[5][0]
+        if len(pid_address) > 8:
+            addr['county'] = pid_address[8][0]
+
+    rd['address'].append(addr)
+
+    doc = {}
+    doc['number'] = pid[3][0]
+    rd['document'].append(doc)
+
+    # if an ssn was found, add it to the document claim
+    # ssn
+    try:
+        ssn = pid[19][0]
+        if ssn:
+            doc = {}
+            doc['number'] = ssn
+            doc['issuer'] = "Social Security Administration (SSA)"
+            doc['issuer_meta'] = []
+            doc['issuer_meta'].append(
+                {"name": "ssn", "verbose_name": "Social Secuirity Number"})
+            rd['document'].append(doc)
+    except IndexError:
+        _swallowed(stats)
+
+    return rd
+
+
+def _swallowed(stats):
+    if stats is not None:
+        stats.exceptions += 1
+
+
+def expand_paths(paths):
+    """ yield the files named by paths, which may be files, globs or directories """
+    for path in paths:
+        if any(c in path for c in "*?["):
+            matches = sorted(glob.glob(path, recursive=True))
+        else:
+            matches = [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                    for name in sorted(files):
+                        if not name.startswith('.'):
+                            yield os.path.join(root, name)
+            else:
+                yield match
+
+
+def parse_chunk(chunk, fields=None):
+    """Parse a list of (source, offset, message) tuples.
+
+    Runs inside the worker processes, so it returns NDJSON lines rather than
+    the parsed hl7 objects to keep what is pickled back small. Each record is
+    (json line, failed, seconds spent on the message). fields is a
+    projection spec, passed as text so each worker compiles it once.
+    """
+    projection = parse_projection(fields) if fields else None
+    records = []
+    for source, offset, message in chunk:
+        start = time.perf_counter()
+        record = {"source": source, "offset": offset}
+        try:
+            responses = parse_message(message, projection=projection)
+            record["result"] = responses[0] if responses else None
+        except Exception as e:
+            record["error"] = "%s: %s" % (e.__class__.__name__, e)
+        line = json.dumps(record)
+        records.append((line, "error" in record, time.perf_counter() - start))
+    if PROFILER.dump_dir:
+        # pool workers are not shut down through atexit, so they dump per chunk
+        PROFILER.dump()
+    return records
+
+
+def iter_chunks(paths, chunk_size, dedup=None, checkpoint=None):
+    """Group the messages of all files into lists of chunk_size (source, offset, message).
+
+    Messages a dedup.Deduplicator has seen before are left out, and so are
+    the files and messages a checkpoint.Checkpoint records as written.
+    """
+    chunk = []
+    for path in expand_paths(paths):
+        resume = -1
+        if checkpoint is not None:
+            if checkpoint.done(path):
+                continue
+            checkpoint.opened(path)
+            resume = checkpoint.resume_offset(path)
+        for offset, message in open_messages(path, max(resume, 0)):
+            if offset <= resume:
+                continue
+            if dedup is not None and dedup.seen(message):
+                continue
+            chunk.append((path, offset, message))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_chunks(chunks, workers, fields=None):
+    """Yield parse_chunk results in input order.
+
+    With more than one worker the chunks go to a process pool, with at most
+    two chunks per worker in flight so a huge backfill is never read into
+    memory ahead of the workers.
+    """
+    parse = partial(parse_chunk, fields=fields) if fields else parse_chunk
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(parse, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def track_chunks(chunks, in_flight, dedup=None):
+    """ pass chunks through, noting where each ends and how many dedup keys exist by then """
+    for chunk in chunks:
+        source, offset, message = chunk[-1]
+        in_flight.append((source, offset, len(chunk), dedup.added if dedup is not None else 0))
+        yield chunk
+
+
+def save_checkpoint(checkpoint, out, dedup, keys):
+    """Sync the output, then save the checkpoint, then commit dedup keys up to keys.
+
+    A crash between the last two steps loses dedup keys of messages that
+    were written, which at worst lets a later resend of them through;
+    committing the keys first could instead make a resumed run skip
+    messages whose output was truncated away. Returns keys.
+    """
+    out.flush()
+    os.fsync(out.fileno())
+    checkpoint.save(os.fstat(out.fileno()).st_size)
+    if dedup is not None:
+        dedup.flush(keys)
+    return keys
+
+
+class LatencyHistogram(object):
+    """ log-scale latency histogram; constant memory, percentiles within ~2% """
+
+    step = math.log(1.02)
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+
+    def add(self, seconds):
+        self.buckets[int(math.log(max(seconds, 1e-9)) / self.step)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return math.exp((bucket + 0.5) * self.step)
+        return math.exp((max(self.buckets) + 0.5) * self.step)
+
+
+class Command(BaseCommand):
+    help = "Parse HL7v2 files, globs or directories into NDJSON, one line per message."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of parser processes (default: number of CPUs).')
+        parser.add_argument(
+            '--chunk-size', type=int, default=200,
+            help='Messages sent to a worker per task.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write NDJSON to this file instead of stdout.')
+        parser.add_argument(
+            '--dedup',
+            help='Skip messages already seen, by sender and MSH-10, recorded in this state file.')
+        parser.add_argument(
+            '--dedup-content-hash', action='store_true',
+            help='With --dedup, also skip messages whose normalized content was seen before.')
+        parser.add_argument(
+            '--checkpoint',
+            help='Record progress in this file and resume from it if it exists. Needs --output.')
+        parser.add_argument(
+            '--checkpoint-interval', type=float, default=10.0,
+            help='Seconds between checkpoints.')
+        parser.add_argument(
+            '--fields',
+            help='Only output these sections and fields, e.g. '
+                 'message,patient_identity,observations.observation_identifier')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if options['fields']:
+            try:
+                parse_projection(options['fields'])
+            except ProjectionError as e:
+                raise CommandError("--fields: %s" % e)
+        checkpoint = None
+        if options['checkpoint']:
+            if not output:
+                raise CommandError("--checkpoint needs --output, stdout cannot be rewound")
+            try:
+                checkpoint = Checkpoint(options['checkpoint'], options['paths'], output)
+            except CheckpointMismatch as e:
+                raise CommandError("%s; remove it to start over" % e)
+        if checkpoint is not None and checkpoint.resumed:
+            # drop whatever was written after the last checkpoint
+            os.truncate(output, checkpoint.output_size)
+            out = open(output, 'a')
+            self.stderr.write("Resuming after %d messages, %d files done" % (
+                checkpoint.messages, len(checkpoint.completed)))
+        else:
+            out = open(output, 'w') if output else None
+        dedup = None
+        if options['dedup']:
+            # with a checkpoint, keys are committed together with it
+            dedup = Deduplicator(options['dedup'], content_hash=options['dedup_content_hash'],
+                                 flush_every=None if checkpoint else 10000)
+        # (source, offset, messages, dedup keys) of the chunks being parsed
+        in_flight = deque()
+        committed = 0
+        saved = time.monotonic()
+        latencies = LatencyHistogram()
+        errors = 0
+        start = time.perf_counter()
+        try:
+            chunks = iter_chunks(options['paths'], options['chunk_size'], dedup, checkpoint)
+            if checkpoint is not None:
+                chunks = track_chunks(chunks, in_flight, dedup)
+            for records in run_chunks(chunks, options['workers'], options['fields']):
+                for line, failed, seconds in records:
+                    if out:
+                        out.write(line + "\n")
+                    else:
+                        self.stdout.write(line)
+                    errors += failed
+                    latencies.add(seconds)
+                if checkpoint is not None:
+                    source, offset, count, keys = in_flight.popleft()
+                    checkpoint.advance(source, offset, count)
+                    if time.monotonic() - saved >= options['checkpoint_interval']:
+                        committed = save_checkpoint(checkpoint, out, dedup, keys)
+                        saved = time.monotonic()
+            if checkpoint is not None:
+                checkpoint.finish()
+                committed = save_checkpoint(checkpoint, out, dedup, dedup.added if dedup else 0)
+        finally:
+            if out:
+                out.close()
+            if dedup is not None:
+                dedup.close(committed if checkpoint is not None else None)
+        elapsed = time.perf_counter() - start
+        self.stderr.write(
+            "%d messages in %.2fs (%.1f messages/s), %d errors, "
+            "p50 %.3f ms, p99 %.3f ms per message" % (
+                latencies.count, elapsed, latencies.count / elapsed if elapsed else 0.0,
+                errors, latencies.percentile(50) * 1000, latencies.percentile(99) * 1000))
+        if dedup is not None:
+            self.stderr.write(
+                "%(duplicates)d of %(checked)d messages skipped as duplicates (%(duplicate_rate).2f%%), "
+                "%(keys)d keys in %(filters)d filters, %(false_positives)d filter false positives, "
+                "false-positive rate %(estimated_false_positive_rate).2e "
+                "of a %(false_positive_budget).2e budget" % dict(
+                    dedup.stats(), duplicate_rate=dedup.stats()["duplicate_rate"] * 100))
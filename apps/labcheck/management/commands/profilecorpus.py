@@ -0,0 +1,62 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...fieldstats import DEFAULT_PRECISION, CorpusProfile, profile_file
+from .parsehl7 import expand_paths
+
+
+class Command(BaseCommand):
+    help = ("Read HL7v2 files once and report, per segment and field, the fill rate, "
+            "value length distribution and approximate number of distinct values, as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Files profiled in parallel (default: number of CPUs).')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the JSON report to this file instead of stdout.')
+        parser.add_argument(
+            '--sketches', action='store_true',
+            help='Include the distinct count sketches, so the report can be merged later.')
+        parser.add_argument(
+            '--merge', action='append', default=[],
+            help='Add a report made with --sketches, e.g. of an earlier month. May be repeated.')
+        parser.add_argument(
+            '--precision', type=int, default=DEFAULT_PRECISION,
+            help='HyperLogLog precision: 2**precision one byte registers per field.')
+
+    def handle(self, *args, **options):
+        if not options['paths'] and not options['merge']:
+            raise CommandError("give HL7v2 paths, reports to --merge, or both")
+        profile = CorpusProfile(options['precision'])
+        try:
+            for path in options['merge']:
+                with open(path) as fh:
+                    profile.merge(CorpusProfile.from_report(json.load(fh)))
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError("--merge: %s" % e)
+        paths = list(expand_paths(options['paths']))
+        profile_path = partial(profile_file, precision=options['precision'])
+        if options['workers'] <= 1 or len(paths) <= 1:
+            for path in paths:
+                profile.merge(profile_path(path))
+        else:
+            with ProcessPoolExecutor(max_workers=min(options['workers'], len(paths))) as pool:
+                for part in pool.map(profile_path, paths):
+                    profile.merge(part)
+        report = json.dumps(profile.report(sketches=options['sketches']), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(report + "\n")
+        else:
+            self.stdout.write(report)
+        self.stderr.write("%d files, %d messages, %d segment types" % (
+            profile.files, profile.messages, len(profile.segments)))
@@ -0,0 +1,78 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...parseprofile import PROFILER, environ_sample
+from .parsehl7 import expand_paths, hl7_transaction_names, open_messages, parse_message
+
+
+def type_descriptions():
+    """ "ORU^R01" style message types to their hl7_transaction_names description """
+    return {"%s^%s" % (msg_type, trigger): description
+            for msg_type, triggers in hl7_transaction_names.items()
+            for trigger, description in triggers.items()}
+
+
+class Command(BaseCommand):
+    help = ("Parse HL7 files with parser instrumentation on and report per-stage "
+            "timings and counters per message type, optionally with cProfile samples.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7 files, directories or glob patterns to parse.')
+        parser.add_argument(
+            '--cprofile-sample', type=float,
+            help='Fraction of messages, 0 to 1, to also run under cProfile '
+                 '(default: LABCHECK_CPROFILE_SAMPLE, or none).')
+        parser.add_argument(
+            '--sort', default='cumulative',
+            help='pstats sort key for the cProfile listing.')
+        parser.add_argument(
+            '--limit', type=int, default=25,
+            help='Number of functions in the cProfile listing.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Also write the report as JSON to this file.')
+        parser.add_argument(
+            '--pstats-file',
+            help='Dump the merged cProfile samples here, for snakeviz or pstats.')
+
+    def handle(self, *args, **options):
+        try:
+            sample = options['cprofile_sample']
+            PROFILER.enable(cprofile_sample=environ_sample(os.environ) if sample is None else sample)
+        except ValueError as e:
+            raise CommandError(e)
+        PROFILER.reset()
+        try:
+            for path in expand_paths(options['paths']):
+                for offset, message in open_messages(path):
+                    try:
+                        parse_message(message)
+                    except Exception:
+                        # counted as failed by the profiler
+                        pass
+        finally:
+            PROFILER.disable()
+
+        report = PROFILER.report(type_descriptions())
+        for msg_type, totals in report.items():
+            self.stdout.write("%s %s" % (msg_type, totals["description"]))
+            self.stdout.write(
+                "  %(messages)d messages, %(failed)d failed, %(segments)d segments, "
+                "%(obx)d OBX, %(fields)d fields, %(exceptions)d exceptions swallowed" % totals)
+            for stage, timing in sorted(totals["stages"].items(), key=lambda s: -s[1]["total_ms"]):
+                self.stdout.write("  %-32s %12.3f ms %12.2f us/message" % (
+                    stage, timing["total_ms"], timing["mean_us"]))
+
+        if PROFILER.profiled:
+            self.stdout.write("\ncProfile, %d sampled messages" % PROFILER.profiled)
+            self.stdout.write(PROFILER.format_pstats(options['sort'], options['limit']))
+            if options['pstats_file']:
+                PROFILER.pstats.dump_stats(options['pstats_file'])
+
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump({"types": report, "cprofile_samples": PROFILER.profiled}, fh, indent=2)
@@ -0,0 +1,30 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...rollups import rebuild_day
+
+
+def parse_day(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise CommandError("%r is not a YYYY-MM-DD date" % text)
+
+
+class Command(BaseCommand):
+    help = ("Recompute the daily counts of the given days from the loaded messages and "
+            "observations, replacing what the loader accumulated.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'days', nargs='+',
+            help='Days to rebuild, as YYYY-MM-DD.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to rebuild in.')
+
+    def handle(self, *args, **options):
+        for day in [parse_day(text) for text in options['days']]:
+            rows = rebuild_day(day, options['database'])
+            self.stdout.write("%s: %d rows" % (day.isoformat(), rows))
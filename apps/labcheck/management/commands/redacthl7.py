@@ -0,0 +1,58 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...redact import DEFAULT_MASK, MaskError, Redactor
+from .parsehl7 import expand_paths
+
+
+class Command(BaseCommand):
+    help = ("Copy HL7v2 files with the PHI fields of a mask emptied or replaced by keyed "
+            "pseudonyms. Delimiters, segment terminators and everything outside the mask "
+            "are left byte for byte as they were.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the redacted messages to this file instead of stdout.')
+        parser.add_argument(
+            '--mask', default=DEFAULT_MASK,
+            help='Fields to redact: SEG for every field after the set ID, SEG-field, '
+                 'or SEG-field.component (default: %(default)s).')
+        parser.add_argument(
+            '--key-file',
+            help='Replace values with pseudonyms keyed by the contents of this file, '
+                 'so the same value always gets the same pseudonym. Without it values are emptied.')
+
+    def handle(self, *args, **options):
+        key = None
+        if options['key_file']:
+            with open(options['key_file'], 'rb') as fh:
+                key = fh.read().strip()
+            if not key:
+                raise CommandError("--key-file %s is empty" % options['key_file'])
+        try:
+            redactor = Redactor(options['mask'], key)
+        except MaskError as e:
+            raise CommandError("--mask: %s" % e)
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        read = 0
+        start = time.perf_counter()
+        try:
+            for path in expand_paths(options['paths']):
+                with open(path, 'rb') as fh:
+                    read += redactor.stream(fh, out)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
+        elapsed = time.perf_counter() - start
+        self.stderr.write(
+            "%d bytes, %d segments with %d values redacted in %.2fs (%.1f MB/s)" % (
+                read, redactor.stats["segments"], redactor.stats["values"], elapsed,
+                read / elapsed / 1024 ** 2 if elapsed else 0.0))
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...synthetic import MESSAGE_TYPES, generate_messages
+
+
+def add_corpus_arguments(parser):
+    """ generator options shared by the commands that build a synthetic corpus """
+    parser.add_argument(
+        '--count', type=int, default=1000,
+        help='Number of messages to generate.')
+    parser.add_argument(
+        '--types', default=','.join(MESSAGE_TYPES),
+        help='Comma separated message types to cycle through (%s).' % ', '.join(MESSAGE_TYPES))
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--obx', type=int, default=5, help='OBX segments per order.')
+    parser.add_argument('--obr', type=int, default=1, help='Orders (ORC/OBR pairs) per message.')
+    parser.add_argument('--nte', type=int, default=0, help='NTE segments after each OBR and OBX.')
+    parser.add_argument(
+        '--repetitions', type=int, default=1,
+        help='Repetitions of PID-3, PID-11 and PID-13.')
+    parser.add_argument(
+        '--field-length', type=int, default=8,
+        help='Length of generated free text values.')
+
+
+def corpus_options(options):
+    """ validated keyword arguments for generate_messages from parsed options """
+    types = tuple(t.strip().upper() for t in options['types'].split(',') if t.strip())
+    unknown = set(types) - set(MESSAGE_TYPES)
+    if unknown or not types:
+        raise CommandError("Unknown message types: %s" % ', '.join(sorted(unknown) or ['(none)']))
+    return {
+        "count": options['count'],
+        "msg_types": types,
+        "seed": options['seed'],
+        "obx": options['obx'],
+        "obr": options['obr'],
+        "nte": options['nte'],
+        "repetitions": options['repetitions'],
+        "field_length": options['field_length'],
+    }
+
+
+class Command(BaseCommand):
+    help = ("Write a deterministic synthetic HL7v2 corpus, one message per block "
+            "separated by blank lines.")
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser)
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the corpus to this file instead of stdout.')
+
+    def handle(self, *args, **options):
+        corpus = corpus_options(options)
+        out = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            for message in generate_messages(**corpus):
+                out.write(message.replace("\r", "\n") + "\n")
+        finally:
+            if options['output']:
+                out.close()
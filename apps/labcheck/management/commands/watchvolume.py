@@ -0,0 +1,86 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...records import field_text, parse_compact
+from ...volume import (DEFAULT_THRESHOLD, FAST_HALF_LIFE, MIN_RATE, SLOW_HALF_LIFE, WARMUP,
+                       VolumeMonitor, message_time)
+from .parsehl7 import expand_paths, open_messages
+
+
+class Command(BaseCommand):
+    help = ("Replay HL7v2 files through the volume monitor: top OBX-3 codes and decayed "
+            "message rates per sender, with an NDJSON alert when a rate drops or spikes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='HL7v2 files, glob patterns or directories.')
+        parser.add_argument(
+            '--output', '-o',
+            help='Write the alerts as NDJSON to this file instead of stdout.')
+        parser.add_argument(
+            '--report',
+            help='Write the rates and top codes per sender as JSON to this file at the end.')
+        parser.add_argument(
+            '--wall-clock', action='store_true',
+            help='Time messages by when they are read instead of by MSH-7.')
+        parser.add_argument(
+            '--threshold', type=float, default=DEFAULT_THRESHOLD,
+            help='Alert when a rate is this many times above or below its baseline.')
+        parser.add_argument(
+            '--fast-half-life', type=float, default=FAST_HALF_LIFE,
+            help='Half-life in seconds of the short term rates.')
+        parser.add_argument(
+            '--slow-half-life', type=float, default=SLOW_HALF_LIFE,
+            help='Half-life in seconds of the baseline rates.')
+        parser.add_argument(
+            '--warmup', type=float, default=WARMUP,
+            help='Seconds of traffic before anything alerts.')
+        parser.add_argument(
+            '--min-rate', type=float, default=MIN_RATE,
+            help='Baselines below this many messages or results per hour do not alert.')
+        parser.add_argument(
+            '--top', type=int, default=20,
+            help='Top codes tracked per sender.')
+        parser.add_argument(
+            '--max-senders', type=int, default=1000,
+            help='Senders tracked at once; the quietest is dropped beyond this.')
+
+    def handle(self, *args, **options):
+        monitor = VolumeMonitor(
+            top_k=options['top'], max_senders=options['max_senders'], threshold=options['threshold'],
+            fast_half_life=options['fast_half_life'], slow_half_life=options['slow_half_life'],
+            warmup=options['warmup'], min_rate=options['min_rate'])
+        out = open(options['output'], 'w') if options['output'] else None
+        alerts = errors = 0
+        now = None
+        try:
+            for path in expand_paths(options['paths']):
+                for offset, message in open_messages(path):
+                    try:
+                        results = parse_compact(message)
+                    except Exception as e:
+                        errors += 1
+                        self.stderr.write("%s@%d: %s: %s" % (path, offset, e.__class__.__name__, e))
+                        continue
+                    for result in results:
+                        if not options['wall_clock']:
+                            sent = message_time(field_text((result.get("message") or {}).get("timestamp")))
+                            # messages without a usable MSH-7 count at the time of the one before
+                            now = sent if sent is not None else now
+                        for alert in monitor.add(result, now):
+                            alerts += 1
+                            line = json.dumps(alert)
+                            if out:
+                                out.write(line + "\n")
+                            else:
+                                self.stdout.write(line)
+        finally:
+            if out:
+                out.close()
+        if options['report']:
+            with open(options['report'], 'w') as fh:
+                json.dump(monitor.report(now), fh, indent=2)
+        self.stderr.write("%d messages from %d senders, %d alerts, %d messages could not be parsed" % (
+            monitor.messages, len(monitor.senders), alerts, errors))
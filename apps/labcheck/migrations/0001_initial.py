@@ -0,0 +1,91 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(blank=True, help_text='File or peer the message came from.', max_length=500)),
+                ('offset', models.BigIntegerField(blank=True, help_text='Byte offset of the message in source.', null=True)),
+                ('msg_type', models.CharField(help_text='MSH-9.1', max_length=3)),
+                ('sub_msg_type', models.CharField(blank=True, help_text='MSH-9.2', max_length=3)),
+                ('control_id', models.CharField(blank=True, help_text='MSH-10', max_length=199)),
+                ('from_system', models.CharField(blank=True, help_text='MSH-3', max_length=227)),
+                ('from_location', models.CharField(blank=True, help_text='MSH-4, the sender.', max_length=227)),
+                ('to_system', models.CharField(blank=True, help_text='MSH-5', max_length=227)),
+                ('to_location', models.CharField(blank=True, help_text='MSH-6', max_length=227)),
+                ('timestamp', models.CharField(blank=True, help_text='MSH-7 as sent.', max_length=26)),
+                ('loaded', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['from_location', 'from_system'], name='labcheck_msg_sender_idx'), models.Index(fields=['control_id'], name='labcheck_msg_control_id_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(help_text='1 for the first OBR of the message.')),
+                ('set_id', models.CharField(blank=True, max_length=4)),
+                ('placer_order_number', models.CharField(blank=True, max_length=199)),
+                ('filler_order_number', models.CharField(blank=True, max_length=199)),
+                ('service_code', models.CharField(blank=True, help_text='OBR-4.1', max_length=50)),
+                ('service_text', models.CharField(blank=True, help_text='OBR-4.2', max_length=199)),
+                ('service_system', models.CharField(blank=True, help_text='OBR-4.3', max_length=20)),
+                ('observation_date_time', models.CharField(blank=True, max_length=26)),
+                ('result_status', models.CharField(blank=True, max_length=1)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='labcheck.message')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Observation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(help_text='1 for the first OBX of the message.')),
+                ('set_id', models.CharField(blank=True, max_length=4)),
+                ('value_type', models.CharField(blank=True, max_length=3)),
+                ('code', models.CharField(blank=True, help_text='OBX-3.1', max_length=50)),
+                ('code_text', models.CharField(blank=True, help_text='OBX-3.2', max_length=199)),
+                ('code_system', models.CharField(blank=True, help_text='OBX-3.3', max_length=20)),
+                ('value', models.TextField(blank=True, help_text='OBX-5')),
+                ('units', models.CharField(blank=True, help_text='OBX-6.1', max_length=50)),
+                ('reference_range', models.CharField(blank=True, max_length=60)),
+                ('abnormal_flags', models.CharField(blank=True, max_length=10)),
+                ('result_status', models.CharField(blank=True, max_length=1)),
+                ('observation_date_time', models.CharField(blank=True, max_length=26)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='labcheck.message')),
+                ('order', models.ForeignKey(blank=True, help_text='The OBR the OBX follows.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='labcheck.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['code', 'code_system'], name='labcheck_obs_code_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_id', models.CharField(blank=True, help_text='PID-3.1', max_length=199)),
+                ('assigning_authority', models.CharField(blank=True, help_text='PID-3.4', max_length=227)),
+                ('family_name', models.CharField(blank=True, max_length=194)),
+                ('given_name', models.CharField(blank=True, max_length=30)),
+                ('birthdate', models.CharField(blank=True, help_text='PID-7 as sent.', max_length=26)),
+                ('gender', models.CharField(blank=True, max_length=10)),
+                ('postal_code', models.CharField(blank=True, max_length=12)),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='patient', to='labcheck.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_id'], name='labcheck_patient_id_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labcheck', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('sender', models.CharField(help_text='MSH-4', max_length=227)),
+                ('msg_type', models.CharField(help_text='MSH-9.1^MSH-9.2', max_length=7)),
+                ('code', models.CharField(blank=True, help_text='OBX-3.1, empty for the message count.', max_length=50)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='day',
+            field=models.DateField(blank=True, help_text='Date of MSH-7, or of loading when that is not a date.', null=True),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='superseded',
+            field=models.BooleanField(default=False, help_text='A later corrected result (OBX-11 C) replaces this one.'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['day'], name='labcheck_msg_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailycount',
+            constraint=models.UniqueConstraint(fields=('day', 'sender', 'msg_type', 'code'), name='labcheck_dailycount_key'),
+        ),
+    ]
@@ -0,0 +1,232 @@
+"""asyncio MLLP listener for labcheck.
+
+Interface engines keep a connection open and send one framed message at a
+time, waiting for the ACK before sending the next. Each connection is
+served in order; parsing happens in a bounded executor and a connection
+stops being read while all worker slots are busy, so a fast sender is
+slowed down by TCP flow control instead of filling memory.
+"""
+import asyncio
+import itertools
+import json
+import time
+import uuid
+
+from .hl7reader import normalize_segments
+from .management.commands.parsehl7 import message_record
+from .volume import volume_summary
+
+
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\r"
+
+# largest frame accepted before the connection is dropped
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_control_ids = itertools.count(1)
+
+
+def frame(message):
+    """ wrap a message in MLLP start and end blocks """
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    return START_BLOCK + message + END_BLOCK
+
+
+def _escape(text, delimiters):
+    """ escape HL7 delimiters in free text with the \\F\\ style sequences """
+    field, component, repetition, esc, subcomponent = delimiters
+    text = text.replace(esc, "%sE%s" % (esc, esc))
+    for char, code in ((field, "F"), (component, "S"), (subcomponent, "T"), (repetition, "R")):
+        text = text.replace(char, "%s%s%s" % (esc, code, esc))
+    return text.replace("\r", " ").replace("\n", " ")
+
+
+def read_msh(message):
+    """ (delimiters, MSH fields) for the first segment, MSH-n is fields[n - 1] """
+    first = message.split("\r", 1)[0]
+    if not first.startswith("MSH") or len(first) < 8:
+        return "|^~\\&", ["MSH", "^~\\&"]
+    fields = first.split(first[3])
+    encoding = (fields[1] + "^~\\&"[len(fields[1]):])[:4]
+    return first[3] + encoding, fields
+
+
+def build_ack(message, code, text=""):
+    """ build an ACK for message with MSA-1 code (AA or AE) and optional MSA-3 text """
+    delimiters, msh = read_msh(message)
+    field, component = delimiters[0], delimiters[1]
+
+    def get(n):
+        return msh[n - 1] if len(msh) >= n else ""
+
+    trigger = get(9).split(component)
+    msh_9 = component.join(["ACK", trigger[1] if len(trigger) > 1 else ""]).rstrip(component)
+    header = [
+        "MSH", delimiters[1:], get(5), get(6), get(3), get(4),
+        time.strftime("%Y%m%d%H%M%S"), "", msh_9,
+        "%s%d" % (uuid.uuid4().hex[:12], next(_control_ids)),
+        get(11) or "P", get(12) or "2.5.1",
+    ]
+    msa = ["MSA", code, get(10)]
+    if text:
+        msa.append(_escape(text, delimiters))
+    return field.join(header) + "\r" + field.join(msa) + "\r"
+
+
+def ack_code(ack):
+    """ MSA-1 of an ACK message """
+    delimiters = read_msh(ack)[0]
+    for segment in ack.split("\r"):
+        if segment.startswith("MSA"):
+            fields = segment.split(delimiters[0])
+            return fields[1] if len(fields) > 1 else ""
+    return ""
+
+
+def handle_message(payload, peer=""):
+    """Validate and parse one framed payload.
+
+    Runs in the worker pool. Returns (ACK bytes, NDJSON record, accepted,
+    volume summary); the summary is volume.volume_summary of the parsed
+    message, or None, so the event loop never decodes the record again.
+    """
+    message = normalize_segments(payload).decode("utf-8", errors="replace")
+    record = message_record(message, peer=peer)
+    error = record.get("error")
+    if error:
+        ack = build_ack(message, "AE", error)
+    else:
+        ack = build_ack(message, "AA")
+    result = record.get("result")
+    summary = volume_summary(result) if result and not error else None
+    return frame(ack), json.dumps(record), not error, summary
+
+
+class MLLPServer(object):
+    """MLLP listener that ACKs every frame it receives.
+
+    ``executor`` runs handle_message; ``max_pending`` bounds how many frames
+    may be waiting on or running in it across all connections. Frames longer
+    than ``max_frame_size`` are skipped and rejected with an AE ACK, or AR
+    when not even their MSH can be read. Records are written as NDJSON
+    to ``output`` when one is given. With a volume.VolumeMonitor every
+    parsed message is counted on it and its alerts are written as NDJSON
+    to ``alerts``.
+    """
+
+    def __init__(self, executor, max_pending, output=None, monitor=None, alerts=None,
+                 max_frame_size=MAX_FRAME_SIZE):
+        self.executor = executor
+        self.max_frame_size = max_frame_size
+        self.slots = asyncio.Semaphore(max_pending)
+        self.output = output
+        self.monitor = monitor
+        self.alerts = alerts
+        self.connections = 0
+        self.accepted = 0
+        self.errors = 0
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port, limit=self.max_frame_size)
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+        peer = "%s:%s" % tuple(peer[:2]) if peer else ""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(END_BLOCK)
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError as e:
+                    # the sender would retransmit a dropped frame forever, so it gets an answer
+                    try:
+                        ack, size = await self.skip_frame(reader, e.consumed)
+                    except asyncio.IncompleteReadError:
+                        break
+                    self.errors += 1
+                    if self.output:
+                        record = {"peer": peer, "error": "frame too large: %d bytes" % size}
+                        self.output.write(json.dumps(record) + "\n")
+                    writer.write(ack)
+                    await writer.drain()
+                    continue
+                payload = data[data.find(START_BLOCK) + 1:-len(END_BLOCK)]
+                async with self.slots:
+                    ack, record, accepted, summary = await loop.run_in_executor(
+                        self.executor, handle_message, payload, peer)
+                if accepted:
+                    self.accepted += 1
+                else:
+                    self.errors += 1
+                if self.output:
+                    self.output.write(record + "\n")
+                if summary is not None and self.monitor is not None:
+                    self.write_alerts(self.monitor.count(*summary))
+                writer.write(ack)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # peer went away, or the listener is shutting down
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def skip_frame(self, reader, consumed):
+        """Read past the end block of a frame longer than max_frame_size.
+
+        consumed is what LimitOverrunError says can be read without the end
+        block. Returns (ACK bytes, frame size); raises IncompleteReadError if
+        the connection ends first.
+        """
+        head = await reader.readexactly(consumed)
+        size = len(head)
+        while True:
+            try:
+                size += len(await reader.readuntil(END_BLOCK))
+                break
+            except asyncio.LimitOverrunError as e:
+                size += len(await reader.readexactly(e.consumed))
+        start = head.find(START_BLOCK) + 1
+        msh = normalize_segments(head[start:start + 65536]).decode("utf-8", errors="replace")
+        msh = msh.split("\r", 1)[0]
+        text = "frame too large: more than %d bytes" % self.max_frame_size
+        if msh.startswith("MSH") and len(msh) >= 8:
+            return frame(build_ack(msh + "\r", "AE", text)), size
+        return frame(build_ack("", "AR", text)), size
+
+    def write_alerts(self, alerts):
+        if self.alerts:
+            for alert in alerts:
+                self.alerts.write(json.dumps(alert) + "\n")
+
+    async def watch_volumes(self):
+        """ run the monitor's checks on a timer, so senders that went quiet are noticed """
+        while True:
+            await asyncio.sleep(self.monitor.check_interval)
+            self.write_alerts(self.monitor.check())
+
+    def stats(self):
+        return {"connections": self.connections, "accepted": self.accepted, "errors": self.errors}
+
+
+async def send_messages(host, port, messages):
+    """ send messages over one connection, waiting for each ACK; returns the MSA-1 codes """
+    reader, writer = await asyncio.open_connection(host, port, limit=MAX_FRAME_SIZE)
+    codes = []
+    try:
+        for message in messages:
+            writer.write(frame(message))
+            await writer.drain()
+            ack = await reader.readuntil(END_BLOCK)
+            codes.append(ack_code(ack.strip(START_BLOCK + END_BLOCK).decode("utf-8", errors="replace")))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return codes
@@ -1,3 +1,113 @@
 from django.db import models
 
-# Create your models here.
+
+# Parsed HL7v2 messages, loaded by loader.MessageLoader (the loadhl7 command).
+# Field names follow the parse_message output; coded fields are split into
+# code, text and coding system so they can be indexed and grouped on.
+
+class Message(models.Model):
+    source = models.CharField(max_length=500, blank=True, help_text="File or peer the message came from.")
+    offset = models.BigIntegerField(null=True, blank=True, help_text="Byte offset of the message in source.")
+    msg_type = models.CharField(max_length=3, help_text="MSH-9.1")
+    sub_msg_type = models.CharField(max_length=3, blank=True, help_text="MSH-9.2")
+    control_id = models.CharField(max_length=199, blank=True, help_text="MSH-10")
+    from_system = models.CharField(max_length=227, blank=True, help_text="MSH-3")
+    from_location = models.CharField(max_length=227, blank=True, help_text="MSH-4, the sender.")
+    to_system = models.CharField(max_length=227, blank=True, help_text="MSH-5")
+    to_location = models.CharField(max_length=227, blank=True, help_text="MSH-6")
+    timestamp = models.CharField(max_length=26, blank=True, help_text="MSH-7 as sent.")
+    day = models.DateField(null=True, blank=True, help_text="Date of MSH-7, or of loading when that is not a date.")
+    loaded = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["from_location", "from_system"], name="labcheck_msg_sender_idx"),
+            models.Index(fields=["control_id"], name="labcheck_msg_control_id_idx"),
+            models.Index(fields=["day"], name="labcheck_msg_day_idx"),
+        ]
+
+    def __str__(self):
+        return f'{self.msg_type}^{self.sub_msg_type} {self.control_id} from {self.from_location}'
+
+
+class Patient(models.Model):
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name="patient")
+    patient_id = models.CharField(max_length=199, blank=True, help_text="PID-3.1")
+    assigning_authority = models.CharField(max_length=227, blank=True, help_text="PID-3.4")
+    family_name = models.CharField(max_length=194, blank=True)
+    given_name = models.CharField(max_length=30, blank=True)
+    birthdate = models.CharField(max_length=26, blank=True, help_text="PID-7 as sent.")
+    gender = models.CharField(max_length=10, blank=True)
+    postal_code = models.CharField(max_length=12, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient_id"], name="labcheck_patient_id_idx"),
+        ]
+
+    def __str__(self):
+        return self.patient_id
+
+
+class Order(models.Model):
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="orders")
+    position = models.PositiveIntegerField(help_text="1 for the first OBR of the message.")
+    set_id = models.CharField(max_length=4, blank=True)
+    placer_order_number = models.CharField(max_length=199, blank=True)
+    filler_order_number = models.CharField(max_length=199, blank=True)
+    service_code = models.CharField(max_length=50, blank=True, help_text="OBR-4.1")
+    service_text = models.CharField(max_length=199, blank=True, help_text="OBR-4.2")
+    service_system = models.CharField(max_length=20, blank=True, help_text="OBR-4.3")
+    observation_date_time = models.CharField(max_length=26, blank=True)
+    result_status = models.CharField(max_length=1, blank=True)
+
+    def __str__(self):
+        return f'{self.service_code} {self.service_text}'
+
+
+class Observation(models.Model):
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="observations")
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True,
+                              related_name="observations", help_text="The OBR the OBX follows.")
+    position = models.PositiveIntegerField(help_text="1 for the first OBX of the message.")
+    set_id = models.CharField(max_length=4, blank=True)
+    value_type = models.CharField(max_length=3, blank=True)
+    code = models.CharField(max_length=50, blank=True, help_text="OBX-3.1")
+    code_text = models.CharField(max_length=199, blank=True, help_text="OBX-3.2")
+    code_system = models.CharField(max_length=20, blank=True, help_text="OBX-3.3")
+    value = models.TextField(blank=True, help_text="OBX-5")
+    units = models.CharField(max_length=50, blank=True, help_text="OBX-6.1")
+    reference_range = models.CharField(max_length=60, blank=True)
+    abnormal_flags = models.CharField(max_length=10, blank=True)
+    result_status = models.CharField(max_length=1, blank=True)
+    observation_date_time = models.CharField(max_length=26, blank=True)
+    superseded = models.BooleanField(default=False, help_text="A later corrected result (OBX-11 C) replaces this one.")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["code", "code_system"], name="labcheck_obs_code_idx"),
+        ]
+
+    def __str__(self):
+        return f'{self.code} {self.value}'
+
+
+class DailyCount(models.Model):
+    """Daily volume per sender, message type and OBX-3 code, kept up to date by the loader.
+
+    Rows with an empty code count messages, the others count the current
+    (not superseded) observations with that code.
+    """
+    day = models.DateField()
+    sender = models.CharField(max_length=227, help_text="MSH-4")
+    msg_type = models.CharField(max_length=7, help_text="MSH-9.1^MSH-9.2")
+    code = models.CharField(max_length=50, blank=True, help_text="OBX-3.1, empty for the message count.")
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "sender", "msg_type", "code"], name="labcheck_dailycount_key"),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.sender} {self.msg_type} {self.code or "messages"}: {self.count}'
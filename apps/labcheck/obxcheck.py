@@ -0,0 +1,145 @@
+"""Batch data-quality checks on numeric OBX results.
+
+Values (OBX-5), reference ranges (OBX-7) and abnormal flags (OBX-8) from
+many parsed messages are collected into NumPy arrays and checked against
+each other in a few vectorized passes. Ranges and values repeat heavily in
+real feeds, so each distinct string is parsed once and the result is
+broadcast back with np.unique.
+
+Only NM observations are checked. A value is out of range when it is
+outside the bounds of its reference range. An out-of-range value is
+reported as missing a flag when OBX-8 is empty or N, and a flag
+contradicts the range when it points the other way (H on a low value, L
+on a high one) or marks a value that is within its range as high or low.
+"""
+import re
+
+import numpy as np
+
+
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)"
+_BETWEEN = re.compile(r"^\s*(%s)\s*-\s*(%s)\s*$" % (_NUMBER, _NUMBER))
+_BOUND = re.compile(r"^\s*(<=|>=|<|>)\s*(%s)\s*$" % _NUMBER)
+
+HIGH_FLAGS = ("H", "HH", ">")
+LOW_FLAGS = ("L", "LL", "<")
+NORMAL_FLAGS = ("", "N")
+
+SUMMARY_KEYS = ("observations", "numeric", "with_range", "out_of_range",
+                "missing_flag", "contradicting_flag")
+
+
+def parse_range(text):
+    """Parse a reference range into (low, high, low inclusive, high inclusive).
+
+    Understands "3.5-5.0", "<10", "<=10", ">1" and ">=1"; open ends are
+    -inf or inf. Anything else gives NaN bounds.
+    """
+    match = _BETWEEN.match(text)
+    if match:
+        return float(match.group(1)), float(match.group(2)), True, True
+    match = _BOUND.match(text)
+    if match:
+        op, bound = match.group(1), float(match.group(2))
+        if op[0] == "<":
+            return -np.inf, bound, True, op == "<="
+        return bound, np.inf, op == ">=", True
+    return np.nan, np.nan, True, True
+
+
+def _to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def parse_ranges(ranges):
+    """ vectorized parse_range over an array of strings, returns four arrays """
+    unique, inverse = np.unique(np.asarray(ranges, dtype=str), return_inverse=True)
+    parsed = [parse_range(text) for text in unique]
+    low = np.array([p[0] for p in parsed], dtype=float)
+    high = np.array([p[1] for p in parsed], dtype=float)
+    low_inclusive = np.array([p[2] for p in parsed], dtype=bool)
+    high_inclusive = np.array([p[3] for p in parsed], dtype=bool)
+    return low[inverse], high[inverse], low_inclusive[inverse], high_inclusive[inverse]
+
+
+def parse_values(values):
+    """ numeric OBX-5 values as a float array, NaN where not a number """
+    unique, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return np.array([_to_float(text) for text in unique], dtype=float)[inverse]
+
+
+def _scalar(value):
+    """ first component of a parsed field, which may be a nested list or tuple """
+    while isinstance(value, (list, tuple)):
+        value = value[0] if value else ""
+    return "" if value is None else str(value)
+
+
+class ObservationBatch(object):
+    """Collect OBX results from parse_message output for check().
+
+    add() takes one parsed message, the dict parse_message returns (or the
+    "result" of an NDJSON record) or a records.CompactMessage. Results are
+    grouped by sender, MSH-4, falling back to MSH-3.
+    """
+
+    def __init__(self):
+        self.senders = []
+        self.value_types = []
+        self.values = []
+        self.ranges = []
+        self.flags = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, result):
+        header = result.get("message") or {}
+        sender = header.get("from_location") or header.get("from_system") or ""
+        for observation in result.get("observations") or ():
+            self.senders.append(sender)
+            self.value_types.append(_scalar(observation.get("value_type")))
+            self.values.append(_scalar(observation.get("observation_value")))
+            self.ranges.append(_scalar(observation.get("references_range")))
+            self.flags.append(_scalar(observation.get("abnormal_flags")).strip().upper())
+
+    def check(self):
+        """ boolean arrays for each check, see SUMMARY_KEYS, plus the sender array """
+        values = parse_values(self.values)
+        low, high, low_inclusive, high_inclusive = parse_ranges(self.ranges)
+        flags = np.asarray(self.flags, dtype=str)
+
+        numeric = (np.asarray(self.value_types, dtype=str) == "NM") & ~np.isnan(values)
+        with_range = numeric & ~np.isnan(low)
+        with np.errstate(invalid="ignore"):
+            below = with_range & np.where(low_inclusive, values < low, values <= low)
+            above = with_range & np.where(high_inclusive, values > high, values >= high)
+        out_of_range = below | above
+        flagged_high = np.isin(flags, HIGH_FLAGS)
+        flagged_low = np.isin(flags, LOW_FLAGS)
+        unflagged = np.isin(flags, NORMAL_FLAGS)
+        in_range = with_range & ~out_of_range
+        return {
+            "senders": np.asarray(self.senders, dtype=str),
+            "observations": np.ones(len(values), dtype=bool),
+            "numeric": numeric,
+            "with_range": with_range,
+            "out_of_range": out_of_range,
+            "missing_flag": out_of_range & unflagged,
+            "contradicting_flag": ((above & flagged_low) | (below & flagged_high)
+                                   | (in_range & (flagged_high | flagged_low))),
+        }
+
+    def summary(self):
+        """ {sender: {check: count}} with a count for every key in SUMMARY_KEYS """
+        if not self.values:
+            return {}
+        checks = self.check()
+        senders, inverse = np.unique(checks["senders"], return_inverse=True)
+        counts = {key: np.bincount(inverse, weights=checks[key], minlength=len(senders))
+                  for key in SUMMARY_KEYS}
+        return {sender: {key: int(counts[key][i]) for key in SUMMARY_KEYS}
+                for i, sender in enumerate(senders.tolist())}
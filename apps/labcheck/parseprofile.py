@@ -0,0 +1,225 @@
+"""Opt-in instrumentation for the labcheck parser.
+
+When enabled, parse_message and validate_and_parse time each stage of a
+message (tokenizing, the MSH header, the patient identity and every
+fieldmaps section) and count segments, OBX segments, extracted fields and
+the IndexError/KeyError cases the extraction quietly steps over. Totals are
+kept per message type. A fraction of messages can also be run under
+cProfile to see where inside a stage the time goes.
+
+While disabled the parser only checks ``PROFILER.enabled`` once per message.
+
+The profilehl7 command enables it for one run. To sample a live process
+instead (the web views, the MLLP listener or parsehl7 and its workers),
+set LABCHECK_CPROFILE_SAMPLE to the fraction of messages to profile; with
+LABCHECK_CPROFILE_DIR set as well, every process dumps its samples to
+<dir>/<pid>.pstats, and pstats.Stats(*paths) merges the dumps.
+"""
+import atexit
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+
+SAMPLE_VARIABLE = "LABCHECK_CPROFILE_SAMPLE"
+DIR_VARIABLE = "LABCHECK_CPROFILE_DIR"
+
+logger = logging.getLogger(__name__)
+
+
+def environ_sample(environ):
+    """ the LABCHECK_CPROFILE_SAMPLE fraction of an environment, 0 when unset; raises ValueError """
+    value = environ.get(SAMPLE_VARIABLE, "").strip()
+    try:
+        sample = float(value) if value else 0.0
+    except ValueError:
+        sample = -1.0
+    if not 0.0 <= sample <= 1.0:
+        raise ValueError("%s must be a fraction between 0 and 1, got %r" % (SAMPLE_VARIABLE, value))
+    return sample
+
+
+class MessageStats(object):
+    """Stage timings and counters for a single message.
+
+    Used as a context manager around one parse: the message is recorded
+    with the profiler on exit, as failed if an exception escaped.
+    """
+
+    __slots__ = ("profiler", "msg_type", "stages", "segments", "obx", "fields",
+                 "exceptions", "profile")
+
+    def __init__(self, profiler, profile=None):
+        self.profiler = profiler
+        self.msg_type = "unknown"
+        self.stages = {}
+        self.segments = 0
+        self.obx = 0
+        self.fields = 0
+        self.exceptions = 0
+        self.profile = profile
+
+    def __enter__(self):
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profile is not None:
+            self.profile.disable()
+        self.profiler.record(self, failed=exc_type is not None)
+        return False
+
+    def timed(self, stage, func, *args):
+        """ call func(*args), adding the time it took to stage """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+
+
+class ParseProfiler(object):
+    """Aggregate MessageStats per message type.
+
+    ``cprofile_sample`` is the fraction of messages, from 0 to 1, that also
+    run under cProfile; their profiles are merged into one pstats.Stats.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_sample = 0.0
+        self.dump_dir = None
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def configure(self, environ=None):
+        """Enable sampling from LABCHECK_CPROFILE_SAMPLE and LABCHECK_CPROFILE_DIR.
+
+        Bad values in an explicit environ raise ValueError or OSError. Read
+        from os.environ, as on import, they are logged as a warning and
+        profiling stays off: an optional setting must not stop the app.
+        """
+        if environ is not None:
+            return self._configure(environ)
+        try:
+            self._configure(os.environ)
+        except (ValueError, OSError) as e:
+            self.disable()
+            self.dump_dir = None
+            logger.warning("parse profiling left off: %s", e)
+
+    def _configure(self, environ):
+        sample = environ_sample(environ)
+        if not sample:
+            return
+        dump_dir = environ.get(DIR_VARIABLE) or None
+        if dump_dir:
+            os.makedirs(dump_dir, exist_ok=True)
+        self.enable(cprofile_sample=sample)
+        self.dump_dir = dump_dir
+        if dump_dir:
+            atexit.register(self.dump)
+            # a forked worker starts from nothing, not from its parent's samples
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self, cprofile_sample=0.0):
+        if not 0.0 <= cprofile_sample <= 1.0:
+            raise ValueError("cprofile_sample must be between 0 and 1, got %r" % cprofile_sample)
+        self.cprofile_sample = cprofile_sample
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.types = {}
+            self.pstats = None
+            self.profiled = 0
+
+    def message(self):
+        """ MessageStats for the next message, sampled for cProfile """
+        profile = None
+        if self.cprofile_sample and self._random.random() < self.cprofile_sample:
+            profile = cProfile.Profile()
+        return MessageStats(self, profile)
+
+    def record(self, stats, failed=False):
+        with self._lock:
+            totals = self.types.get(stats.msg_type)
+            if totals is None:
+                totals = self.types[stats.msg_type] = {
+                    "messages": 0, "failed": 0, "segments": 0, "obx": 0, "fields": 0,
+                    "exceptions": 0, "stages": defaultdict(float)}
+            totals["messages"] += 1
+            totals["failed"] += failed
+            totals["segments"] += stats.segments
+            totals["obx"] += stats.obx
+            totals["fields"] += stats.fields
+            totals["exceptions"] += stats.exceptions
+            for stage, seconds in stats.stages.items():
+                totals["stages"][stage] += seconds
+            if stats.profile is not None:
+                self.profiled += 1
+                if self.pstats is None:
+                    self.pstats = pstats.Stats(stats.profile)
+                else:
+                    self.pstats.add(stats.profile)
+
+    def report(self, descriptions=None):
+        """Totals per message type as plain data.
+
+        ``descriptions`` maps a message type such as "ORU^R01" to the text
+        included in its entry.
+        """
+        descriptions = descriptions or {}
+        report = {}
+        with self._lock:
+            for msg_type, totals in sorted(self.types.items()):
+                messages = totals["messages"]
+                report[msg_type] = {
+                    "description": descriptions.get(msg_type, ""),
+                    "messages": messages,
+                    "failed": totals["failed"],
+                    "segments": totals["segments"],
+                    "obx": totals["obx"],
+                    "fields": totals["fields"],
+                    "exceptions": totals["exceptions"],
+                    "stages": {stage: {"total_ms": round(seconds * 1000, 3),
+                                       "mean_us": round(seconds * 1e6 / messages, 2)}
+                               for stage, seconds in totals["stages"].items()},
+                }
+        return report
+
+    def dump(self):
+        """ write the merged samples to <dump_dir>/<pid>.pstats; returns the path, or None """
+        with self._lock:
+            if self.dump_dir is None or self.pstats is None:
+                return None
+            path = os.path.join(self.dump_dir, "%d.pstats" % os.getpid())
+            self.pstats.dump_stats(path)
+            return path
+
+    def format_pstats(self, sort="cumulative", limit=25):
+        """ the merged cProfile statistics as text, or "" if nothing was sampled """
+        if self.pstats is None:
+            return ""
+        out = io.StringIO()
+        self.pstats.stream = out
+        self.pstats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+PROFILER = ParseProfiler()
+PROFILER.configure()
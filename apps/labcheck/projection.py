@@ -0,0 +1,104 @@
+"""Sparse fieldsets for parse_message output.
+
+A projection such as ``message,patient_identity,observations.observation_identifier``
+names the top level sections to return and, after a dot, single keys
+within a section. A bare section name keeps the whole section. The
+projection is pushed down into extraction: sections nobody asked for are
+never extracted, and the fieldmaps sections compile extractors that only
+touch the requested fields.
+
+Projections are parsed and compiled once per distinct spec string.
+"""
+from functools import lru_cache
+
+from .codeindex import CHECKED_FIELDS
+from .fieldmaps import SECTIONS, compile_fields
+
+HEADER_KEYS = ("msg_type", "sub_msg_type", "msg_description", "id", "from_system",
+               "from_location", "to_system", "to_location", "timestamp")
+
+PATIENT_KEYS = ("sub", "given_name", "family_name", "phone_number", "language", "marital_status",
+                "gender", "birthdate", "address", "document")
+
+# output keys of every top level section, None when it has no selectable keys
+SECTION_KEYS = dict(
+    [("message", HEADER_KEYS), ("patient_identity", PATIENT_KEYS)]
+    + [(name, tuple(row[3] for row in field_map)) for name, segment_id, repeats, field_map in SECTIONS]
+    + [("code_issues", None)])
+
+
+class ProjectionError(ValueError):
+    """ the fields parameter names an unknown section or key """
+
+
+class Projection(object):
+    """A parsed fields parameter.
+
+    sections maps each requested section to the frozenset of its requested
+    keys, or None for all of them. extractors is SECTION_EXTRACTORS cut down
+    to the requested fieldmaps sections, plus the code fields code_issues
+    reads; trim() removes those helpers again once code_issues is built.
+    """
+
+    def __init__(self, spec, sections):
+        self.spec = spec
+        self.sections = sections
+        needed = dict(sections)
+        if "code_issues" in sections:
+            for name, key, segment_id, field in CHECKED_FIELDS:
+                if name not in needed:
+                    needed[name] = frozenset([key])
+                elif needed[name] is not None:
+                    needed[name] = needed[name] | {key}
+        self.extractors = tuple(
+            (name, segment_id, repeats, compile_fields(field_map, needed[name]))
+            for name, segment_id, repeats, field_map in SECTIONS if name in needed)
+        self.helpers = tuple((name, needed[name] - (sections.get(name) or frozenset()))
+                             for name in needed
+                             if name != "code_issues" and needed[name] is not None
+                             and needed[name] != sections.get(name))
+
+    def __contains__(self, section):
+        return section in self.sections
+
+    def trim(self, message):
+        """ drop unrequested keys from the header and patient and the code_issues helpers, in place """
+        for name in ("message", "patient_identity"):
+            keys = self.sections.get(name)
+            if keys is not None and name in message:
+                message[name] = {k: v for k, v in message[name].items() if k in keys}
+        for name, extra in self.helpers:
+            if name not in self.sections:
+                message.pop(name, None)
+            elif name in message:
+                entries = message[name] if isinstance(message[name], list) else [message[name]]
+                for entry in entries:
+                    for key in extra:
+                        entry.pop(key, None)
+        return message
+
+
+@lru_cache(maxsize=256)
+def parse_projection(spec):
+    """ Projection for a comma separated fields parameter; raises ProjectionError """
+    sections = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, key = item.partition(".")
+        if name not in SECTION_KEYS:
+            raise ProjectionError("unknown section %r, expected one of %s" % (
+                name, ", ".join(SECTION_KEYS)))
+        if not key:
+            sections[name] = None
+            continue
+        if SECTION_KEYS[name] is None or key not in SECTION_KEYS[name]:
+            raise ProjectionError("unknown field %r in %s" % (key, name))
+        if name not in sections:
+            sections[name] = frozenset([key])
+        elif sections[name] is not None:
+            sections[name] = sections[name] | {key}
+    if not sections:
+        raise ProjectionError("no fields requested")
+    return Projection(spec, sections)
@@ -0,0 +1,170 @@
+"""Compact parse results for batch work.
+
+parse_message returns nested dicts that repeat every key in every OBX and
+OBR, and keeps the hl7 containers the values were read from. Code that
+holds many results at once (aggregation, batch checks) can use
+parse_compact instead: each section is a tuple-backed record with no per
+instance dict, values are plain strings and tuples, and short strings are
+interned so repeated codes, units and flags are stored once.
+
+Records answer get() like the dicts they replace, so readers of
+parse_message output such as codeindex.code_issues and
+obxcheck.ObservationBatch work on them unchanged. as_dict() gives the
+parse_message shape at serialization time; tuples serialize to the same
+JSON as the lists they replace.
+"""
+import sys
+from collections import namedtuple
+
+from .codeindex import code_issues, default_index
+from .fieldmaps import SECTIONS, compile_record
+from .management.commands.parsehl7 import extract_header, extract_patient, index_segments
+from .projection import HEADER_KEYS, PATIENT_KEYS
+
+# strings up to this length are interned
+INTERN_LENGTH = 32
+
+
+def freeze(value):
+    """ value with hl7 containers and lists turned into tuples of interned strings """
+    if isinstance(value, str):
+        if len(value) > INTERN_LENGTH:
+            return value
+        return sys.intern(value if type(value) is str else str(value))
+    if isinstance(value, list):
+        return tuple([freeze(v) for v in value])
+    if isinstance(value, dict):
+        return {key: freeze(v) for key, v in value.items()}
+    return value
+
+
+def field_text(value, separators="^&"):
+    """ a parsed field value back as text, components joined with ^ and subcomponents with & """
+    if isinstance(value, (list, tuple)):
+        separator = separators[0] if separators else ""
+        return separator.join([field_text(v, separators[1:]) for v in value])
+    return "" if value is None else str(value)
+
+
+def component(value, position):
+    """ component position (0 based) of a parsed field value as text """
+    if not isinstance(value, (list, tuple)):
+        return field_text(value) if position == 0 else ""
+    if position >= len(value):
+        return ""
+    return field_text(value[position], "&")
+
+
+def _get(self, key, default=None):
+    position = self._positions.get(key)
+    return default if position is None else self[position]
+
+
+def _as_dict(self):
+    return dict(zip(self._fields, self))
+
+
+def record_type(name, keys):
+    """ a namedtuple type with dict style get() and as_dict() """
+    base = namedtuple(name, keys)
+    return type(name, (base,), {
+        "__slots__": (),
+        "_positions": {key: i for i, key in enumerate(keys)},
+        "get": _get,
+        "as_dict": _as_dict,
+    })
+
+
+HeaderRecord = record_type("HeaderRecord", HEADER_KEYS)
+
+# record type of each fieldmaps section
+SECTION_RECORDS = {
+    name: record_type("".join(part.title() for part in name.split("_")) + "Record",
+                      [row[3] for row in field_map])
+    for name, segment_id, repeats, field_map in SECTIONS
+}
+
+SECTION_RECORD_EXTRACTORS = tuple(
+    (name, segment_id, repeats, compile_record(field_map, SECTION_RECORDS[name], freeze))
+    for name, segment_id, repeats, field_map in SECTIONS)
+
+
+class PatientRecord(object):
+    """ the patient_identity section; keys extract_patient leaves out stay unset """
+
+    __slots__ = PATIENT_KEYS
+
+    def __init__(self, fields):
+        for key, value in fields.items():
+            setattr(self, key, freeze(value))
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in _PATIENT_KEYS else default
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in PATIENT_KEYS if hasattr(self, key)}
+
+
+_PATIENT_KEYS = frozenset(PATIENT_KEYS)
+
+MESSAGE_SECTIONS = (("message", "patient_identity") + tuple(name for name, s, r, f in SECTIONS)
+                    + ("code_issues",))
+
+
+class CompactMessage(object):
+    """One parsed message. Sections the message does not have are None."""
+
+    __slots__ = MESSAGE_SECTIONS
+
+    def __init__(self):
+        for name in MESSAGE_SECTIONS:
+            setattr(self, name, None)
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in _MESSAGE_SECTIONS else None
+        return default if value is None else value
+
+    def as_dict(self):
+        """ the parse_message dict for this message """
+        result = {}
+        for name in MESSAGE_SECTIONS:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name == "code_issues":
+                result[name] = list(value)
+            elif name in _REPEATING:
+                result[name] = [entry.as_dict() for entry in value]
+            else:
+                result[name] = value.as_dict()
+        return result
+
+
+_MESSAGE_SECTIONS = frozenset(MESSAGE_SECTIONS)
+_REPEATING = frozenset(name for name, segment_id, repeats, field_map in SECTIONS if repeats)
+
+
+def compact_message(segments):
+    """ CompactMessage from a SegmentIndex, or None like parse_message when MSH-9 is empty """
+    msh = segments.segment('MSH')
+    if not str(msh[9][0][0]):
+        return None
+    record = CompactMessage()
+    record.message = HeaderRecord(**{key: freeze(value) for key, value in extract_header(msh).items()})
+    record.patient_identity = PatientRecord(extract_patient(segments.segment('PID')))
+    for name, segment_id, repeats, extract in SECTION_RECORD_EXTRACTORS:
+        try:
+            found = segments.segments(segment_id)
+        except KeyError:
+            continue
+        setattr(record, name, tuple([extract(s) for s in found]) if repeats else extract(found[0]))
+    index = default_index()
+    if index is not None:
+        record.code_issues = tuple(code_issues(record, index))
+    return record
+
+
+def parse_compact(message, fast=True):
+    """ parse_message returning CompactMessage records """
+    record = compact_message(index_segments(message, fast))
+    return [] if record is None else [record]
@@ -0,0 +1,204 @@
+"""Streaming PHI redaction of raw HL7v2 bytes.
+
+A mask such as ``PID-5,PID-7,PID-11.5,NK1`` names segment fields to
+redact: a field (PID-5), one component of every repetition of a field
+(PID-11.5), or a bare segment id for every field after the first, which is
+the set ID of the segments that repeat. Masks are compiled once per spec
+string. The masked segments are found with bytes.find on their ids, which
+runs at memory speed, and only they are split; every other byte is copied
+through untouched and nothing is parsed into an hl7 tree.
+
+Only the characters between delimiters change. Field, component,
+repetition and subcomponent separators and segment terminators stay
+where they were, so a redacted message splits exactly like the original.
+Without a key values are emptied; with one each value becomes a keyed
+pseudonym (HMAC-SHA256) of the same length, digits for digits and
+letters for everything else, so equal values stay equal across messages
+and runs without the key being recoverable from them.
+"""
+import hashlib
+import hmac
+import re
+from functools import lru_cache
+
+from .hl7reader import CHUNK_SIZE
+
+DEFAULT_MASK = "PID-3,PID-5,PID-6,PID-7,PID-11,PID-13,PID-14,PID-19,NK1"
+
+# pseudonyms remembered per Redactor; names and dates repeat a lot in a batch
+PSEUDONYM_CACHE = 65536
+
+_RULE = re.compile(r"^([A-Z][A-Z0-9]{2})(?:-([1-9][0-9]*)(?:\.([1-9][0-9]*))?)?$")
+
+# bytes that end a segment, MLLP framing included
+_TERMINATORS = frozenset(b"\r\n\x0b\x1c")
+
+_SEGMENT = re.compile(rb"[^\r\n\x0b\x1c]*")
+
+_LETTERS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_DIGITS = b"0123456789"
+
+
+class MaskError(ValueError):
+    """ the mask names something that is not a segment field """
+
+
+@lru_cache(maxsize=64)
+def compile_mask(spec):
+    """Parse a mask spec into {segment id: ((field, component or None), ...)}.
+
+    field is None for a bare segment id. Raises MaskError.
+    """
+    rules = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        match = _RULE.match(item)
+        if match is None:
+            raise MaskError("%r is not SEG, SEG-field or SEG-field.component" % item)
+        segment_id, field, position = match.groups()
+        if segment_id == "MSH" and (field is None or int(field) <= 2):
+            raise MaskError("%r: MSH-1 and MSH-2 hold the delimiters, name the MSH fields after them" % item)
+        rule = (int(field) if field else None, int(position) if position else None)
+        rules.setdefault(segment_id.encode(), []).append(rule)
+    if not rules:
+        raise MaskError("the mask is empty")
+    return {segment_id: tuple(segment_rules) for segment_id, segment_rules in rules.items()}
+
+
+class Redactor(object):
+    """Redact masked fields in a stream of HL7v2 bytes.
+
+    redact() takes data holding whole segments, in stream order, since the
+    delimiters of each message come from its MSH. stream() copies a binary
+    file to another one. stats counts the segments and values redacted.
+    """
+
+    def __init__(self, mask=DEFAULT_MASK, key=None):
+        self.rules = compile_mask(mask)
+        self.key = key
+        self._segment_ids = tuple(sorted(set(self.rules) | {b"MSH"}))
+        self._atoms = {}
+        self._set_delimiters(b"|", b"^~\\&")
+        if key is None:
+            self._replacement = b""
+        else:
+            pseudonym = lru_cache(maxsize=PSEUDONYM_CACHE)(self._pseudonym)
+            self._replacement = lambda match: pseudonym(match.group())
+        self.stats = {"segments": 0, "values": 0}
+
+    def _set_delimiters(self, field, encoding):
+        encoding = encoding[:4]
+        component, repetition = encoding[0:1] or b"^", encoding[1:2] or b"~"
+        subcomponent = encoding[3:4] or b"&"
+        self._delimiters = (field, component, repetition, subcomponent)
+        self._header = field + encoding
+        atoms = self._atoms.get(self._delimiters)
+        if atoms is None:
+            # runs of anything but a separator; the escape character is part of a value
+            atoms = self._atoms[self._delimiters] = re.compile(
+                b"[^%s]+" % re.escape(field + component + repetition + subcomponent))
+        self._atom = atoms
+
+    def redact(self, data):
+        """ data with the masked fields of its segments redacted """
+        starts = []
+        for segment_id in self._segment_ids:
+            i = data.find(segment_id)
+            while i >= 0:
+                if i == 0 or data[i - 1] in _TERMINATORS:
+                    starts.append(i)
+                i = data.find(segment_id, i + 3)
+        starts.sort()
+        pieces = []
+        last = 0
+        for start in starts:
+            end = _SEGMENT.match(data, start).end()
+            segment = data[start:end]
+            redacted = self._segment(segment)
+            if redacted is not segment:
+                pieces.append(data[last:start])
+                pieces.append(redacted)
+                last = end
+        if not pieces:
+            return data
+        pieces.append(data[last:])
+        return b"".join(pieces)
+
+    def stream(self, fh, out, chunk_size=CHUNK_SIZE):
+        """ copy binary stream fh to out redacted, chunk_size bytes at a time; returns bytes read """
+        pending = b""
+        read = 0
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            read += len(chunk)
+            data = pending + chunk
+            # only whole segments are redacted, the tail waits for the next chunk
+            end = max(data.rfind(b"\r"), data.rfind(b"\n"), data.rfind(b"\x1c")) + 1
+            if end:
+                out.write(self.redact(data[:end]))
+            pending = data[end:]
+        if pending:
+            out.write(self.redact(pending))
+        return read
+
+    def _segment(self, segment):
+        segment_id = segment[:3]
+        if segment_id == b"MSH" and len(segment) > 3 and not segment.startswith(self._header, 3):
+            self._set_delimiters(segment[3:4], segment[4:8].split(segment[3:4], 1)[0])
+        rules = self.rules.get(segment_id)
+        if rules is None:
+            return segment
+        separator, component, repetition = self._delimiters[:3]
+        if segment[3:4] != separator:
+            return segment
+        fields = segment.split(separator)
+        # MSH-1 is the field separator itself, so MSH-n is fields[n - 1]
+        shift = 1 if segment_id == b"MSH" else 0
+        redacted = 0
+        for field, position in rules:
+            if field is None:
+                targets = range(2, len(fields))
+            elif field - shift < len(fields):
+                targets = (field - shift,)
+            else:
+                continue
+            for i in targets:
+                if not fields[i]:
+                    continue
+                if position is None:
+                    fields[i] = self._atom.sub(self._replacement, fields[i])
+                else:
+                    fields[i] = repetition.join(
+                        [self._component(value, position - 1, component)
+                         for value in fields[i].split(repetition)])
+                redacted += 1
+        if not redacted:
+            return segment
+        self.stats["segments"] += 1
+        self.stats["values"] += redacted
+        return separator.join(fields)
+
+    def _component(self, value, position, component):
+        components = value.split(component)
+        if position < len(components) and components[position]:
+            components[position] = self._atom.sub(self._replacement, components[position])
+        return component.join(components)
+
+    def _pseudonym(self, value):
+        stream = b""
+        counter = 0
+        while len(stream) < len(value):
+            stream += hmac.new(self.key, value + counter.to_bytes(4, "big"), hashlib.sha256).digest()
+            counter += 1
+        return bytes([_DIGITS[r % 10] if 48 <= c <= 57 else _LETTERS[r % 26]
+                      for c, r in zip(value, stream)])
+
+
+def redact_text(message, mask=DEFAULT_MASK, key=None, encoding="utf-8"):
+    """ redact one message given as str, for logging or showing a message """
+    data = message.encode(encoding, errors="surrogateescape")
+    return Redactor(mask, key).redact(data).decode(encoding, errors="surrogateescape")
@@ -0,0 +1,163 @@
+"""Incrementally maintained daily counts (models.DailyCount).
+
+MessageLoader adds the counts of every chunk it writes in the same
+transaction, as deltas upserted on (day, sender, message type, code), so
+readers never GROUP BY the observation table. The day is the date of MSH-7,
+so results that arrive late land on the day they belong to.
+
+A corrected result (OBX-11 C) supersedes the earlier results for the same
+sender, filler order number (OBR-3) and OBX-3 code: they are flagged
+superseded and their counts subtracted, on whatever day they were counted.
+rebuild_day() recomputes one day from the base tables, for repairs or after
+bulk deletes.
+"""
+import datetime
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, F, Value
+from django.db.models.functions import Concat
+
+from .models import DailyCount, Message, Observation
+
+# DailyCount.code of the message count rows
+MESSAGE_CODE = ""
+
+CORRECTED = "C"
+
+
+def message_day(timestamp):
+    """ the date of an MSH-7 timestamp, None when it does not start with a valid YYYYMMDD """
+    if len(timestamp) < 8 or not timestamp[:8].isdigit():
+        return None
+    try:
+        return datetime.date(int(timestamp[:4]), int(timestamp[4:6]), int(timestamp[6:8]))
+    except ValueError:
+        return None
+
+
+def message_type(message):
+    return "%s^%s" % (message.msg_type, message.sub_msg_type)
+
+
+def chunk_counts(messages, observations):
+    """Count deltas for newly written rows: {(day, sender, type, code): count}.
+
+    Every message counts once under MESSAGE_CODE, every observation that is
+    not superseded once under its code; observations without a code are
+    not counted.
+    """
+    deltas = Counter()
+    for message in messages:
+        deltas[(message.day, message.from_location, message_type(message), MESSAGE_CODE)] += 1
+    for observation in observations:
+        if observation.code and not observation.superseded:
+            message = observation.message
+            deltas[(message.day, message.from_location, message_type(message), observation.code)] += 1
+    return deltas
+
+
+def correction_key(sender, filler_order_number, code):
+    return (sender, filler_order_number, code)
+
+
+def supersede(observations, using=DEFAULT_DB_ALIAS):
+    """Apply the corrections among observations about to be written.
+
+    Earlier results in the same list are flagged superseded in place; those
+    already stored are updated in one statement. Returns the count deltas
+    for the stored ones. Observations need their message and order set.
+    """
+    latest = {}
+    corrected = {}
+    for observation in observations:
+        if not observation.code or observation.order is None:
+            continue
+        key = correction_key(observation.message.from_location,
+                             observation.order.filler_order_number, observation.code)
+        if observation.result_status == CORRECTED:
+            for earlier in latest.pop(key, ()):
+                earlier.superseded = True
+            corrected[key] = observation
+        latest.setdefault(key, []).append(observation)
+    deltas = Counter()
+    if not corrected:
+        return deltas
+    stored = (Observation.objects.using(using)
+              .filter(superseded=False, code__in={key[2] for key in corrected},
+                      order__filler_order_number__in={key[1] for key in corrected},
+                      message__from_location__in={key[0] for key in corrected})
+              .values_list("pk", "code", "order__filler_order_number", "message__from_location",
+                           "message__day", "message__msg_type", "message__sub_msg_type"))
+    replaced = []
+    for pk, code, filler, sender, day, msg_type, sub_msg_type in stored:
+        if correction_key(sender, filler, code) in corrected:
+            replaced.append(pk)
+            deltas[(day, sender, "%s^%s" % (msg_type, sub_msg_type), code)] -= 1
+    if replaced:
+        Observation.objects.using(using).filter(pk__in=replaced).update(superseded=True)
+    return deltas
+
+
+def upsert_counts(deltas, using=DEFAULT_DB_ALIAS):
+    """Add deltas to DailyCount in one statement.
+
+    Uses INSERT ... ON CONFLICT DO UPDATE where the backend has it
+    (PostgreSQL, SQLite), otherwise reads the existing rows and writes them
+    back with bulk_update and bulk_create. Call inside a transaction.
+    """
+    deltas = [(key, delta) for key, delta in deltas.items() if delta]
+    if not deltas:
+        return
+    connection = connections[using]
+    if connection.vendor not in ("postgresql", "sqlite"):
+        return _upsert_portable(deltas, using)
+    table = connection.ops.quote_name(DailyCount._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(DailyCount._meta.get_field(name).column)
+                        for name in ("day", "sender", "msg_type", "code", "count"))
+    count = connection.ops.quote_name(DailyCount._meta.get_field("count").column)
+    key = columns.rsplit(", ", 1)[0]
+    sql = ("INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s) "
+           "ON CONFLICT (%s) DO UPDATE SET %s = %s.%s + excluded.%s" % (
+               table, columns, key, count, table, count, count))
+    adapt = connection.ops.adapt_datefield_value
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(adapt(day), sender, msg_type, code, delta)
+                                 for (day, sender, msg_type, code), delta in deltas])
+
+
+def _upsert_portable(deltas, using):
+    wanted = dict(deltas)
+    rows = DailyCount.objects.using(using).select_for_update().filter(
+        day__in={key[0] for key in wanted}, sender__in={key[1] for key in wanted})
+    existing = {}
+    for row in rows:
+        key = (row.day, row.sender, row.msg_type, row.code)
+        if key in wanted:
+            row.count += wanted.pop(key)
+            existing[key] = row
+    DailyCount.objects.using(using).bulk_update(existing.values(), ["count"])
+    DailyCount.objects.using(using).bulk_create(
+        [DailyCount(day=day, sender=sender, msg_type=msg_type, code=code, count=count)
+         for (day, sender, msg_type, code), count in wanted.items()])
+
+
+def rebuild_day(day, using=DEFAULT_DB_ALIAS):
+    """ recompute the DailyCount rows of one day from the messages and observations; returns the row count """
+    messages = (Message.objects.using(using).filter(day=day)
+                .values_list("from_location", Concat(F("msg_type"), Value("^"), F("sub_msg_type")))
+                .annotate(count=Count("pk")).order_by())
+    observations = (Observation.objects.using(using)
+                    .filter(message__day=day, superseded=False).exclude(code="")
+                    .values_list("message__from_location",
+                                 Concat(F("message__msg_type"), Value("^"), F("message__sub_msg_type")),
+                                 "code")
+                    .annotate(count=Count("pk")).order_by())
+    rows = [DailyCount(day=day, sender=sender, msg_type=type_, code=MESSAGE_CODE, count=count)
+            for sender, type_, count in messages]
+    rows += [DailyCount(day=day, sender=sender, msg_type=type_, code=code, count=count)
+             for sender, type_, code, count in observations]
+    with transaction.atomic(using=using):
+        DailyCount.objects.using(using).filter(day=day).delete()
+        DailyCount.objects.using(using).bulk_create(rows)
+    return len(rows)
@@ -0,0 +1,266 @@
+"""Message structure (segment order and grouping) validation.
+
+Structures are written in the abstract message syntax of the HL7 standard:
+``[X]`` is optional, ``{X}`` repeats one or more times, ``[{X}]`` is
+optional and repeating and ``<X|Y>`` is a choice. Each structure is
+compiled once into a deterministic automaton over segment ids (Thompson
+construction, then subset construction) and cached, so checking a message
+is one dict lookup per segment. The first segment with no transition is
+reported together with the segments that would have been accepted there.
+
+Z segments are site defined and skipped.
+"""
+import re
+from functools import lru_cache
+
+
+ADT_A01 = ("MSH [{SFT}] EVN PID [PD1] [{ROL}] [{NK1}] PV1 [PV2] [{ROL}] [{DB1}] [{OBX}] [{AL1}] "
+           "[{DG1}] [DRG] [{PR1 [{ROL}]}] [{GT1}] [{IN1 [IN2] [{IN3}] [{ROL}]}] [ACC] [UB1] [UB2] [PDA]")
+
+STRUCTURES = {
+    "ADT_A01": ADT_A01,
+    "ADT_A02": "MSH [{SFT}] EVN PID [PD1] [{ROL}] PV1 [PV2] [{ROL}] [{DB1}] [{OBX}] [PDA]",
+    "ADT_A03": ("MSH [{SFT}] EVN PID [PD1] [{ROL}] [{NK1}] PV1 [PV2] [{ROL}] [{DB1}] [{AL1}] [{DG1}] "
+                "[DRG] [{PR1 [{ROL}]}] [{OBX}] [{GT1}] [{IN1 [IN2] [{IN3}] [{ROL}]}] [ACC] [PDA]"),
+    "ADT_A05": ADT_A01.replace(" [PDA]", ""),
+    "ADT_A06": ADT_A01.replace("[{ROL}] [{NK1}]", "[{ROL}] [MRG] [{NK1}]").replace(" [PDA]", ""),
+    "ADT_A09": "MSH [{SFT}] EVN PID [PD1] PV1 [PV2] [{DB1}] [{OBX}] [{DG1}]",
+    "ADT_A15": "MSH [{SFT}] EVN PID [PD1] [{ROL}] PV1 [PV2] [{ROL}] [{DB1}] [{OBX}] [{DG1}]",
+    "ADT_A21": "MSH [{SFT}] EVN PID [PD1] PV1 [PV2] [{DB1}] [{OBX}]",
+    "ADT_A30": "MSH [{SFT}] EVN PID [PD1] MRG",
+    "ORU_R01": ("MSH [{SFT}] {[PID [PD1] [{NTE}] [{NK1}] [PV1 [PV2]]] "
+                "{[ORC] OBR [{NTE}] [{TQ1 [{TQ2}]}] [CTD] [{OBX [{NTE}]}] [{FT1}] [{CTI}] "
+                "[{SPM [{OBX}]}]}} [DSC]"),
+    "ORM_O01": ("MSH [{NTE}] [PID [PD1] [{NTE}] [PV1 [PV2]] [{IN1 [IN2] [IN3]}] [GT1] [{AL1}]] "
+                "{ORC [<OBR|RQD|RQ1|RXO|ODS|ODT> [{NTE}] [CTD] [{DG1}] [{OBX [{NTE}]}]] "
+                "[{FT1}] [{CTI}] [BLG]}"),
+    "VXU_V04": ("MSH [{SFT}] PID [PD1] [{NK1}] [PV1 [PV2]] [{GT1}] [{IN1 [IN2] [IN3]}] "
+                "[{ORC [{TQ1 [{TQ2}]}] RXA [RXR] [{OBX [{NTE}]}]}]"),
+}
+
+# MSH-9 type^trigger to structure, for the types in hl7_transaction_names
+MESSAGE_STRUCTURES = {
+    "ADT^A01": "ADT_A01", "ADT^A04": "ADT_A01", "ADT^A08": "ADT_A01", "ADT^A13": "ADT_A01",
+    "ADT^A02": "ADT_A02",
+    "ADT^A03": "ADT_A03",
+    "ADT^A05": "ADT_A05", "ADT^A28": "ADT_A05", "ADT^A31": "ADT_A05",
+    "ADT^A06": "ADT_A06", "ADT^A07": "ADT_A06",
+    "ADT^A09": "ADT_A09", "ADT^A10": "ADT_A09", "ADT^A11": "ADT_A09",
+    "ADT^A15": "ADT_A15",
+    "ADT^A21": "ADT_A21", "ADT^A29": "ADT_A21",
+    "ADT^A30": "ADT_A30",
+    "ORU^R01": "ORU_R01",
+    "ORM^O01": "ORM_O01",
+    "VXU^V04": "VXU_V04",
+}
+
+_TOKEN = re.compile(r"\s*(?:([A-Z0-9]{3})|([\[\]{}<>|]))")
+
+
+class GrammarError(ValueError):
+    """ a structure definition does not parse """
+
+
+def parse_grammar(text):
+    """Parse abstract message syntax into nested tuples.
+
+    Nodes are ("seg", id), ("seq", nodes), ("opt", node), ("rep", node) and
+    ("alt", nodes).
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if not match:
+            raise GrammarError("unexpected %r in structure at %d" % (text[position:position + 10], position))
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    node, end = _parse_sequence(tokens, 0, ())
+    if end != len(tokens):
+        raise GrammarError("unbalanced %r in structure" % tokens[end])
+    return node
+
+
+_CLOSING = {"[": "]", "{": "}", "<": ">"}
+
+
+def _parse_sequence(tokens, i, stop):
+    nodes = []
+    while i < len(tokens) and tokens[i] not in stop:
+        token = tokens[i]
+        if token in _CLOSING:
+            if token == "<":
+                choices = []
+                while True:
+                    node, i = _parse_sequence(tokens, i + 1, ("|", ">"))
+                    choices.append(node)
+                    if i >= len(tokens):
+                        raise GrammarError("missing >")
+                    if tokens[i] == ">":
+                        break
+                nodes.append(("alt", tuple(choices)))
+            else:
+                node, i = _parse_sequence(tokens, i + 1, (_CLOSING[token],))
+                if i >= len(tokens):
+                    raise GrammarError("missing %s" % _CLOSING[token])
+                nodes.append(("opt" if token == "[" else "rep", node))
+            i += 1
+        elif token in "]}>|":
+            raise GrammarError("unexpected %s" % token)
+        else:
+            nodes.append(("seg", token))
+            i += 1
+    return ("seq", tuple(nodes)), i
+
+
+class _NFA(object):
+    """ Thompson construction; epsilon edges are labelled None """
+
+    def __init__(self):
+        self.edges = []
+
+    def state(self):
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def build(self, node, start):
+        """ add node after start, returns its end state """
+        kind, value = node
+        if kind == "seg":
+            end = self.state()
+            self.edges[start].append((value, end))
+            return end
+        if kind == "seq":
+            for child in value:
+                start = self.build(child, start)
+            return start
+        if kind == "opt":
+            end = self.build(value, start)
+            self.edges[start].append((None, end))
+            return end
+        if kind == "rep":
+            entry = self.state()
+            self.edges[start].append((None, entry))
+            end = self.build(value, entry)
+            self.edges[end].append((None, entry))
+            return end
+        end = self.state()
+        for choice in value:
+            self.edges[self.build(choice, start)].append((None, end))
+        return end
+
+    def closure(self, states):
+        stack = list(states)
+        seen = set(states)
+        while stack:
+            for label, target in self.edges[stack.pop()]:
+                if label is None and target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+
+class Automaton(object):
+    """ deterministic automaton over segment ids, state 0 is the start """
+
+    def __init__(self, name, transitions, accepting):
+        self.name = name
+        self.transitions = transitions
+        self.accepting = accepting
+
+    def run(self, segment_ids):
+        """None when segment_ids is accepted, else (index, expected segment ids).
+
+        index is that of the first segment without a transition, or
+        len(segment_ids) when the message ends before the structure does.
+        """
+        transitions = self.transitions
+        state = 0
+        for i, segment_id in enumerate(segment_ids):
+            following = transitions[state].get(segment_id)
+            if following is None:
+                return i, sorted(transitions[state])
+            state = following
+        if state in self.accepting:
+            return None
+        return len(segment_ids), sorted(transitions[state])
+
+
+def compile_grammar(text, name=""):
+    """ compile a structure definition into an Automaton by subset construction """
+    nfa = _NFA()
+    start = nfa.state()
+    end = nfa.build(parse_grammar(text), start)
+    initial = nfa.closure([start])
+    states = {initial: 0}
+    pending = [initial]
+    transitions = [{}]
+    accepting = set()
+    while pending:
+        current = pending.pop()
+        number = states[current]
+        if end in current:
+            accepting.add(number)
+        moves = {}
+        for state in current:
+            for label, target in nfa.edges[state]:
+                if label is not None:
+                    moves.setdefault(label, set()).add(target)
+        for label, targets in moves.items():
+            following = nfa.closure(targets)
+            if following not in states:
+                states[following] = len(transitions)
+                transitions.append({})
+                pending.append(following)
+            transitions[number][label] = states[following]
+    return Automaton(name, transitions, frozenset(accepting))
+
+
+@lru_cache(maxsize=None)
+def automaton(structure):
+    """ the cached Automaton for a structure name in STRUCTURES """
+    return compile_grammar(STRUCTURES[structure], structure)
+
+
+def message_structure(message):
+    """ (structure name or None, "TYPE^TRIGGER") from MSH-9, preferring MSH-9.3 """
+    header = message.split("\r", 1)[0]
+    if not header.startswith("MSH") or len(header) < 8:
+        return None, ""
+    fields = header.split(header[3])
+    parts = fields[8].split(header[4]) if len(fields) > 8 else []
+    msg_type = "^".join(parts[:2])
+    if len(parts) > 2 and parts[2] in STRUCTURES:
+        return parts[2], msg_type
+    return MESSAGE_STRUCTURES.get(msg_type), msg_type
+
+
+def check_structure(message):
+    """Findings for segment order, in the same shape as conformance findings.
+
+    Empty when the message fits its structure. A message type without a
+    known structure gives a single warning.
+    """
+    structure, msg_type = message_structure(message)
+    if structure is None:
+        return [{"segment": "MSH", "sequence": 1, "field": 9, "component": None, "repetition": None,
+                 "severity": "warning", "code": "unknown_structure",
+                 "message": "no message structure known for %s" % (msg_type or "this message")}]
+    segments = [s[:3] for s in message.split("\r") if s.strip()]
+    sequence = [(i, s) for i, s in enumerate(segments, 1) if not s.startswith("Z")]
+    failure = automaton(structure).run([s for i, s in sequence])
+    if failure is None:
+        return []
+    index, expected = failure
+    if index < len(sequence):
+        number, segment_id = sequence[index]
+        text = "%s is out of place in %s" % (segment_id, structure)
+    else:
+        number, segment_id = None, None
+        text = "%s ended early" % structure
+    if expected:
+        text += ", expected %s" % " or ".join(expected)
+    return [{"segment": segment_id, "sequence": number, "field": None, "component": None,
+             "repetition": None, "severity": "error", "code": "structure", "message": text,
+             "expected": expected}]
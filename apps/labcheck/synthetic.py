@@ -0,0 +1,123 @@
+"""Deterministic synthetic HL7v2 messages for tests and benchmarks.
+
+The same seed and options always produce the same messages, so benchmark
+runs can be compared over time. Nothing here is real patient data.
+"""
+import random
+import string
+
+
+MESSAGE_TYPES = ("ADT", "ORU", "ORM", "VXU")
+
+TRIGGERS = {"ADT": "A01", "ORU": "R01", "ORM": "O01", "VXU": "V04"}
+
+_LOINC = ("6690-2^Wbc", "770-8^Neutros", "736-9^Lymphs", "718-7^Hgb", "4544-3^Hct",
+          "787-2^Mcv", "94500-6^SARS-CoV-2 RNA", "630-4^Bacteria", "2345-7^Glucose")
+_CVX = ("217^PFIZER 12 YEARS & UP SARS-COV-2", "141^Influenza, seasonal", "08^Hep B, adolescent or pediatric")
+_UNITS = ("/nl", "%", "g/dl", "fl", "mg/dl", "")
+_ALPHABET = string.ascii_uppercase + string.digits
+
+
+class MessageGenerator(object):
+    """Build synthetic messages from a seeded random.Random.
+
+    ``obx``, ``obr`` and ``nte`` set how many of those segments a message
+    gets (per order for OBX and NTE), ``repetitions`` how often repeating
+    PID fields repeat and ``field_length`` the length of free text values.
+    """
+
+    def __init__(self, seed=0, obx=5, obr=1, nte=0, repetitions=1, field_length=8):
+        self.rng = random.Random(seed)
+        self.obx = obx
+        self.obr = obr
+        self.nte = nte
+        self.repetitions = repetitions
+        self.field_length = field_length
+        self.count = 0
+
+    def text(self, length=None):
+        return "".join(self.rng.choice(_ALPHABET) for _ in range(length or self.field_length))
+
+    def digits(self, length):
+        return "".join(self.rng.choice(string.digits) for _ in range(length))
+
+    def timestamp(self):
+        return "20%02d%02d%02d%02d%02d%02d" % (
+            self.rng.randint(10, 25), self.rng.randint(1, 12), self.rng.randint(1, 28),
+            self.rng.randint(0, 23), self.rng.randint(0, 59), self.rng.randint(0, 59))
+
+    def message(self, msg_type="ORU"):
+        """ one message of msg_type as a string of \\r terminated segments """
+        self.count += 1
+        segments = [self.msh(msg_type)]
+        if msg_type == "ADT":
+            segments.append("EVN|%s|%s|||" % (TRIGGERS["ADT"], self.timestamp()))
+        segments.append(self.pid())
+        if msg_type != "VXU":
+            segments.append("PV1|1|%s|%s^^^%s||||%s^%s^%s" % (
+                self.rng.choice("OIE"), self.text(4), self.text(), self.digits(4), self.text(), self.text()))
+        if msg_type == "ORU":
+            for order in range(1, self.obr + 1):
+                segments.extend(self.order(order))
+                segments.extend(self.notes())
+                for set_id in range(1, self.obx + 1):
+                    segments.append(self.obx_segment(set_id))
+                    segments.extend(self.notes())
+        elif msg_type == "ORM":
+            for order in range(1, self.obr + 1):
+                segments.extend(self.order(order))
+                segments.extend(self.notes())
+        elif msg_type == "VXU":
+            segments.append("ORC|RE||%s" % self.digits(8))
+            segments.append("RXA|0|1|%s|%s|%s|0.3|ML" % (
+                self.timestamp(), self.timestamp(), self.rng.choice(_CVX).replace("&", "\\T\\")))
+            segments.append("RXR|IM^Intramuscular^HL70162|LD^Left Deltoid^HL70163")
+            for set_id in range(1, self.obx + 1):
+                segments.append(self.obx_segment(set_id))
+        return "\r".join(segments) + "\r"
+
+    def msh(self, msg_type):
+        return "MSH|^~\\&|%s|%s^%s^CLIA|RECEIVER|STATE_DOH|%s||%s^%s|%s%06d|P|2.5.1" % (
+            self.text(), self.text(), self.digits(10), self.timestamp(),
+            msg_type, TRIGGERS[msg_type], self.digits(6), self.count)
+
+    def pid(self):
+        identifiers = "~".join("%s^^^%s&%s&ISO^MR" % (self.digits(8), self.text(), self.digits(6))
+                               for _ in range(self.repetitions))
+        addresses = "~".join("%s %s ST^^%s^%s^%s" % (self.digits(3), self.text(), self.text(),
+                                                     self.text(2), self.digits(5))
+                             for _ in range(self.repetitions))
+        phones = "~".join("(%s)%s-%s" % (self.digits(3), self.digits(3), self.digits(4))
+                          for _ in range(self.repetitions))
+        return "PID|1||%s||%s^%s^%s||19%s%02d%02d|%s|||%s||%s|||||||%s" % (
+            identifiers, self.text(), self.text(), self.text(1), self.digits(2),
+            self.rng.randint(1, 12), self.rng.randint(1, 28), self.rng.choice("MFU"),
+            addresses, phones, self.digits(9))
+
+    def order(self, set_id):
+        placer = self.digits(8)
+        return [
+            "ORC|RE|%s|%s|||||||||%s^%s^%s" % (placer, self.digits(8), self.digits(4), self.text(), self.text()),
+            "OBR|%d|%s|%s|%s^LN|R||%s|||||||%s||%s^%s^%s||||||%s|||F" % (
+                set_id, placer, self.digits(8), self.rng.choice(_LOINC), self.timestamp(),
+                self.timestamp(), self.digits(4), self.text(), self.text(), self.timestamp()),
+        ]
+
+    def obx_segment(self, set_id):
+        low = self.rng.randint(0, 50)
+        high = low + self.rng.randint(1, 100)
+        value = self.rng.randint(0, 160)
+        flag = "H" if value > high else "L" if value < low else ""
+        return "OBX|%d|NM|%s^LN||%d|%s|%d-%d|%s|||F|||%s|%s^%s^CLIA" % (
+            set_id, self.rng.choice(_LOINC), value, self.rng.choice(_UNITS), low, high, flag,
+            self.timestamp(), self.digits(10), self.text())
+
+    def notes(self):
+        return ["NTE|%d|L|%s" % (i, self.text()) for i in range(1, self.nte + 1)]
+
+
+def generate_messages(count, msg_types=MESSAGE_TYPES, seed=0, **options):
+    """ yield count messages, cycling through msg_types """
+    generator = MessageGenerator(seed=seed, **options)
+    for i in range(count):
+        yield generator.message(msg_types[i % len(msg_types)])
@@ -1,7 +1,40 @@
-from django.test import TestCase, Client
+from django.db import IntegrityError, models
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from pathlib import Path
 import json
+import hl7
+import numpy as np
+import asyncio
+import io
+import os
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from unittest import mock
+from django.core.management import CommandError, call_command
+from .codeindex import CodeIndex, build_index
+from .conformance import ProfileError, compile_profile, load_profile
+from .dedup import Deduplicator
+from .fieldmaps import OBX_FIELDS, compile_fields
+from .fieldstats import CorpusProfile, HyperLogLog, value_hash
+from .linkage import Linker, bit_counts, byte_bit_counts, connected_components, soundex
+from .hl7reader import SegmentNormalizer, normalize_segments, read_messages
+from .hl7tokenizer import Unsupported, index_message
+from .loader import MessageLoader, order_links
+from .management.commands.parsehl7 import SegmentIndex, parse_chunk, parse_message, cleanup_hl7, validate_and_parse
+from .parsecache import ParseCache
+from .parseprofile import PROFILER
+from .projection import ProjectionError, parse_projection
+from .records import CompactMessage, parse_compact
+from .redact import MaskError, Redactor, compile_mask, redact_text
+from .rollups import rebuild_day
+from .structure import GrammarError, automaton, check_structure, compile_grammar
+from .obxcheck import ObservationBatch, parse_ranges
+from .mllp import MLLPServer, build_ack, send_messages
+from .models import DailyCount, Message, Observation, Order, Patient
+from .synthetic import MESSAGE_TYPES, MessageGenerator, generate_messages
+from .volume import CountMinSketch, DecayedRate, SpaceSaving, VolumeMonitor, message_time
 class LabCheckViewsTest(TestCase):
 	def setUp(self):
 		self.client = Client()
@@ -30,4 +63,1211 @@ class LabCheckViewsTest(TestCase):
 		#self.assertIn('resourceType', data)
 		#self.assertEqual(data['resourceType'], 'Bundle')
 
+	def test_api_index_returns_parsed_message(self):
+		with open(self.good_hl7_path, 'rb') as f:
+			response = self.client.post(reverse('labcheck:api_index'), {'hl7_file': f})
+		self.assertEqual(response.json()['message']['msg_type'], 'ORU')
+
+	def test_api_batch_streams_every_message(self):
+		batch = Path(__file__).parent / 'test_files' / '12345-sub-payload.hl7'
+		with open(batch, 'rb') as f:
+			response = self.client.post(reverse('labcheck:api_batch'), {'hl7_file': f})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+		records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+		self.assertEqual([r['offset'] for r in records], [0, 899])
+		self.assertEqual([r['result']['message']['from_location'] for r in records], ['1437262961', 'SENDING_FACILITY'])
+
+	def test_api_fields(self):
+		with open(self.good_hl7_path, 'rb') as f:
+			response = self.client.post(reverse('labcheck:api_index') + '?fields=message.msg_type,observations.observation_identifier', {'hl7_file': f})
+		result = response.json()
+		self.assertEqual(set(result), {'message', 'observations'})
+		self.assertEqual(result['message'], {'msg_type': 'ORU'})
+		self.assertEqual(set(result['observations'][0]), {'observation_identifier'})
+		with open(self.good_hl7_path, 'rb') as f:
+			response = self.client.post(reverse('labcheck:api_batch'), {'hl7_file': f, 'fields': 'patients'})
+		self.assertEqual(response.status_code, 400)
+
+	def test_api_batch_reports_bad_messages(self):
+		with open(self.bad_hl7_path, 'rb') as f:
+			response = self.client.post(reverse('labcheck:api_batch'), {'hl7_file': f})
+		records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+		self.assertEqual(len(records), 1)
+		self.assertIn('error', records[0])
+
+
+class ParseMessageTest(TestCase):
+	def setUp(self):
+		self.oru_path = Path(__file__).parent / 'test_files' / 'hl7v2-oru-obx-example-1.hl7'
+		with open(self.oru_path, 'r', encoding='utf-8') as f:
+			self.oru = cleanup_hl7(f.read())
+
+	def test_segment_index(self):
+		segments = SegmentIndex(hl7.parse(self.oru))
+		self.assertEqual(len(segments.segments('OBX')), 14)
+		self.assertEqual(segments.segment('PID'), segments['PID'][0])
+		with self.assertRaises(KeyError):
+			segments.segment('EVN')
+
+	def test_parse_message_observations(self):
+		result = parse_message(self.oru)[0]
+		self.assertEqual(result['message']['msg_type'], 'ORU')
+		self.assertEqual(len(result['observations']), 14)
+		self.assertEqual(len(result['orders']), 1)
+		self.assertNotIn('event_type', result)
+
+	def test_compiled_fields_are_bounds_safe(self):
+		short_obx = hl7.parse("MSH|^~\\&|A\rOBX|1|NM|wbc^Wbc^LN").segment('OBX')
+		values = compile_fields(OBX_FIELDS)(short_obx)
+		self.assertEqual(values['value_type'], 'NM')
+		self.assertEqual(values['observation_method'], '')
+		self.assertEqual(list(values), [row[3] for row in OBX_FIELDS])
+
+	def test_compiled_fields_subset_and_components(self):
+		field_map = (("OBX", 3, 2, "code_text"), ("OBX", 3, 9, "missing"), ("OBX", 2, 1, "value_type"))
+		obx = hl7.parse("MSH|^~\\&|A\rOBX|1|NM|wbc^Wbc^LN").segment('OBX')
+		self.assertEqual(compile_fields(field_map)(obx), {"code_text": "Wbc", "missing": "", "value_type": "NM"})
+		self.assertEqual(compile_fields(field_map, keys={"code_text"})(obx), {"code_text": "Wbc"})
+		with self.assertRaises(ValueError):
+			compile_fields(field_map + (("OBR", 4, None, "service"),))
+
+
+class HL7ReaderTest(TestCase):
+	batch = (
+		b"FHS|^~\\&|APP\r\n"
+		b"BHS|^~\\&|APP\r\n"
+		b"MSH|^~\\&|A|B|C|D|2024||ADT^A01|1|P|2.3\r\n"
+		b"PID|1||111\r\n"
+		b"MSH|^~\\&|A|B|C|D|2024||ADT^A01|2|P|2.3\r"
+		b"PID|1||222\r"
+		b"\n"
+		b"MSH|^~\\&|A|B|C|D|2024||ADT^A01|3|P|2.3\n"
+		b"PID|1||333\n"
+		b"BTS|3\r\n"
+		b"FTS|1\r\n"
+	)
+
+	def test_read_messages_splits_batch(self):
+		messages = list(read_messages(io.BytesIO(self.batch)))
+		self.assertEqual(len(messages), 3)
+		for (offset, message), pid in zip(messages, ["111", "222", "333"]):
+			self.assertTrue(message.startswith("MSH|"))
+			self.assertTrue(message.endswith("\rPID|1||%s\r" % pid))
+			self.assertEqual(self.batch[offset:offset + 3], b"MSH")
+
+	def test_read_messages_small_chunks(self):
+		# \r\n split across reads must not look like a blank line
+		messages = list(read_messages(io.BytesIO(self.batch), chunk_size=7))
+		self.assertEqual(messages, list(read_messages(io.BytesIO(self.batch))))
+
+	def test_normalizer_chunks_and_mllp(self):
+		stream = b"\x0bMSH|^~\\&|A\r\nPID|1\r\x1c\r\x0bMSH|^~\\&|B\nPID|2\x1c\r"
+		normalizer = SegmentNormalizer()
+		segments = []
+		for i in range(len(stream)):
+			segments.extend(normalizer.feed(memoryview(stream)[i:i + 1]))
+		segments.extend(normalizer.close())
+		self.assertEqual([s for o, s in segments if s], [b"MSH|^~\\&|A", b"PID|1", b"MSH|^~\\&|B", b"PID|2"])
+		for offset, segment in segments:
+			self.assertEqual(stream[offset:offset + len(segment)], segment)
+		self.assertEqual(normalize_segments(stream), b"MSH|^~\\&|A\rPID|1\rMSH|^~\\&|B\rPID|2\r")
+		messages = [m for o, m in read_messages(io.BytesIO(stream))]
+		self.assertEqual(messages, ["MSH|^~\\&|A\rPID|1\r", "MSH|^~\\&|B\rPID|2\r"])
+
+	def test_cleanup_hl7(self):
+		self.assertEqual(cleanup_hl7("MSH|^~\\&|A\r\n\n  \nPID|1\rPV1|1\n"), "MSH|^~\\&|A\r\r  \rPID|1\rPV1|1\r")
+		# empty and one character lines have always been a bare segment end
+		self.assertEqual(cleanup_hl7("MSH|^~\\&|A\n\x1a\n\nPID|1"), "MSH|^~\\&|A\r\r\rPID|1\r")
+
+	def test_segments_before_msh_are_kept(self):
+		messages = list(read_messages(io.BytesIO(b"PID|1||111\n\nMSH|^~\\&|A\n")))
+		self.assertEqual([m for o, m in messages], ["PID|1||111\r", "MSH|^~\\&|A\r"])
+		self.assertEqual([o for o, m in messages], [0, 12])
+
+
+class ParseHL7CommandTest(TestCase):
+	def setUp(self):
+		self.test_files = Path(__file__).parent / 'test_files'
+
+	def run_command(self, *paths, **options):
+		with tempfile.NamedTemporaryFile('r', suffix='.ndjson') as out:
+			call_command('parsehl7', *paths, output=out.name, stderr=io.StringIO(), **options)
+			return [json.loads(line) for line in out]
+
+	def test_directory_single_worker(self):
+		records = self.run_command(str(self.test_files), workers=1)
+		# 12345-sub-payload.hl7 holds two messages, list-payload.hl7 is empty
+		self.assertEqual(len(records), 7)
+		errors = [r for r in records if 'error' in r]
+		self.assertEqual([Path(r['source']).name for r in errors], ['bad-hl7.hl7'])
+
+	def test_glob_with_process_pool(self):
+		records = self.run_command(str(self.test_files / '*.hl7'), workers=2, chunk_size=1)
+		self.assertEqual(records, self.run_command(str(self.test_files), workers=1))
+
+
+class TokenizerParityTest(TestCase):
+	"""The lazy tokenizer must give exactly what the hl7.parse path gives."""
+	edge_cases = [
+		# custom delimiters, subcomponents and repetitions
+		"MSH#$@/%#A$x#B#C#D#2020##ORU$R01#ID1#P#2.3\rPID#1##123$$$X%Y%Z@456##DOE$JOHN##1990#M###1 Main$$Town$ST$12345\rOBX#1#NM#c$d##5@6#u#1-2\r",
+		# short segments and a blank segment
+		"MSH|^~\\&|A|B|C|D|2020||ADT^A01|1|P|2.3\rEVN|A01\r\rPID|1||9~8^^^X&Y||DOE^JANE\rPV1|1\r",
+		# two MSH segments in one message
+		"MSH|^~\\&|A|B|C|D|2020||VXU^V04|1|P\rPID|1||1\rMSH|^~\\&|E|F|G|H|2021||VXU^V04|2|P\rPID|1||2\r",
+		# MSH without encoding characters terminated
+		"MSH|^~\\&\rPID|1\r",
+	]
+
+	def corpus(self):
+		messages = list(self.edge_cases)
+		for path in sorted((Path(__file__).parent / 'test_files').glob('*.hl7')):
+			with open(path, 'rb') as f:
+				messages.extend(message for offset, message in read_messages(f))
+		return messages
+
+	def outcome(self, message, fast):
+		try:
+			return json.dumps(parse_message(message, fast=fast))
+		except Exception as e:
+			return repr(e)
+
+	def test_parity(self):
+		for message in self.corpus():
+			with self.subTest(message=message[:40]):
+				self.assertEqual(self.outcome(message, True), self.outcome(message, False))
+
+	def test_fallback(self):
+		for message in ["FMSH|^~\\&|A\r", "MSH|^~\\&|A\rPV1\r", "MSH|^^^^|A\r"]:
+			with self.assertRaises(Unsupported):
+				index_message(message)
+			self.assertEqual(self.outcome(message, True), self.outcome(message, False))
+
+
+class ValidateAndParseTest(TestCase):
+	def setUp(self):
+		with open(Path(__file__).parent / 'test_files' / 'adt.hl7', 'r', encoding='utf-8') as f:
+			self.adt = f.read()
+		self.cache = ParseCache(maxsize=2)
+
+	def test_cached_result(self):
+		responses, error = validate_and_parse(self.adt, cache=self.cache)
+		self.assertEqual(error, "")
+		self.assertEqual(responses, parse_message(cleanup_hl7(self.adt)))
+		# same message with different line endings normalizes to the same key
+		again, error = validate_and_parse(self.adt.replace("\n", "\r\n"), cache=self.cache)
+		self.assertIs(again, responses)
+		self.assertEqual(self.cache.stats()['hits'], 1)
+		self.assertEqual(self.cache.stats()['misses'], 1)
+
+	def test_parse_error_and_eviction(self):
+		responses, error = validate_and_parse("FMSH|^~\\&|A", cache=self.cache)
+		self.assertEqual(responses, [])
+		self.assertTrue(error.startswith("Parsing exception. Not an HL7 message."))
+		validate_and_parse(self.adt, cache=self.cache)
+		validate_and_parse(self.adt.replace("MOUSE", "DUCK"), cache=self.cache)
+		self.assertEqual(len(self.cache), 2)
+		self.assertEqual(self.cache.stats()['evictions'], 1)
+
+
+class MLLPTest(TestCase):
+	def setUp(self):
+		with open(Path(__file__).parent / 'test_files' / 'adt.hl7', 'r', encoding='utf-8') as f:
+			self.adt = f.read()
+
+	def test_build_ack(self):
+		ack = build_ack(cleanup_hl7(self.adt), "AE", "bad|value^here")
+		msh, msa = ack.rstrip("\r").split("\r")
+		fields = msh.split("|")
+		self.assertEqual(fields[2:6], ["RECEIVING_APPLICATION", "RECEIVING_FACILITY", "SENDING_APPLICATION", "SENDING_FACILITY"])
+		self.assertEqual(fields[8], "ACK^A01")
+		self.assertEqual(msa, "MSA|AE|934576120110613083617|bad\\F\\value\\S\\here")
+
+	def test_listener_acks(self):
+		async def exchange():
+			with ThreadPoolExecutor(max_workers=2) as executor:
+				output = io.StringIO()
+				server = MLLPServer(executor, max_pending=2, output=output)
+				listener = await server.start('127.0.0.1', 0)
+				port = listener.sockets[0].getsockname()[1]
+				codes = await asyncio.gather(
+					send_messages('127.0.0.1', port, [self.adt, "FMSH|^~\\&|A"]),
+					send_messages('127.0.0.1', port, [self.adt] * 3))
+				listener.close()
+				await listener.wait_closed()
+				return codes, output.getvalue().splitlines()
+
+		codes, records = asyncio.run(exchange())
+		self.assertEqual(codes, [["AA", "AE"], ["AA", "AA", "AA"]])
+		self.assertEqual(len(records), 5)
+		self.assertEqual(sum('"error"' in record for record in records), 1)
+
+	def test_listener_rejects_oversized_frames(self):
+		adt = cleanup_hl7(self.adt)
+		large = adt + 'NTE|1||' + 'x' * 5000 + '\r'
+
+		async def exchange():
+			with ThreadPoolExecutor(max_workers=1) as executor:
+				output = io.StringIO()
+				server = MLLPServer(executor, max_pending=1, output=output, max_frame_size=1024)
+				listener = await server.start('127.0.0.1', 0)
+				port = listener.sockets[0].getsockname()[1]
+				codes = await send_messages('127.0.0.1', port, [adt, large, adt, 'x' * 5000, adt])
+				listener.close()
+				await listener.wait_closed()
+				return codes, server.stats(), output.getvalue().splitlines()
+
+		codes, stats, records = asyncio.run(exchange())
+		# the connection stays usable after each rejected frame
+		self.assertEqual(codes, ['AA', 'AE', 'AA', 'AR', 'AA'])
+		self.assertEqual((stats['accepted'], stats['errors']), (3, 2))
+		self.assertIn('frame too large', records[1])
+
+
+class SyntheticCorpusTest(TestCase):
+	def test_deterministic(self):
+		options = dict(seed=7, obx=3, nte=2, repetitions=2, field_length=12)
+		self.assertEqual(list(generate_messages(8, **options)), list(generate_messages(8, **options)))
+		self.assertNotEqual(list(generate_messages(8, seed=1)), list(generate_messages(8, seed=2)))
+
+	def test_segment_counts(self):
+		generator = MessageGenerator(obx=4, obr=2, nte=1, repetitions=3)
+		segments = [s.split('|')[0] for s in generator.message('ORU').split('\r') if s]
+		self.assertEqual(segments.count('OBR'), 2)
+		self.assertEqual(segments.count('OBX'), 8)
+		self.assertEqual(segments.count('NTE'), 10)
+		pid = next(s for s in generator.message('ADT').split('\r') if s.startswith('PID'))
+		self.assertEqual(pid.split('|')[3].count('~'), 2)
+
+	def test_all_types_parse(self):
+		for message in generate_messages(len(MESSAGE_TYPES), nte=1):
+			with self.subTest(message=message[:60]):
+				result = parse_message(message)
+				self.assertIn(result[0]['message']['msg_type'], MESSAGE_TYPES)
+				self.assertEqual(json.dumps(result), json.dumps(parse_message(message, fast=False)))
+
+	def test_benchsuite_report(self):
+		with tempfile.NamedTemporaryFile('r', suffix='.json') as out:
+			call_command('benchsuite', count=8, output=out.name, stdout=io.StringIO())
+			report = json.load(out)
+		self.assertEqual(report['corpus']['count'], 8)
+		self.assertEqual(set(report['stages']), {'cleanup_hl7', 'invalid_hl7', 'parse_message', 'json_serialization'})
+		for stage in report['stages'].values():
+			self.assertEqual(stage['messages'], 8)
+			self.assertGreater(stage['messages_per_s'], 0)
+
+
+class ParseProfilerTest(TestCase):
+	def tearDown(self):
+		PROFILER.disable()
+		PROFILER.reset()
+		PROFILER.dump_dir = None
+
+	def test_disabled_records_nothing(self):
+		parse_message(next(generate_messages(1)))
+		self.assertEqual(PROFILER.report(), {})
+
+	def test_counts_per_message_type(self):
+		PROFILER.enable(cprofile_sample=1.0)
+		messages = list(generate_messages(4, msg_types=('ORU',), obx=3))
+		results = [parse_message(message) for message in messages]
+		PROFILER.disable()
+		self.assertEqual(results, [parse_message(message) for message in messages])
+		report = PROFILER.report({'ORU^R01': 'observations'})
+		self.assertEqual(list(report), ['ORU^R01'])
+		oru = report['ORU^R01']
+		self.assertEqual((oru['description'], oru['messages'], oru['obx']), ('observations', 4, 12))
+		# MSH, PID, PV1, ORC, OBR and three OBX
+		self.assertEqual(oru['segments'], 4 * 8)
+		self.assertIn('observations', oru['stages'])
+		self.assertIn('tokenize', oru['stages'])
+		self.assertEqual(PROFILER.profiled, 4)
+		self.assertIn('extract_message', PROFILER.format_pstats())
+
+	def test_command_report(self):
+		test_files = Path(__file__).parent / 'test_files'
+		with tempfile.NamedTemporaryFile('r', suffix='.json') as out:
+			call_command('profilehl7', str(test_files), output=out.name, stdout=io.StringIO())
+			report = json.load(out)
+		self.assertEqual(report['types']['unknown']['failed'], 1)
+		self.assertEqual(sum(t['messages'] for t in report['types'].values()), 7)
+		self.assertFalse(PROFILER.enabled)
+
+	def test_environment_sampling(self):
+		with self.assertRaises(ValueError):
+			PROFILER.configure({'LABCHECK_CPROFILE_SAMPLE': '2'})
+		PROFILER.configure({})
+		self.assertFalse(PROFILER.enabled)
+		with tempfile.TemporaryDirectory() as directory:
+			PROFILER.configure({'LABCHECK_CPROFILE_SAMPLE': '1', 'LABCHECK_CPROFILE_DIR': directory})
+			self.assertTrue(PROFILER.enabled)
+			parse_chunk([('synthetic', offset, message) for offset, message in enumerate(generate_messages(3))])
+			# a worker leaves its samples behind as <pid>.pstats
+			stats = pstats.Stats(str(Path(directory) / ('%d.pstats' % os.getpid())))
+		self.assertEqual(PROFILER.profiled, 3)
+		self.assertTrue(any(name == 'extract_message' for filename, line, name in stats.stats))
+
+	def test_bad_environment(self):
+		test_files = Path(__file__).parent / 'test_files'
+		with mock.patch.dict(os.environ, {'LABCHECK_CPROFILE_SAMPLE': 'lots'}):
+			# at import the app starts anyway, without profiling
+			with self.assertLogs('apps.labcheck.parseprofile', 'WARNING') as logs:
+				PROFILER.configure()
+			self.assertFalse(PROFILER.enabled)
+			self.assertIn('LABCHECK_CPROFILE_SAMPLE', logs.output[0])
+			with self.assertRaisesRegex(CommandError, 'LABCHECK_CPROFILE_SAMPLE'):
+				call_command('profilehl7', str(test_files), stdout=io.StringIO())
+
+
+class ObservationCheckTest(TestCase):
+	def observation(self, value, reference, flag, value_type='NM'):
+		return {'value_type': value_type, 'observation_value': value, 'references_range': reference, 'abnormal_flags': flag}
+
+	def test_parse_ranges(self):
+		low, high, low_inclusive, high_inclusive = parse_ranges(['3.5-5.0', '<10', '>=1', '-1 - 2', 'pending', '3.5-5.0'])
+		self.assertEqual(low[[0, 2, 3, 5]].tolist(), [3.5, 1.0, -1.0, 3.5])
+		self.assertEqual(high[[0, 1, 3]].tolist(), [5.0, 10.0, 2.0])
+		self.assertEqual(low[1], float('-inf'))
+		self.assertEqual(high[2], float('inf'))
+		self.assertEqual((high_inclusive[1], low_inclusive[2]), (False, True))
+		self.assertTrue(low[4] != low[4])
+
+	def test_summary_per_sender(self):
+		batch = ObservationBatch()
+		batch.add({'message': {'from_location': 'LAB-A'}, 'observations': [
+			self.observation('7.0', '3.8-11.0', ''),
+			self.observation('16', '4-15', 'H'),
+			self.observation('16', '4-15', ''),
+			self.observation('2', '4-15', 'H'),
+			self.observation('10', '<10', 'N'),
+			self.observation('5', '4-15', 'L'),
+		]})
+		batch.add({'message': {'from_location': 'LAB-B'}, 'observations': [
+			self.observation(['112283007', 'E coli'], '', 'A', value_type='CE'),
+			self.observation('1', 'see note', ''),
+		]})
+		summary = batch.summary()
+		self.assertEqual(summary['LAB-A'], {'observations': 6, 'numeric': 6, 'with_range': 6,
+			'out_of_range': 4, 'missing_flag': 2, 'contradicting_flag': 2})
+		self.assertEqual(summary['LAB-B'], {'observations': 2, 'numeric': 1, 'with_range': 0,
+			'out_of_range': 0, 'missing_flag': 0, 'contradicting_flag': 0})
+
+	def test_command_on_hl7_files(self):
+		test_files = Path(__file__).parent / 'test_files'
+		stderr = io.StringIO()
+		with tempfile.NamedTemporaryFile('r', suffix='.json') as out:
+			call_command('obxcheck', str(test_files), hl7=True, output=out.name, stderr=stderr)
+			summary = json.load(out)
+		self.assertEqual(summary['SendingFac']['out_of_range'], 2)
+		self.assertEqual(summary['SendingFac']['missing_flag'], 0)
+		# bad-hl7.hl7
+		self.assertIn('1 messages could not be parsed', stderr.getvalue())
+
+
+class CodeIndexTest(TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = str(Path(self.tmp.name) / 'codes.idx')
+		csv_path = Path(self.tmp.name) / 'loinc.csv'
+		csv_path.write_text('LOINC_NUM,LONG_COMMON_NAME,STATUS\n6690-2,Leukocytes,ACTIVE\n'
+			'770-8,Neutrophils,DEPRECATED\n718-7,Hemoglobin,ACTIVE\n')
+		call_command('buildcodeindex', str(csv_path), output=self.path, system='LN', code_column='LOINC_NUM',
+			display_column='LONG_COMMON_NAME', status_column='STATUS', stdout=io.StringIO())
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_lookup(self):
+		index = CodeIndex(self.path)
+		self.assertEqual(len(index), 3)
+		self.assertEqual(index.lookup('LN', '6690-2').display, 'Leukocytes')
+		self.assertTrue(index.lookup('LOINC', '770-8').deprecated)
+		self.assertIsNone(index.lookup('LN', '1-8'))
+		self.assertIsNone(index.lookup('LN', '1-8'))
+		self.assertEqual(index.cache_info().hits, 1)
+		self.assertEqual(index.check('LN', '1-8'), 'unknown')
+		self.assertIsNone(index.check('L', 'wbc'))
+		index.close()
+
+	def test_rebuild_is_sorted(self):
+		rows = [('LN', '%d-%d' % (i, i % 10), 'code %d' % i, '') for i in range(500, 0, -1)]
+		build_index(rows, self.path)
+		index = CodeIndex(self.path)
+		for i in range(1, 501):
+			self.assertEqual(index.lookup('LN', '%d-%d' % (i, i % 10)).display, 'code %d' % i)
+		index.close()
+
+	def test_system_with_comma(self):
+		build_index([('LOCAL,LAB', 'wbc', 'White cells', ''), ('LN', '718-7', 'Hemoglobin', '')], self.path)
+		index = CodeIndex(self.path)
+		self.assertEqual(index.systems, {'LOCAL,LAB', 'LN'})
+		self.assertEqual(index.lookup('LOCAL,LAB', 'wbc').display, 'White cells')
+		self.assertEqual(index.check('LOCAL,LAB', 'rbc'), 'unknown')
+		self.assertIsNone(index.check('LOCAL', 'rbc'))
+		index.close()
+
+	def test_flags_codes_at_parse_time(self):
+		with open(Path(__file__).parent / 'test_files' / 'hl7v2-oru-obx-example-1.hl7') as f:
+			message = cleanup_hl7(f.read())
+		self.assertNotIn('code_issues', parse_message(message)[0])
+		with override_settings(LABCHECK_CODE_INDEX=self.path):
+			issues = parse_message(message)[0]['code_issues']
+		self.assertEqual(issues[0], {'segment': 'OBX', 'position': 2, 'field': 'OBX-3',
+			'system': 'LN', 'code': '770-8', 'issue': 'deprecated'})
+		self.assertNotIn('6690-2', [issue['code'] for issue in issues])
+		self.assertNotIn('L', [issue['system'] for issue in issues])
+
+
+class DeduplicatorTest(TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = str(Path(self.tmp.name) / 'dedup.sqlite3')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_persists_between_runs(self):
+		messages = list(generate_messages(50))
+		dedup = Deduplicator(self.path)
+		self.assertEqual([dedup.seen(m) for m in messages + messages[:10]], [False] * 50 + [True] * 10)
+		dedup.close()
+		dedup = Deduplicator(self.path)
+		self.assertTrue(all(dedup.seen(m) for m in messages))
+		self.assertEqual(dedup.stats()['duplicate_rate'], 1.0)
+		dedup.close()
+
+	def test_false_positives_are_confirmed(self):
+		# a filter this small says "maybe" for nearly everything
+		dedup = Deduplicator(self.path, initial_capacity=1, error_rate=0.5, flush_every=7)
+		messages = list(generate_messages(100))
+		self.assertFalse(any(dedup.seen(m) for m in messages))
+		self.assertGreater(dedup.stats()['false_positives'], 0)
+		self.assertGreater(len(dedup.filter.filters), 1)
+		self.assertTrue(all(dedup.seen(m) for m in messages))
+		dedup.close()
+
+	def test_content_hash(self):
+		message = next(generate_messages(1))
+		header, rest = message.split('\r', 1)
+		fields = header.split('|')
+		fields[9] = ''
+		without_id = '|'.join(fields) + '\r' + rest
+		dedup = Deduplicator(self.path)
+		self.assertEqual([dedup.seen(without_id), dedup.seen(without_id)], [False, False])
+		dedup.close()
+		dedup = Deduplicator(str(Path(self.tmp.name) / 'content.sqlite3'), content_hash=True)
+		self.assertEqual([dedup.seen(without_id), dedup.seen(without_id)], [False, True])
+		dedup.close()
+
+	def test_parsehl7_skips_duplicates(self):
+		test_files = Path(__file__).parent / 'test_files'
+		# two of the test files share a sender and control id
+		for expected in (6, 0):
+			with tempfile.NamedTemporaryFile('r', suffix='.ndjson') as out:
+				stderr = io.StringIO()
+				call_command('parsehl7', str(test_files), workers=1, dedup=self.path, dedup_content_hash=True,
+					output=out.name, stderr=stderr)
+				self.assertEqual(len(out.readlines()), expected)
+		self.assertIn('7 of 7 messages skipped as duplicates', stderr.getvalue())
+
+
+class CheckpointTest(TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.dir = Path(self.tmp.name)
+		self.inputs = []
+		for i in range(3):
+			path = self.dir / ('batch-%d.hl7' % i)
+			path.write_text('\n'.join(m.replace('\r', '\n') for m in generate_messages(25, seed=i)))
+			self.inputs.append(str(path))
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def run_command(self, output, **options):
+		call_command('parsehl7', *self.inputs, output=str(output), workers=1, chunk_size=4,
+			stderr=io.StringIO(), **options)
+		return (self.dir / output).read_text().splitlines()
+
+	def test_resume_after_crash(self):
+		expected = self.run_command(self.dir / 'expected.ndjson')
+		self.assertEqual(len(expected), 75)
+		output = self.dir / 'out.ndjson'
+		options = dict(checkpoint=str(self.dir / 'checkpoint.json'), checkpoint_interval=0,
+			dedup=str(self.dir / 'dedup.sqlite3'))
+		calls = []
+
+		def crash_on_tenth(chunk):
+			calls.append(chunk)
+			if len(calls) == 10:
+				raise KeyboardInterrupt
+			return parse_chunk(chunk)
+
+		with mock.patch('apps.labcheck.management.commands.parsehl7.parse_chunk', crash_on_tenth):
+			with self.assertRaises(KeyboardInterrupt):
+				self.run_command(output, **options)
+		state = json.loads((self.dir / 'checkpoint.json').read_text())
+		self.assertEqual(state['messages'], 36)
+		self.assertEqual(state['completed'], self.inputs[:1])
+		# a partial write after the last checkpoint is dropped on resume
+		with open(output, 'a') as f:
+			f.write('{"partial')
+		self.assertEqual(self.run_command(output, **options), expected)
+		# a finished run has nothing left to do
+		self.assertEqual(self.run_command(output, **options), expected)
+
+	def test_mismatched_checkpoint(self):
+		checkpoint = str(self.dir / 'checkpoint.json')
+		self.run_command(self.dir / 'out.ndjson', checkpoint=checkpoint)
+		with self.assertRaises(CommandError):
+			self.run_command(self.dir / 'other.ndjson', checkpoint=checkpoint)
+
+
+class ConformanceProfileTest(TestCase):
+	def setUp(self):
+		self.profile = load_profile('elr-2.5.1')
+
+	def findings(self, message):
+		return {(f['segment'], f['field'], f['component'], f['code']) for f in self.profile.validate(message)}
+
+	def test_elr_findings(self):
+		message = next(generate_messages(1, msg_types=('ORU',)))
+		self.assertTrue(self.profile.applies_to(message))
+		self.assertFalse(self.profile.applies_to(next(generate_messages(1, msg_types=('ADT',)))))
+		findings = self.findings(message)
+		self.assertIn(('MSH', 9, 3, 'required'), findings)
+		self.assertIn(('SPM', None, None, 'cardinality'), findings)
+		self.assertNotIn(('PID', 8, None, 'value_set'), findings)
+		broken = message.replace('|P|2.5.1', '|Q|2.5.1', 1).replace('OBX|1|NM|', 'OBX|x|NM|', 1)
+		findings = self.findings(broken)
+		self.assertIn(('MSH', 11, 1, 'value_set'), findings)
+		self.assertIn(('OBX', 1, None, 'data_type'), findings)
+
+	def test_compiled_rules(self):
+		profile = compile_profile({
+			'value_sets': {'YN': ['Y', 'N']},
+			'segments': {
+				'PID': {'min': 1, 'max': 1, 'fields': [
+					{'field': 3, 'usage': 'R', 'repeats': False},
+					{'field': 3, 'component': 1, 'usage': 'R', 'max_length': 4},
+					{'field': 7, 'usage': 'RE', 'type': 'DT', 'severity': 'warning'},
+					{'field': 9, 'usage': 'X'},
+					{'field': 24, 'usage': 'RE', 'value_set': 'YN'},
+				]},
+			},
+		})
+		message = 'MSH|^~\\&|A\rPID|1||12345~^^^X||DOE||1990011||ALIAS' + '|' * 15 + 'M\rPID|2||1\r'
+		findings = profile.validate(message)
+		summary = [(f['sequence'], f['field'], f['component'], f['repetition'], f['severity'], f['code']) for f in findings]
+		self.assertEqual(summary, [
+			(2, 3, None, None, 'error', 'repetitions'),
+			(2, 3, 1, 1, 'error', 'length'),
+			(2, 3, 1, 2, 'error', 'required'),
+			(2, 7, None, 1, 'warning', 'data_type'),
+			(2, 9, None, None, 'error', 'not_supported'),
+			(2, 24, None, 1, 'error', 'value_set'),
+			(None, None, None, None, 'error', 'cardinality'),
+		])
+		self.assertEqual(findings[1]['value'], '12345')
+		with self.assertRaises(ProfileError):
+			compile_profile({'segments': {'PID': {'fields': [{'field': 1, 'type': 'XYZ'}]}}})
+
+	def test_command(self):
+		test_files = Path(__file__).parent / 'test_files'
+		with tempfile.NamedTemporaryFile('r', suffix='.ndjson') as out:
+			stdout = io.StringIO()
+			call_command('checkprofile', str(test_files), output=out.name, stdout=stdout)
+			records = [json.loads(line) for line in out]
+		# only the two ORU^R01 messages are validated
+		self.assertEqual(len(records), 2)
+		self.assertIn('ELR 2.5.1: 2 messages', stdout.getvalue())
+
+class MessageStructureTest(TestCase):
+	def test_grammar(self):
+		dfa = compile_grammar('MSH [{NTE}] {PID <PV1|PV2> [{OBX [NTE]}]}')
+		self.assertIsNone(dfa.run(['MSH', 'PID', 'PV1']))
+		self.assertIsNone(dfa.run(['MSH', 'NTE', 'NTE', 'PID', 'PV2', 'OBX', 'NTE', 'OBX', 'PID', 'PV1']))
+		self.assertEqual(dfa.run(['MSH', 'PID', 'OBX']), (2, ['PV1', 'PV2']))
+		self.assertEqual(dfa.run(['MSH', 'PID']), (2, ['PV1', 'PV2']))
+		self.assertEqual(dfa.run(['MSH', 'PID', 'PV1', 'OBX', 'NTE', 'NTE']), (5, ['OBX', 'PID']))
+		with self.assertRaises(GrammarError):
+			compile_grammar('MSH [PID')
+		self.assertIs(automaton('ORU_R01'), automaton('ORU_R01'))
+
+	def test_messages(self):
+		for message in generate_messages(40):
+			self.assertEqual(check_structure(message), [], message)
+		test_files = Path(__file__).parent / 'test_files'
+		with open(test_files / 'orm-example.hl7', 'r', encoding='utf-8') as f:
+			findings = check_structure(cleanup_hl7(f.read()))
+		# the second OBR has no ORC of its own
+		self.assertEqual([(f['segment'], f['sequence'], f['code']) for f in findings], [('OBR', 8, 'structure')])
+		self.assertIn('ORC', findings[0]['expected'])
+		oru = next(generate_messages(1, msg_types=('ORU',)))
+		findings = check_structure(oru.replace('\rPID|', '\rZPI|1\rPID|', 1).replace('\rPV1|', '\rEVN|x\rPV1|', 1))
+		self.assertEqual([(f['segment'], f['sequence']) for f in findings], [('EVN', 4)])
+		findings = check_structure(oru.split('\rOBR|')[0])
+		self.assertEqual([(f['segment'], f['sequence']) for f in findings], [(None, None)])
+		findings = check_structure(oru.replace('ORU^R01', 'ORU^R30', 1))
+		self.assertEqual(findings[0]['code'], 'unknown_structure')
+
+class ProjectionTest(TestCase):
+	def setUp(self):
+		with open(Path(__file__).parent / 'test_files' / 'hl7v2-oru-obx-example-1.hl7') as f:
+			self.message = cleanup_hl7(f.read())
+		self.full = parse_message(self.message)[0]
+
+	def test_sections_and_fields(self):
+		projection = parse_projection('message,patient_identity.sub,observations.observation_identifier,observations.units')
+		result = parse_message(self.message, projection=projection)[0]
+		self.assertEqual(list(result), ['message', 'patient_identity', 'observations'])
+		self.assertEqual(result['message'], self.full['message'])
+		self.assertEqual(result['patient_identity'], {'sub': self.full['patient_identity']['sub']})
+		self.assertEqual(result['observations'], [
+			{'observation_identifier': o['observation_identifier'], 'units': o['units']}
+			for o in self.full['observations']])
+		self.assertIs(parse_projection('orders'), parse_projection('orders'))
+		self.assertEqual(parse_message(self.message, projection=parse_projection('orders'))[0],
+			{'orders': self.full['orders']})
+		for spec in ('', 'patient', 'observations.nope', 'code_issues.code'):
+			with self.assertRaises(ProjectionError):
+				parse_projection(spec)
+
+	def test_code_issues_reads_unrequested_fields(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = str(Path(tmp) / 'codes.idx')
+			build_index([('LN', '770-8', 'Neutrophils', 'D')], path)
+			with override_settings(LABCHECK_CODE_INDEX=path):
+				full = parse_message(self.message)[0]
+				result = parse_message(self.message, projection=parse_projection('code_issues,observations.units'))[0]
+		self.assertEqual(result['code_issues'], full['code_issues'])
+		self.assertEqual(list(result), ['observations', 'code_issues'])
+		self.assertEqual(set(result['observations'][0]), {'units'})
+
+	def test_batch_command(self):
+		test_files = Path(__file__).parent / 'test_files'
+		with tempfile.NamedTemporaryFile('r', suffix='.ndjson') as out:
+			call_command('parsehl7', str(test_files), output=out.name, workers=2, chunk_size=1,
+				fields='message.id,observations.observation_identifier', stderr=io.StringIO())
+			records = [json.loads(line) for line in out]
+		results = [r['result'] for r in records if 'result' in r]
+		self.assertEqual(len(results), 6)
+		self.assertTrue(all(set(r) <= {'message', 'observations'} for r in results))
+		with self.assertRaises(CommandError):
+			call_command('parsehl7', str(test_files), fields='message.nope', stderr=io.StringIO())
+
+class CompactRecordsTest(TestCase):
+	def test_serializes_like_parse_message(self):
+		messages = list(generate_messages(20, nte=1))
+		for path in sorted((Path(__file__).parent / 'test_files').glob('*.hl7')):
+			with open(path, 'rb') as f:
+				messages.extend(message for offset, message in read_messages(f) if 'MSH' in message)
+		for message in messages:
+			try:
+				expected = parse_message(message)
+			except Exception:
+				continue
+			records = parse_compact(message)
+			self.assertEqual(json.dumps([r.as_dict() for r in records]), json.dumps(expected))
+
+	def test_records_read_like_dicts(self):
+		message = next(generate_messages(1, msg_types=('ORU',)))
+		record = parse_compact(message)[0]
+		self.assertIsInstance(record, CompactMessage)
+		self.assertFalse(hasattr(record.observations[0], '__dict__'))
+		self.assertEqual(record.get('observations')[0].get('value_type'), 'NM')
+		self.assertEqual(record.observations[0].get('count', 'missing'), 'missing')
+		self.assertIsNone(record.get('patient_visit_2'))
+		self.assertIs(record.observations[0].value_type, record.observations[1].value_type)
+		batch, compact = ObservationBatch(), ObservationBatch()
+		batch.add(parse_message(message)[0])
+		compact.add(record)
+		self.assertEqual(batch.summary(), compact.summary())
+
+	def test_benchmark(self):
+		stdout, stderr = io.StringIO(), io.StringIO()
+		call_command('benchrecords', count=20, stdout=stdout, stderr=stderr)
+		self.assertIn('compact', stdout.getvalue())
+		self.assertEqual(stderr.getvalue(), '')
+
+class MessageLoaderTest(TestCase):
+	def test_chunked_load(self):
+		messages = list(generate_messages(20, msg_types=('ORU', 'ADT'), obr=2, obx=3))
+		loader = MessageLoader(chunk_size=10)
+		# a chunk is one transaction (a savepoint inside the test), one INSERT per table
+		# and one daily count upsert
+		with self.assertNumQueries(2 * 7):
+			for offset, message in enumerate(messages):
+				loader.add(message, 'synthetic', offset)
+		loader.close()
+		self.assertEqual(loader.transactions, 2)
+		self.assertEqual(Message.objects.count(), 20)
+		self.assertEqual(Patient.objects.count(), 20)
+		self.assertEqual(Order.objects.count(), 10 * 2)
+		self.assertEqual(Observation.objects.count(), 10 * 2 * 3)
+		self.assertFalse(Observation.objects.filter(order__isnull=True).exists())
+		self.assertFalse(Observation.objects.exclude(order__message=models.F('message')).exists())
+		message = Message.objects.get(offset=0)
+		result = parse_message(messages[0])[0]
+		self.assertEqual(message.control_id, result['message']['id'])
+		self.assertEqual(message.patient.patient_id, str(result['patient_identity']['sub'][0]))
+		first = message.observations.order_by('position')[0]
+		self.assertEqual(first.code, str(result['observations'][0]['observation_identifier'][0]))
+		self.assertEqual(first.order.position, 1)
+		self.assertEqual(message.observations.filter(order__position=2).count(), 3)
+
+	def test_links_and_command(self):
+		self.assertEqual(order_links('MSH|\rOBX|1\rOBR|1\rOBX|1\rNTE|1\rOBR|2\rOBX|1\rOBX|2\r'), [None, 0, 1, 1])
+		stdout, stderr = io.StringIO(), io.StringIO()
+		call_command('loadhl7', str(Path(__file__).parent / 'test_files'), stdout=stdout, stderr=stderr)
+		self.assertEqual(Message.objects.count(), 6)
+		self.assertIn('bad-hl7.hl7', stderr.getvalue())
+		# the orm example has two OBR and no OBX, the redacted lab message two OBR with OBX after each
+		lab = Message.objects.get(source__endswith='redacted-lab-message.hl7')
+		self.assertEqual(lab.orders.count(), 2)
+		self.assertEqual([o.observations.count() for o in lab.orders.order_by('position')], [1, 16])
+
+	def test_failed_chunk(self):
+		messages = list(generate_messages(4, msg_types=('ORU',)))
+		loader = MessageLoader(chunk_size=10)
+		for offset, message in enumerate(messages):
+			loader.add(message, 'synthetic', offset)
+		with mock.patch('apps.labcheck.loader.upsert_counts', side_effect=IntegrityError('boom')):
+			with self.assertRaises(IntegrityError):
+				loader.close()
+		# the chunk is rolled back and dropped, not retried with the next one
+		self.assertEqual(loader.pending, [])
+		self.assertEqual(loader.transactions, 0)
+		self.assertEqual(Message.objects.count(), 0)
+		loader.add(messages[0], 'synthetic', 0)
+		loader.close()
+		self.assertEqual(Message.objects.count(), 1)
+		# the command reports the chunk instead of counting parse errors
+		stdout, stderr = io.StringIO(), io.StringIO()
+		with mock.patch('apps.labcheck.loader.upsert_counts', side_effect=IntegrityError('boom')):
+			with self.assertRaisesRegex(CommandError, 'chunk 1, .* was rolled back: IntegrityError: boom'):
+				call_command('loadhl7', str(Path(__file__).parent / 'test_files'), stdout=stdout, stderr=stderr)
+		self.assertNotIn('IntegrityError', stderr.getvalue())
+		self.assertEqual(Message.objects.count(), 1)
+
+class DailyCountTest(TestCase):
+	def counts(self):
+		return {(str(c.day), c.msg_type, c.code): c.count for c in DailyCount.objects.all()}
+
+	def load(self, messages, chunk_size=1000):
+		loader = MessageLoader(chunk_size=chunk_size)
+		for message in messages:
+			loader.add(message)
+		loader.close()
+
+	def oru(self, control_id, timestamp, status, codes=('2345-7', '4544-3')):
+		segments = ['MSH|^~\\&|APP|LAB|R|DOH|%s||ORU^R01|%s|P|2.5.1' % (timestamp, control_id),
+			'PID|1||123^^^H^MR||DOE^J||19800101|F|||1 A ST^^CITY^ST^12345', 'OBR|1|P1|F1|cbc^CBC^L']
+		segments += ['OBX|%d|NM|%s^x^LN||5||||||%s' % (i, code, status) for i, code in enumerate(codes, 1)]
+		return '\r'.join(segments) + '\r'
+
+	def test_incremental_matches_rebuild(self):
+		self.load(generate_messages(30, obr=2, obx=2), chunk_size=7)
+		incremental = self.counts()
+		self.assertEqual(sum(n for (day, msg_type, code), n in incremental.items() if code == ''), 30)
+		self.assertEqual(sum(n for (day, msg_type, code), n in incremental.items() if code), Observation.objects.count())
+		for day in Message.objects.values_list('day', flat=True).distinct():
+			rebuild_day(day)
+		self.assertEqual(self.counts(), incremental)
+
+	def test_late_correction(self):
+		self.load([self.oru('1', '20240101120000', 'F'), self.oru('2', '20240102120000', 'F', ('9999-9',))])
+		# a correction sent days later replaces the first result for the same order and code
+		self.load([self.oru('3', '20240105080000', 'C', ('2345-7',))])
+		counts = self.counts()
+		self.assertEqual(counts[('2024-01-01', 'ORU^R01', '2345-7')], 0)
+		self.assertEqual(counts[('2024-01-01', 'ORU^R01', '4544-3')], 1)
+		self.assertEqual(counts[('2024-01-05', 'ORU^R01', '2345-7')], 1)
+		self.assertEqual(counts[('2024-01-02', 'ORU^R01', '9999-9')], 1)
+		self.assertEqual(Observation.objects.filter(superseded=True).count(), 1)
+		# an original and its correction in the same chunk count once
+		self.load([self.oru('4', '20240106080000', 'F', ('4544-3',)), self.oru('5', '20240106090000', 'C', ('4544-3',))])
+		self.assertEqual(self.counts()[('2024-01-06', 'ORU^R01', '4544-3')], 1)
+		self.assertEqual(self.counts()[('2024-01-01', 'ORU^R01', '4544-3')], 0)
+		before = self.counts()
+		DailyCount.objects.all().delete()
+		stdout = io.StringIO()
+		call_command('rebuildrollups', '2024-01-01', '2024-01-02', '2024-01-05', '2024-01-06', stdout=stdout)
+		self.assertEqual({k: v for k, v in before.items() if v}, self.counts())
+		with self.assertRaises(CommandError):
+			call_command('rebuildrollups', '2024-13-01')
+
+
+class PatientLinkageTest(TestCase):
+	def pid(self, family, given, birthdate, gender='F', postal='12345', identifier='1', authority='HOSP', ssn=''):
+		return ('PID|1||%s^^^%s^MR||%s^%s||%s|%s|||1 A ST^^CITY^ST^%s||||||||%s'
+			% (identifier, authority, family, given, birthdate, gender, postal, ssn))
+
+	def message(self, control_id, pid):
+		return '\r'.join(['MSH|^~\\&|APP|LAB|R|DOH|20240101||ADT^A04|%s|P|2.5.1' % control_id, pid]) + '\r'
+
+	def test_soundex(self):
+		self.assertEqual([soundex(n) for n in ('Robert', 'Rupert', 'Ashcraft', 'Tymczak', 'Pfister', "O'Hara", '')],
+			['R163', 'R163', 'A261', 'T522', 'P236', 'O600', ''])
+
+	def test_bit_counts(self):
+		values = [0, 1, 3, 0xFF, 0x8000000000000001, (1 << 64) - 1] + [(1 << k) - 1 for k in range(1, 64, 7)]
+		expected = [bin(v).count('1') for v in values]
+		array = np.array(values, dtype=np.uint64)
+		# the lookup table is what NumPy 1.x uses
+		self.assertEqual(byte_bit_counts(array).tolist(), expected)
+		self.assertEqual(bit_counts(array).tolist(), expected)
+		self.assertEqual(byte_bit_counts(array[:0]).tolist(), [])
+
+	def test_connected_components(self):
+		labels = connected_components(6, np.array([4, 1, 5]), np.array([5, 3, 2]))
+		self.assertEqual(labels.tolist(), [0, 1, 2, 1, 2, 2])
+
+	def test_links_variants(self):
+		linker = Linker()
+		pids = [
+			self.pid('SMITH', 'JANE', '19800101'),
+			# another facility, a typo in the surname
+			self.pid('SMYTH', 'JANE', '19800101', identifier='A7', authority='CLINIC'),
+			# same PID-3 at the same facility, the name changed
+			self.pid('JONES', 'JANE', '19800101', postal='54321'),
+			# a different person with a similar name and birthday
+			self.pid('SMITH', 'JOHN', '19800102', gender='M', identifier='2'),
+			# a different person sharing only postal code and birthdate
+			self.pid('BROWN', 'ALEX', '19800101', identifier='3'),
+		]
+		for i, pid in enumerate(pids):
+			for record in parse_compact(self.message(str(i), pid)):
+				linker.add(record.get('patient_identity'))
+		clusters = linker.clusters().tolist()
+		self.assertEqual(clusters, [0, 0, 0, 1, 2])
+		self.assertEqual(linker.stats['clusters'], 3)
+		# parse_message dicts link the same way
+		dicts = Linker()
+		for i, pid in enumerate(pids):
+			for result in parse_message(self.message(str(i), pid), True):
+				dicts.add(result['patient_identity'])
+		self.assertEqual(dicts.clusters().tolist(), clusters)
+
+	def test_ssn_disagreement(self):
+		linker = Linker()
+		# everything else agrees, but two facilities recorded different SSNs
+		for ssn, authority in (('123-45-6789', 'HOSP'), ('987654321', 'CLINIC')):
+			for record in parse_compact(self.message(ssn, self.pid('DOE', 'PAT', '19700505', authority=authority, ssn=ssn))):
+				linker.add(record.get('patient_identity'))
+		self.assertEqual(linker.clusters().tolist(), [0, 1])
+
+	def test_command(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = Path(tmp) / 'adt.hl7'
+			path.write_text(''.join([self.message('1', self.pid('SMITH', 'JANE', '19800101')),
+				self.message('2', self.pid('SMITH', 'JANE', '19800101', identifier='A7', authority='CLINIC')),
+				self.message('3', self.pid('BROWN', 'ALEX', '19600101', identifier='3'))]))
+			output = Path(tmp) / 'links.ndjson'
+			stderr = io.StringIO()
+			call_command('linkpatients', str(path), output=str(output), stderr=stderr)
+			lines = [json.loads(line) for line in output.read_text().splitlines()]
+		self.assertEqual([line['cluster'] for line in lines], [0, 0, 1])
+		self.assertEqual(lines[1]['source'], str(path))
+		self.assertIn('2 patients', stderr.getvalue())
+
+
+class RedactionTest(TestCase):
+	message = ('MSH|^~\\&|APP|LAB|R|DOH|20240101||ADT^A04|1|P|2.5.1\r'
+		'PID|1||123^^^HOSP^MR||DOE^JANE~DOE^J||19800101|F|||1 A ST^^CITY^ST^12345||(555)555-1234||||||123-45-6789\r'
+		'NK1|1|DOE^JOHN|SPO^Spouse|1 A ST^^CITY^ST^12345\r'
+		'OBX|1|NM|2345-7^Glucose^LN||95|mg/dL\r')
+
+	def test_blank(self):
+		redacted = redact_text(self.message)
+		for before, after in zip(self.message.split('\r'), redacted.split('\r')):
+			# delimiters are where they were
+			self.assertEqual([c for c in before if c in '|^~&'], [c for c in after if c in '|^~&'])
+		segments = redacted.split('\r')
+		self.assertEqual(segments[0], self.message.split('\r')[0])
+		self.assertEqual(segments[1], 'PID|1||^^^^||^~^|||F|||^^^^||||||||')
+		self.assertEqual(segments[2], 'NK1|1|^|^|^^^^')
+		self.assertEqual(segments[3], 'OBX|1|NM|2345-7^Glucose^LN||95|mg/dL')
+
+	def test_pseudonyms(self):
+		first = Redactor(key=b'secret').redact(self.message.encode())
+		second = Redactor(key=b'secret').redact(self.message.replace('|1|P|', '|2|P|').encode())
+		other = Redactor(key=b'other').redact(self.message.encode())
+		pid = first.split(b'\r')[1].split(b'|')
+		self.assertEqual(len(first), len(self.message))
+		self.assertNotIn(b'DOE', first)
+		self.assertNotIn(b'19800101', first)
+		self.assertTrue(pid[7].isdigit())
+		# the same value gets the same pseudonym, in other fields and messages too
+		self.assertEqual(pid[5].split(b'~')[0].split(b'^')[0], first.split(b'\r')[2].split(b'|')[2].split(b'^')[0])
+		self.assertEqual(first.split(b'\r')[1], second.split(b'\r')[1])
+		self.assertNotEqual(first.split(b'\r')[1], other.split(b'\r')[1])
+		result = parse_message(first.decode(), True)[0]
+		self.assertEqual(result['message']['msg_type'], 'ADT')
+
+	def test_mask(self):
+		redacted = redact_text(self.message, 'PID-11.5,OBX-5,MSH-7').split('\r')
+		self.assertEqual(redacted[1].split('|')[11], '1 A ST^^CITY^ST^')
+		self.assertEqual(redacted[1].split('|')[5], 'DOE^JANE~DOE^J')
+		self.assertEqual(redacted[0].split('|')[6], '')
+		self.assertEqual(redacted[3].split('|')[5], '')
+		for spec in ('PID-0', 'pid-5', 'MSH-2', 'MSH', ''):
+			with self.assertRaises(MaskError):
+				compile_mask(spec)
+
+	def test_delimiters_and_stream(self):
+		# the second message uses # for components, so ^ is data there
+		data = (self.message + self.message.replace('|^~\\&|', '|#~\\&|')).replace('\r', '\r\n').encode()
+		whole = Redactor(key=b'k').redact(data)
+		second = whole.split(b'MSH')[2].split(b'\r\n')[1]
+		self.assertEqual(second.count(b'^'), 0)
+		self.assertEqual(second.count(b'~'), 1)
+		self.assertEqual(second.count(b'|'), self.message.split('\r')[1].count('|'))
+		for chunk_size in (1, 7, 4096):
+			out = io.BytesIO()
+			Redactor(key=b'k').stream(io.BytesIO(data), out, chunk_size)
+			self.assertEqual(out.getvalue(), whole)
+
+	def test_command(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = Path(tmp) / 'adt.hl7'
+			path.write_text(self.message)
+			key = Path(tmp) / 'key'
+			key.write_bytes(b'secret\n')
+			output = Path(tmp) / 'redacted.hl7'
+			stderr = io.StringIO()
+			call_command('redacthl7', str(path), output=str(output), key_file=str(key), stderr=stderr)
+			self.assertEqual(output.read_bytes(), Redactor(key=b'secret').redact(self.message.encode()))
+			self.assertIn('2 segments', stderr.getvalue())
+			with self.assertRaises(CommandError):
+				call_command('redacthl7', str(path), output=str(output), mask='PID-x')
+
+
+class CorpusProfileTest(TestCase):
+	def write(self, directory, name, messages):
+		path = Path(directory) / name
+		path.write_text(''.join(messages))
+		return str(path)
+
+	def test_hyperloglog(self):
+		hashes = np.array([value_hash(str(i).encode()) for i in range(20000)], dtype=np.uint64)
+		whole = HyperLogLog()
+		whole.add_hashes(hashes)
+		self.assertAlmostEqual(whole.estimate(), 20000, delta=20000 * 0.05)
+		first, second = HyperLogLog(), HyperLogLog()
+		first.add_hashes(hashes[:12000])
+		second.add_hashes(hashes[8000:])
+		first.merge(second)
+		self.assertEqual(first.registers.tolist(), whole.registers.tolist())
+		small = HyperLogLog()
+		small.add_hashes(hashes[:10])
+		self.assertEqual(small.estimate(), 10)
+		with self.assertRaises(ValueError):
+			first.merge(HyperLogLog(10))
+
+	def test_hyperloglog_low_precision(self):
+		# at precision 4 the rank comes from 60 bits, past what a float holds exactly
+		hashes = [(1 << bits) + offset << 4 | 3 for bits in range(59) for offset in (-1, 0, 1) if (1 << bits) + offset > 0]
+		for h in hashes:
+			sketch = HyperLogLog(4)
+			sketch.add_hashes(np.array([h], dtype=np.uint64))
+			self.assertEqual(int(sketch.registers[3]), 60 - (h >> 4).bit_length() + 1)
+
+	def test_fields(self):
+		profile = CorpusProfile().add_file('apps/labcheck/test_files/hl7v2-oru-obx-example-1.hl7')
+		report = profile.report()
+		self.assertEqual(report['messages'], 1)
+		msh = report['segments']['MSH']['fields']
+		self.assertEqual(msh['MSH-1']['length']['max'], 1)
+		self.assertEqual(msh['MSH-2']['fill_rate'], 1.0)
+		self.assertEqual(msh['MSH-9']['distinct'], 1)
+		obx = report['segments']['OBX']
+		self.assertEqual(obx['messages'], 1)
+		self.assertEqual(obx['fields']['OBX-1']['filled'], obx['count'])
+		self.assertEqual(obx['fields']['OBX-1']['distinct'], obx['count'])
+		self.assertEqual(sum(obx['fields']['OBX-3']['length']['histogram'].values()), obx['fields']['OBX-3']['filled'])
+
+	def test_merge(self):
+		messages = list(generate_messages(300, seed=5))
+		with tempfile.TemporaryDirectory() as tmp:
+			whole = CorpusProfile().add_file(self.write(tmp, 'all.hl7', messages))
+			parts = CorpusProfile()
+			parts.merge(CorpusProfile().add_file(self.write(tmp, 'a.hl7', messages[:100])))
+			parts.merge(CorpusProfile().add_file(self.write(tmp, 'b.hl7', messages[100:])))
+		expected = whole.report(sketches=True)
+		merged = parts.report(sketches=True)
+		self.assertEqual(merged['files'], 2)
+		self.assertEqual(merged['segments'], expected['segments'])
+		# a report with sketches turns back into the same profile
+		self.assertEqual(CorpusProfile.from_report(expected).report(sketches=True), expected)
+		with self.assertRaises(ValueError):
+			CorpusProfile.from_report(whole.report())
+
+	def test_command(self):
+		messages = list(generate_messages(200, seed=9))
+		with tempfile.TemporaryDirectory() as tmp:
+			paths = [self.write(tmp, 'a.hl7', messages[:50]), self.write(tmp, 'b.hl7', messages[50:])]
+			first = str(Path(tmp) / 'first.json')
+			call_command('profilecorpus', paths[0], output=first, sketches=True, stderr=io.StringIO())
+			output = str(Path(tmp) / 'merged.json')
+			call_command('profilecorpus', paths[1], merge=[first], output=output, workers=2, stderr=io.StringIO())
+			merged = json.loads(Path(output).read_text())
+			stdout = io.StringIO()
+			call_command('profilecorpus', *paths, workers=2, stdout=stdout, stderr=io.StringIO())
+			whole = json.loads(stdout.getvalue())
+			with self.assertRaises(CommandError):
+				call_command('profilecorpus')
+		self.assertEqual(merged['messages'], 200)
+		self.assertNotIn('sketch', merged['segments']['PID']['fields']['PID-5'])
+		self.assertEqual(merged['segments'], whole['segments'])
+
+
+class VolumeMonitorTest(TestCase):
+	def result(self, sender, codes, msg_type='ORU'):
+		return {'message': {'from_location': sender, 'msg_type': msg_type},
+			'observations': [{'observation_identifier': [code, 'x', 'LN']} for code in codes]}
+
+	def steady(self, monitor, start, hours, every=60):
+		""" sender A sends an ORU with two results every minute, B one every two minutes """
+		alerts = []
+		for t in range(start, start + hours * 3600, every):
+			alerts += monitor.add(self.result('A', ['2345-7', '718-7']), t)
+			if t % (2 * every) == 0:
+				alerts += monitor.add(self.result('B', ['94500-6']), t)
+		return alerts
+
+	def test_message_time(self):
+		self.assertEqual(message_time('20240101120000'), 1704110400)
+		self.assertEqual(message_time('202401011200-0500'), 1704110400 + 5 * 3600)
+		self.assertEqual(message_time('20240101'), 1704067200)
+		for timestamp in ('', '2024', '20241301', '2024010112000'):
+			self.assertIsNone(message_time(timestamp))
+
+	def test_sketches(self):
+		stream = ['a'] * 500 + ['b'] * 300 + ['c'] * 100 + ['n%d' % i for i in range(400)]
+		halves = SpaceSaving(20), SpaceSaving(20)
+		counts = CountMinSketch(256, 4), CountMinSketch(256, 4)
+		whole = SpaceSaving(20)
+		for i, key in enumerate(stream):
+			whole.add(key)
+			halves[i % 2].add(key)
+			counts[i % 2].add(key)
+		self.assertEqual([key for key, count, error in whole.top(3)], ['a', 'b', 'c'])
+		halves[0].merge(halves[1])
+		counts[0].merge(counts[1])
+		top = halves[0].top(3)
+		self.assertEqual([key for key, count, error in top], ['a', 'b', 'c'])
+		for key, count, error in top:
+			# Space-Saving and Count-Min only overestimate
+			self.assertGreaterEqual(count, stream.count(key))
+			self.assertLessEqual(count - error, stream.count(key))
+			self.assertGreaterEqual(counts[0].estimate(key), stream.count(key))
+		self.assertEqual(len(halves[0].counts), 20)
+
+	def test_decayed_rate(self):
+		rate = DecayedRate(900, 0)
+		for t in range(0, 7200, 10):
+			rate.add(t)
+		self.assertAlmostEqual(rate.rate(7200) * 3600, 360, delta=360 * 0.05)
+		# normalized from the start, no ramp up
+		early = DecayedRate(86400, 0)
+		for t in range(0, 600, 10):
+			early.add(t)
+		self.assertAlmostEqual(early.rate(600) * 3600, 360, delta=360 * 0.05)
+
+	def test_alerts(self):
+		monitor = VolumeMonitor()
+		start = 1704067200
+		self.assertEqual(self.steady(monitor, start, 48), [])
+		# A goes quiet while B sends a flood of a new code
+		alerts = []
+		t = start + 48 * 3600
+		for t in range(t, t + 3 * 3600, 120):
+			alerts += monitor.add(self.result('B', ['94500-6'] + ['99999-9'] * 5), t)
+		kinds = {(alert['kind'], alert['sender'], alert['status']) for alert in alerts}
+		self.assertEqual(kinds, {('volume_drop', 'A', 'open'), ('code_spike', 'B', 'open')})
+		drop = [alert for alert in alerts if alert['kind'] == 'volume_drop'][0]
+		self.assertEqual(drop['msg_type'], 'ORU')
+		self.assertLess(drop['rate_per_hour'] * 4, drop['baseline_per_hour'])
+		self.assertEqual(monitor.top_codes('A'), [('2345-7', 2880), ('718-7', 2880)])
+		self.assertEqual(monitor.top_codes('B'), [('94500-6', 1530), ('99999-9', 450)])
+		# A is back
+		alerts = self.steady(monitor, t, 2)
+		self.assertIn(('volume_drop', 'A', 'resolved'), {(alert['kind'], alert['sender'], alert['status']) for alert in alerts})
+		report = monitor.report(t + 7200)
+		self.assertEqual(report['senders']['A']['top_codes'][0]['code'], '2345-7')
+
+	def test_bounded_and_mergeable(self):
+		monitor = VolumeMonitor(top_k=2, max_senders=3)
+		for i in range(10):
+			monitor.add(self.result('S%d' % i, ['c%d' % j for j in range(5)]), 1000 + i)
+		self.assertEqual(len(monitor.senders), 3)
+		self.assertTrue(all(len(state.codes.counts) == 2 for state in monitor.senders.values()))
+		whole, parts = VolumeMonitor(), (VolumeMonitor(), VolumeMonitor())
+		for i, t in enumerate(range(0, 6 * 3600, 60)):
+			result = self.result('A', ['2345-7'] * (1 + i % 3) + ['718-7'])
+			whole.add(result, t)
+			parts[i % 2].add(result, t)
+		before = parts[1].report(6 * 3600)
+		parts[0].merge(parts[1])
+		copied = VolumeMonitor().merge(parts[1])
+		self.assertEqual(copied.report(6 * 3600)['senders'], before['senders'])
+		self.assertEqual(parts[0].messages, whole.messages)
+		self.assertEqual(parts[0].top_codes('A'), whole.top_codes('A'))
+		merged, expected = parts[0].report(6 * 3600), whole.report(6 * 3600)
+		self.assertAlmostEqual(merged['senders']['A']['volumes']['ORU']['rate_per_hour'],
+			expected['senders']['A']['volumes']['ORU']['rate_per_hour'], places=1)
+		# the merged monitors have rates of their own, the source is left as it was
+		for monitor in (parts[0], copied):
+			monitor.add(self.result('A', ['718-7'] * 50), 6 * 3600 + 60)
+		self.assertEqual(parts[1].report(6 * 3600), before)
+
+	def test_evicted_sender(self):
+		monitor = VolumeMonitor(max_senders=1)
+		start = 1704067200
+		for t in range(start, start + 48 * 3600, 60):
+			monitor.add(self.result('A', ['2345-7']), t)
+		# A goes quiet; the timer notices
+		t = start + 51 * 3600
+		self.assertEqual([(a['kind'], a['status']) for a in monitor.check(t)], [('volume_drop', 'open')])
+		# a new sender takes A's place: its alert is not resolved, A is no longer watched
+		alerts = monitor.add(self.result('B', ['94500-6']), t + 60) + monitor.check(t + 120)
+		self.assertEqual([(a['kind'], a['sender'], a['status']) for a in alerts], [('volume_drop', 'A', 'evicted')])
+		self.assertEqual(list(monitor.senders), ['B'])
+		self.assertEqual(monitor.check(t + 180), [])
+
+	def test_command(self):
+		messages = [self.message(i) for i in range(300)]
+		with tempfile.TemporaryDirectory() as tmp:
+			path = Path(tmp) / 'oru.hl7'
+			path.write_text(''.join(messages))
+			report = Path(tmp) / 'report.json'
+			stdout, stderr = io.StringIO(), io.StringIO()
+			call_command('watchvolume', str(path), report=str(report), warmup=0, stdout=stdout, stderr=stderr)
+			summary = json.loads(report.read_text())
+		self.assertEqual(summary['messages'], 300)
+		self.assertEqual(summary['senders']['LAB']['top_codes'][0]['code'], '2345-7')
+		self.assertEqual(summary['time'], '2024-01-01T04:59:00Z')
+		self.assertIn('300 messages from 1 senders', stderr.getvalue())
+
+	def test_listener(self):
+		async def exchange(monitor):
+			with ThreadPoolExecutor(max_workers=2) as executor:
+				server = MLLPServer(executor, max_pending=2, monitor=monitor, alerts=io.StringIO())
+				listener = await server.start('127.0.0.1', 0)
+				port = listener.sockets[0].getsockname()[1]
+				await send_messages('127.0.0.1', port, [self.message(i) for i in range(3)] + ['FMSH|^~\\&|A'])
+				listener.close()
+				await listener.wait_closed()
+
+		monitor = VolumeMonitor()
+		asyncio.run(exchange(monitor))
+		self.assertEqual(monitor.messages, 3)
+		self.assertEqual(monitor.top_codes('LAB'), [('2345-7', 3), ('718-7', 3)])
 
+	def message(self, minute):
+		return '\r'.join([
+			'MSH|^~\\&|APP|LAB|R|DOH|%s||ORU^R01|%d|P|2.5.1' % ('202401010%d%02d00' % (minute // 60, minute % 60), minute),
+			'PID|1||1^^^H^MR||DOE^J||19800101|F|||1 A ST^^CITY^ST^12345', 'OBR|1|P1|F1|cbc^CBC^L',
+			'OBX|1|NM|2345-7^Glucose^LN||95', 'OBX|2|NM|718-7^Hgb^LN||12']) + '\r'
@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import index, api_index
+from .views import index, api_index, api_batch
 app_name = 'labcheck'
 urlpatterns = [
     path('', index, name='index'),
     path('api/', api_index, name='api_index'),
+    path('api/batch/', api_batch, name='api_batch'),
 ]
@@ -1,6 +1,8 @@
 from django.shortcuts import render
-from django.http import JsonResponse
-from .management.commands.parsehl7 import parse_message, invalid_hl7,  cleanup_hl7
+from django.http import JsonResponse, StreamingHttpResponse
+from .hl7reader import read_messages
+from .management.commands.parsehl7 import message_record, validate_and_parse
+from .projection import ProjectionError, parse_projection
 import json
 from django.views.decorators.csrf import csrf_exempt
 
@@ -10,13 +12,14 @@ def index(request):
 	if request.method == "POST":
 		hl7_input = request.POST.get("hl7-input", "")
 		try:
-			if invalid_hl7(cleanup_hl7(hl7_input)):
+			responses, parse_error = validate_and_parse(hl7_input)
+			if parse_error:
 				return render(request, 'labcheck/index.html', {
 					"hl7_input": hl7_input,
 					"error": "Invalid HL7 message."
 				})
 
-			parsed_json = parse_message(cleanup_hl7(hl7_input))[0]
+			parsed_json = responses[0]
 		except Exception as e:
 			error = str(e)
 	return render(request, 'labcheck/index.html', {
@@ -25,21 +28,50 @@ def index(request):
 		"error": error
 	})
 
+def request_projection(request):
+	"""The projection named by the "fields" parameter, None when absent; raises ProjectionError."""
+	fields = request.POST.get("fields") or request.GET.get("fields")
+	return parse_projection(fields) if fields else None
+
 @csrf_exempt
 def api_index(request):
 	if request.method == "POST":
 		hl7_file = request.FILES.get("hl7_file")
 		if not hl7_file:
 			return JsonResponse({"error": "No HL7 file uploaded."}, status=400)
+		try:
+			projection = request_projection(request)
+		except ProjectionError as e:
+			return JsonResponse({"error": str(e)}, status=400)
 		try:
 			hl7_content = hl7_file.read().decode("utf-8")
-			if invalid_hl7(cleanup_hl7(hl7_content)):
+			responses, parse_error = validate_and_parse(hl7_content, projection=projection)
+			if parse_error:
 				error ={"hl7_input": hl7_content,"error": "Invalid HL7 message."}
 				return JsonResponse(error, status=200, json_dumps_params={'indent': 2})
 				
-			parsed_json = parse_message(cleanup_hl7(hl7_content))[0]
+			parsed_json = responses[0]
 			return JsonResponse(parsed_json, safe=False, json_dumps_params={'indent': 2})
 		except Exception as e:
 			return JsonResponse({"error": str(e)}, status=500, json_dumps_params={'indent': 2})
 	else:
-		return JsonResponse({"error": "Only POST method allowed."}, status=405, json_dumps_params={'indent': 2})
\ No newline at end of file
+		return JsonResponse({"error": "Only POST method allowed."}, status=405, json_dumps_params={'indent': 2})
+
+def ndjson_records(hl7_file, projection=None):
+	"""Parse an uploaded file one message at a time, yielding compact NDJSON lines."""
+	for offset, message in read_messages(hl7_file):
+		yield json.dumps(message_record(message, projection, offset=offset), separators=(",", ":")) + "\n"
+
+@csrf_exempt
+def api_batch(request):
+	if request.method == "POST":
+		hl7_file = request.FILES.get("hl7_file")
+		if not hl7_file:
+			return JsonResponse({"error": "No HL7 file uploaded."}, status=400)
+		try:
+			projection = request_projection(request)
+		except ProjectionError as e:
+			return JsonResponse({"error": str(e)}, status=400)
+		return StreamingHttpResponse(ndjson_records(hl7_file, projection), content_type="application/x-ndjson")
+	else:
+		return JsonResponse({"error": "Only POST method allowed."}, status=405)
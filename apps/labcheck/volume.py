@@ -0,0 +1,433 @@
+"""Streaming volume monitoring: top OBX-3 codes and rate anomalies per sender.
+
+VolumeMonitor is fed parse results one message at a time and keeps only
+sketches, so memory is bounded whatever the traffic:
+
+- a Count-Min sketch of (sender, OBX-3 code) counts, a fixed table;
+- a Space-Saving summary of the top_k codes of each sender, each tracked
+  code with its own decayed rates;
+- exponentially decayed rates per sender and message type (MSH-4,
+  MSH-9.1), one with a short half-life for "now" and one with a long
+  half-life as the baseline.
+
+At most max_senders senders are tracked; beyond that the quietest one is
+dropped, and its open alerts are closed as evicted rather than resolved,
+since nothing is known about it any more. check() compares the short term rate with the baseline and
+returns an alert record when a sender's volume drops or spikes by more
+than threshold times, or a code spikes, and a resolved record when it is
+back within bounds. add() calls check() every check_interval seconds; a
+listener should also call it on a timer, since a sender that stopped
+sending adds nothing. Monitors of several workers merge() into one.
+"""
+import datetime
+import hashlib
+import math
+import re
+import time
+
+import numpy as np
+
+from .records import component, field_text
+
+DEFAULT_THRESHOLD = 4.0
+
+# seconds
+FAST_HALF_LIFE = 15 * 60
+SLOW_HALF_LIFE = 24 * 3600
+WARMUP = 3600
+CHECK_INTERVAL = 60
+
+# events per hour below which a baseline is too thin to alert on
+MIN_RATE = 10.0
+
+_DIGITS = re.compile(r"\d*")
+
+
+def message_time(timestamp):
+    """ seconds since the epoch of an MSH-7 timestamp, None when it is not one; no offset means UTC """
+    digits = _DIGITS.match(timestamp).group()[:14]
+    if len(digits) < 8 or len(digits) % 2:
+        return None
+    offset = 0
+    for sign in "+-":
+        if sign in timestamp[8:]:
+            zone = timestamp.rsplit(sign, 1)[1]
+            if len(zone) == 4 and zone.isdigit():
+                offset = (int(zone[:2]) * 3600 + int(zone[2:]) * 60) * (1 if sign == "+" else -1)
+    fields = [int(digits[:4])] + [int(digits[i:i + 2]) for i in range(4, len(digits), 2)]
+    try:
+        moment = datetime.datetime(*fields, tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+    return moment.timestamp() - offset
+
+
+def volume_summary(result):
+    """ (MSH-4 sender, MSH-9.1 message type, [OBX-3 codes]) of a parse_message result """
+    header = result.get("message") or {}
+    codes = [component(obx.get("observation_identifier"), 0) for obx in result.get("observations") or ()]
+    return (field_text(header.get("from_location")), field_text(header.get("msg_type")),
+            [code for code in codes if code])
+
+
+def _hashes(key):
+    digest = hashlib.blake2b(key.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class CountMinSketch(object):
+    """ Count-Min sketch: counts never underestimated, overestimated by at most 2/width of the total at 1 - 2**-depth """
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.rows = np.arange(depth)
+
+    def _columns(self, key):
+        h1, h2 = _hashes(key)
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        self.table[self.rows, self._columns(key)] += count
+
+    def estimate(self, key):
+        return int(self.table[self.rows, self._columns(key)].min())
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("cannot merge Count-Min sketches of different sizes")
+        self.table += other.table
+
+
+class SpaceSaving(object):
+    """Space-Saving summary of the most frequent keys, at most capacity of them.
+
+    counts overestimate by at most errors[key], and any key counted more
+    than total / capacity times is in the summary. add() returns the key
+    it evicted, if any.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return None
+        evicted = None
+        error = 0
+        if len(counts) >= self.capacity:
+            evicted = min(counts, key=counts.get)
+            error = counts.pop(evicted)
+            del self.errors[evicted]
+        counts[key] = error + count
+        self.errors[key] = error
+        return evicted
+
+    def floor(self):
+        """ the count any key not in a full summary may have had """
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def top(self, n=None):
+        """ [(key, count, error)] by count, highest first """
+        ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return [(key, count, self.errors[key]) for key, count in ranked[:n]]
+
+    def merge(self, other):
+        """ merge other in; keys missing from a full summary count its floor, as an error """
+        floors = (self.floor(), other.floor())
+        merged = {}
+        for key in set(self.counts) | set(other.counts):
+            count = error = 0
+            for summary, floor in zip((self, other), floors):
+                if key in summary.counts:
+                    count += summary.counts[key]
+                    error += summary.errors[key]
+                else:
+                    count += floor
+                    error += floor
+            merged[key] = (count, error)
+        kept = sorted(merged, key=lambda key: -merged[key][0])[:self.capacity]
+        self.counts = {key: merged[key][0] for key in kept}
+        self.errors = {key: merged[key][1] for key in kept}
+        return set(merged) - set(kept)
+
+
+class DecayedRate(object):
+    """Event rate with exponentially decaying weights, in events per second.
+
+    The rate is normalized by the weight of the time since started, so it
+    is unbiased from the first event instead of ramping up over a few
+    half-lives.
+    """
+
+    __slots__ = ("half_life", "value", "updated", "started")
+
+    def __init__(self, half_life, now):
+        self.half_life = half_life
+        self.value = 0.0
+        self.updated = now
+        self.started = now
+
+    def add(self, now, count=1):
+        if now >= self.updated:
+            self.decay(now)
+            self.value += count
+        else:
+            # late events count with the weight they would have had
+            self.value += count * 2.0 ** ((now - self.updated) / self.half_life)
+
+    def decay(self, now):
+        if now > self.updated:
+            self.value *= 2.0 ** ((self.updated - now) / self.half_life)
+            self.updated = now
+
+    def rate(self, now):
+        self.decay(now)
+        decay = math.log(2) / self.half_life
+        weight = -math.expm1(-decay * max(now - self.started, 0))
+        return self.value * decay / weight if weight > 0 else 0.0
+
+    def merge(self, other):
+        """ add other's events in; other is left as it was """
+        now = max(self.updated, other.updated)
+        self.decay(now)
+        self.value += other.value * 2.0 ** ((other.updated - now) / other.half_life)
+        self.started = min(self.started, other.started)
+
+    def copy(self):
+        rate = DecayedRate(self.half_life, self.updated)
+        rate.value = self.value
+        rate.started = self.started
+        return rate
+
+
+class Rates(object):
+    """ short term and baseline DecayedRate of one stream """
+
+    __slots__ = ("fast", "slow")
+
+    def __init__(self, now, fast_half_life, slow_half_life, started=None):
+        self.fast = DecayedRate(fast_half_life, now)
+        self.slow = DecayedRate(slow_half_life, now)
+        if started is not None:
+            self.fast.started = self.slow.started = started
+
+    def add(self, now, count=1):
+        self.fast.add(now, count)
+        self.slow.add(now, count)
+
+    def per_hour(self, now):
+        return self.fast.rate(now) * 3600, self.slow.rate(now) * 3600
+
+    def merge(self, other):
+        self.fast.merge(other.fast)
+        self.slow.merge(other.slow)
+
+    def copy(self):
+        rates = Rates.__new__(Rates)
+        rates.fast = self.fast.copy()
+        rates.slow = self.slow.copy()
+        return rates
+
+
+class SenderState(object):
+    """ what the monitor keeps of one MSH-4 sender """
+
+    def __init__(self, top_k):
+        # MSH-9.1 to Rates
+        self.volumes = {}
+        self.codes = SpaceSaving(top_k)
+        # OBX-3 code to Rates, for the codes in self.codes
+        self.code_rates = {}
+
+    def quietness(self, now):
+        return sum(rates.slow.rate(now) for rates in self.volumes.values())
+
+
+class VolumeMonitor(object):
+    """Sketches of sender volumes and top codes, with alerts on rate changes.
+
+    now arguments are seconds since the epoch, time.time() when None.
+    """
+
+    def __init__(self, top_k=20, max_senders=1000, threshold=DEFAULT_THRESHOLD,
+                 fast_half_life=FAST_HALF_LIFE, slow_half_life=SLOW_HALF_LIFE, warmup=WARMUP,
+                 min_rate=MIN_RATE, check_interval=CHECK_INTERVAL, width=4096, depth=4):
+        self.top_k = top_k
+        self.max_senders = max_senders
+        self.threshold = threshold
+        self.fast_half_life = fast_half_life
+        self.slow_half_life = slow_half_life
+        self.warmup = warmup
+        self.min_rate = min_rate
+        self.check_interval = check_interval
+        self.code_counts = CountMinSketch(width, depth)
+        self.senders = {}
+        self.started = None
+        self.checked = None
+        # (kind, sender, msg_type or code) of the alerts currently open
+        self.open = {}
+        # open alerts of senders dropped since the last check
+        self.evicted = []
+        self.messages = 0
+
+    def _now(self, now):
+        now = time.time() if now is None else now
+        if self.started is None:
+            self.started = self.checked = now
+        return now
+
+    def add(self, result, now=None):
+        """ count one parse_message result (dict or records.CompactMessage); returns alert records """
+        sender, msg_type, codes = volume_summary(result)
+        return self.count(sender, msg_type, codes, now)
+
+    def count(self, sender, msg_type, codes, now=None):
+        """ count one message as volume_summary gives it; returns alert records """
+        now = self._now(now)
+        state = self._sender(sender, now)
+        volume = state.volumes.get(msg_type)
+        if volume is None:
+            volume = state.volumes[msg_type] = Rates(now, self.fast_half_life, self.slow_half_life)
+        volume.add(now)
+        for code in codes:
+            self.code_counts.add("%s\x1f%s" % (sender, code))
+            evicted = state.codes.add(code)
+            if evicted is not None:
+                state.code_rates.pop(evicted, None)
+            rates = state.code_rates.get(code)
+            if rates is None:
+                # a code's baseline covers the whole run, so a new code that floods in stands out
+                rates = state.code_rates[code] = Rates(now, self.fast_half_life, self.slow_half_life,
+                                                       started=self.started)
+            rates.add(now)
+        self.messages += 1
+        if now - self.checked >= self.check_interval:
+            return self.check(now)
+        return []
+
+    def _sender(self, sender, now):
+        state = self.senders.get(sender)
+        if state is None:
+            if len(self.senders) >= self.max_senders:
+                quietest = min(self.senders, key=lambda name: self.senders[name].quietness(now))
+                del self.senders[quietest]
+                for key in [key for key in self.open if key[1] == quietest]:
+                    self.evicted.append(self.open.pop(key))
+            state = self.senders[sender] = SenderState(self.top_k)
+        return state
+
+    def check(self, now=None):
+        """ alert records for the rates that crossed the threshold or came back since the last check """
+        now = self._now(now)
+        self.checked = now
+        if now - self.started < self.warmup:
+            return []
+        alerts = []
+        anomalous = set()
+        floor = self.min_rate
+        for sender, state in self.senders.items():
+            for msg_type, rates in state.volumes.items():
+                if now - rates.slow.started < self.warmup:
+                    continue
+                fast, slow = rates.per_hour(now)
+                if slow < floor:
+                    continue
+                if fast * self.threshold < slow:
+                    kind = "volume_drop"
+                elif fast > slow * self.threshold:
+                    kind = "volume_spike"
+                else:
+                    continue
+                anomalous.add((kind, sender, msg_type))
+                self._open(alerts, (kind, sender, msg_type), now, fast, slow)
+            for code, rates in state.code_rates.items():
+                fast, slow = rates.per_hour(now)
+                if fast > max(slow, floor) * self.threshold:
+                    anomalous.add(("code_spike", sender, code))
+                    self._open(alerts, ("code_spike", sender, code), now, fast, slow)
+        for key in list(self.open):
+            if key not in anomalous:
+                alerts.append(dict(self.open.pop(key), status="resolved", time=iso_time(now)))
+        alerts.extend(dict(alert, status="evicted", time=iso_time(now)) for alert in self.evicted)
+        self.evicted = []
+        return alerts
+
+    def _open(self, alerts, key, now, fast, slow):
+        if key in self.open:
+            return
+        kind, sender, subject = key
+        alert = {
+            "time": iso_time(now),
+            "status": "open",
+            "kind": kind,
+            "sender": sender,
+            "code" if kind == "code_spike" else "msg_type": subject,
+            "rate_per_hour": round(fast, 2),
+            "baseline_per_hour": round(slow, 2),
+        }
+        self.open[key] = alert
+        alerts.append(alert)
+
+    def top_codes(self, sender, n=None):
+        """ [(code, count)] of a sender, highest first; counts are upper bounds, tightened by the Count-Min sketch """
+        state = self.senders.get(sender)
+        if state is None:
+            return []
+        ranked = [(code, min(count, self.code_counts.estimate("%s\x1f%s" % (sender, code))))
+                  for code, count, _ in state.codes.top()]
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        return ranked[:n]
+
+    def report(self, now=None, top=10):
+        """ rates per sender and message type, and the top codes per sender """
+        now = self._now(now)
+        senders = {}
+        for sender in sorted(self.senders):
+            state = self.senders[sender]
+            volumes = {}
+            for msg_type in sorted(state.volumes):
+                fast, slow = state.volumes[msg_type].per_hour(now)
+                volumes[msg_type] = {"rate_per_hour": round(fast, 2), "baseline_per_hour": round(slow, 2)}
+            senders[sender] = {
+                "volumes": volumes,
+                "top_codes": [{"code": code, "count": count} for code, count in self.top_codes(sender, top)],
+            }
+        return {"time": iso_time(now), "messages": self.messages, "senders": senders,
+                "open_alerts": list(self.open.values())}
+
+    def merge(self, other):
+        """ add the sketches and rates of another monitor with the same settings; other is left as it was """
+        self.code_counts.merge(other.code_counts)
+        self.messages += other.messages
+        if other.started is not None:
+            self.started = other.started if self.started is None else min(self.started, other.started)
+            self.checked = other.checked if self.checked is None else max(self.checked, other.checked)
+        for sender, theirs in other.senders.items():
+            ours = self.senders.get(sender)
+            if ours is None:
+                ours = self._sender(sender, self.checked)
+            for msg_type, rates in theirs.volumes.items():
+                if msg_type in ours.volumes:
+                    ours.volumes[msg_type].merge(rates)
+                else:
+                    ours.volumes[msg_type] = rates.copy()
+            for code in ours.codes.merge(theirs.codes):
+                ours.code_rates.pop(code, None)
+            for code, rates in theirs.code_rates.items():
+                if code not in ours.codes.counts:
+                    continue
+                if code in ours.code_rates:
+                    ours.code_rates[code].merge(rates)
+                else:
+                    ours.code_rates[code] = rates.copy()
+        return self
+
+
+def iso_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
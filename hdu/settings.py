@@ -130,3 +130,7 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Code index built by `manage.py buildcodeindex`; when set, labcheck flags
+# unknown and deprecated OBX-3/OBR-4 codes
+LABCHECK_CODE_INDEX = env("LABCHECK_CODE_INDEX", "")